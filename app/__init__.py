@@ -1,8 +1,9 @@
 from flask import Flask
 from app.config.config import Config
 from app.routes.main import main
+from app.utils.retention import retention_sweeper
 
-def create_app():
+def create_app(start_background=True):
     app = Flask(__name__,
                 static_folder=Config.STATIC_FOLDER,
                 template_folder=Config.TEMPLATE_FOLDER)
@@ -13,4 +14,8 @@ def create_app():
     
     # 注册蓝图
     app.register_blueprint(main)
+    
+    # 后台清理过期会话和超出配额的文件（多进程部署时由 serve.py 在一个工作进程中启动）
+    if start_background:
+        retention_sweeper.start()
     return app 
\ No newline at end of file
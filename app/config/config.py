@@ -8,7 +8,21 @@ class Config:
     # 文件上传配置
     UPLOAD_FOLDER = os.path.join(APP_DIR, 'files/uploads')
     OUTPUT_FOLDER = os.path.join(APP_DIR, 'files/outputs')
+    # 会话数据库（SQLite）；SESSION_FILE 为旧版的 JSON 会话文件，首次启动时导入数据库
+    SESSION_DB = os.path.join(APP_DIR, 'files/sessions.sqlite3')
     SESSION_FILE = os.path.join(APP_DIR, 'files/session_data.json')
+    # 会话保留：最近一次访问后保留的秒数，上传 + 输出目录的总大小上限（超出时按 LRU 淘汰会话），
+    # 后台清理的间隔（秒）和每批删除的会话数
+    SESSION_TTL = 3 * 24 * 3600
+    STORAGE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+    RETENTION_SWEEP_INTERVAL = 600
+    RETENTION_BATCH_SIZE = 500
+    # 生成结果（MIDI/PDF）的内容寻址缓存目录与容量上限
+    RESULT_CACHE_FOLDER = os.path.join(APP_DIR, 'files/cache')
+    RESULT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+    # 下载 / 查看接口：按内容哈希计算 ETag 时缓存的文件数；不会被覆盖的会话文件（原始 MIDI、候选、预览）的浏览器缓存时间（秒）
+    ETAG_CACHE_ENTRIES = 4096
+    ARTIFACT_MAX_AGE = 365 * 24 * 3600
     
     # 静态文件和模板配置
     STATIC_FOLDER = os.path.join(APP_DIR, 'static')
@@ -17,6 +31,60 @@ class Config:
     MUSESCORE_PATH_LINUX = os.path.join(APP_DIR, 'utils/MuseScoreLinux/bin/mscore4portable')
 
     MODEL_PATH=os.path.join(APP_DIR, 'utils','model')
+    MODEL_NAME = 'model1.pt'
+    TEMPERATURE = 0.8
+    # 推测解码的草稿模型文件名（放在 MODEL_PATH 下），为 None 时不启用
+    DRAFT_MODEL_NAME = None
+    SPECULATIVE_NUM_DRAFT = 4  # 每轮草稿 token 数
+    # 采样参数（0 / 1.0 表示不启用对应的过滤或惩罚）
+    SAMPLING_TOP_K = 0
+    SAMPLING_TOP_P = 1.0
+    REPETITION_PENALTY = 1.0
+    # 多候选生成：一次请求最多的候选数，以及排序时节奏对齐度的权重
+    MAX_CANDIDATES = 8
+    CANDIDATE_ALIGNMENT_WEIGHT = 1.0
+    # 编码器输出（含 cross-attention K/V）缓存的字节上限
+    ENCODER_CACHE_MAX_BYTES = 512 * 1024 * 1024
+    # 局部重新生成时左手前缀的 decoder 状态缓存的字节上限
+    DECODER_STATE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+    # 长曲分窗生成：每个窗口右手的 token 数、相邻窗口重叠的 token 数
+    WINDOW_TOKENS = 1024
+    WINDOW_OVERLAP_TOKENS = 256
+    # 分段并行生成：工作进程数，长休止 / 最长段落时长（量化单位），每段前后带入的右手上下文事件数
+    SECTION_WORKERS = os.cpu_count() or 1
+    SECTION_REST_UNITS = 100
+    SECTION_MAX_UNITS = 2000
+    SECTION_CONTEXT_EVENTS = 16
+    # 区间重新生成：区间前带入的右手事件数、左手前缀 token 数上限
+    REGENERATE_CONTEXT_EVENTS = 64
+    REGENERATE_CONTEXT_TOKENS = 256
+    # 生成任务调度：同时运行的任务数、排队上限（超过时返回 503），排队每等 1 秒估计耗时减少的秒数
+    # 前两项是整台机器的上限，serve.py 多进程部署时按工作进程数平分（每个进程至少 1）
+    MAX_CONCURRENT_JOBS = 2
+    MAX_QUEUE_DEPTH = 16
+    SCHEDULER_AGING = 1.0
+    # 估计耗时时每个右手 token 折合的解码步数（编码器与 cross-attn 随右手长度增长的开销）
+    SCHEDULER_SOURCE_WEIGHT = 0.05
+    # 预览模式：先生成多少个左手 token 就返回预览（约前几小节），其余在后台接着生成
+    PREVIEW_TOKENS = 96
+    # 乐谱（PDF）后台渲染的线程数；MuseScore 进程数由下面的批量转换限制，这里只是同时等待的渲染数
+    PDF_RENDER_WORKERS = 8
+    # MuseScore 批量转换：收集请求的窗口（秒，0 表示每个文件单独启动 MuseScore）、每批最多的文件数、同时运行的进程数
+    MUSESCORE_BATCH_WINDOW = 0.2
+    MUSESCORE_BATCH_MAX = 16
+    MUSESCORE_BATCH_WORKERS = 2
+    # 批量生成（/batch）：一次最多的文件数、解压后的总字节数上限、一个 batch 同时解码的曲子数、同时进行的 batch 数
+    BATCH_MAX_FILES = 500
+    BATCH_MAX_BYTES = 200 * 1024 * 1024
+    BATCH_DECODE_SIZE = 8
+    BATCH_CONCURRENCY = 2
+    # 多进程部署（serve.py）：监听地址、工作进程数、每个工作进程的 torch 线程数（None 表示 CPU 核数 / 工作进程数），
+    # 重载或停止时等待进行中的请求和后台生成结束的秒数
+    SERVER_HOST = "0.0.0.0"
+    SERVER_PORT = 5000
+    SERVER_WORKERS = max(1, (os.cpu_count() or 1) // 2)
+    SERVER_TORCH_THREADS = None
+    SERVER_GRACEFUL_TIMEOUT = 300
     
     # MIDI播放器音量配置
     LEFT_HAND_VOLUME_RATIO = 0.8  # 左手音量相对于右手的比例 (80%)
@@ -25,4 +93,5 @@ class Config:
     @staticmethod
     def init_app():
         os.makedirs(Config.UPLOAD_FOLDER, exist_ok=True)
-        os.makedirs(Config.OUTPUT_FOLDER, exist_ok=True) 
\ No newline at end of file
+        os.makedirs(Config.OUTPUT_FOLDER, exist_ok=True)
+        os.makedirs(Config.RESULT_CACHE_FOLDER, exist_ok=True) 
\ No newline at end of file
@@ -1,38 +1,177 @@
 import json
-from app.config.config import Config
 import os
+import time
+import sqlite3
+import threading
+from app.config.config import Config
+
+# ========== 会话存储（SQLite） ==========
+'''
+会话保存在 SQLite 数据库中（WAL 模式），每个会话一行，按 session_id 主键读写：
+    - 写一个会话只更新这一行，不再整体重写 session_data.json
+    - WAL 模式下读不阻塞写，多个工作进程可以同时使用同一个数据库文件
+    - 每个（进程, 线程）使用自己的连接；fork 之后子进程会新建连接，不复用父进程的
+第一次打开数据库时把旧的 session_data.json 导入一次，导入后改名为 session_data.json.imported。
+创建 SessionManager 不会碰数据库文件，第一次读写会话时才打开（建表、导入）：导入 app 包的
+离线脚本（batch_infer.py）、sectional 的 spawn 子进程和 serve.py 的主进程都不会创建或迁移会话库。
+accessed_at 记录最近访问时间（带索引），供 retention 按 TTL 过期清理和按 LRU 淘汰。
+'''
+
 class SessionManager:
     _instance = None
-    _session_data = {}
-    
+    ACCESS_RESOLUTION = 60
+
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(SessionManager, cls).__new__(cls)
-            cls._instance._load_session_data()
+            cls._instance._local = threading.local()
+            cls._instance._ready = False
+            cls._instance._init_lock = threading.Lock()
         return cls._instance
-    
-    def _load_session_data(self):
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        os.makedirs(os.path.dirname(Config.SESSION_DB), exist_ok=True)
+        conn = sqlite3.connect(Config.SESSION_DB, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        if not self._ready:
+            with self._init_lock:
+                if not self._ready:
+                    self._init_db(conn)
+                    self._ready = True
+        return conn
+
+    def _init_db(self, conn):
+        conn.execute('''CREATE TABLE IF NOT EXISTS sessions (
+                            session_id TEXT PRIMARY KEY,
+                            data TEXT NOT NULL,
+                            created_at REAL NOT NULL,
+                            updated_at REAL NOT NULL)''')
+        conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        # 最近访问时间，用于过期清理和按 LRU 淘汰（早期的数据库没有这一列）
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(sessions)')]
+        if 'accessed_at' not in columns:
+            try:
+                conn.execute('ALTER TABLE sessions ADD COLUMN accessed_at REAL NOT NULL DEFAULT 0')
+                conn.execute('UPDATE sessions SET accessed_at = updated_at')
+            except sqlite3.OperationalError:
+                pass  # 其它进程已经加上了
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_sessions_accessed_at ON sessions (accessed_at)')
+        self._import_json(conn)
+
+    def _import_json(self, conn):
+        """把旧的 session_data.json 导入数据库（只做一次，多个进程同时启动时由事务保证）"""
+        if not os.path.exists(Config.SESSION_FILE):
+            return
         try:
-            if os.path.exists(Config.SESSION_FILE):
-                with open(Config.SESSION_FILE, 'r') as f:
-                    self._session_data = json.load(f)
+            conn.execute('BEGIN IMMEDIATE')
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone():
+                conn.execute('COMMIT')
+                return
+            with open(Config.SESSION_FILE, 'r') as f:
+                session_data = json.load(f)
+            now = time.time()
+            conn.executemany('INSERT OR IGNORE INTO sessions (session_id, data, created_at, updated_at, accessed_at) '
+                             'VALUES (?, ?, ?, ?, ?)',
+                             [(session_id, json.dumps(data), now, now, now) for session_id, data in session_data.items()])
+            conn.execute("INSERT INTO meta VALUES ('json_imported', ?)", (str(now),))
+            conn.execute('COMMIT')
+            os.replace(Config.SESSION_FILE, Config.SESSION_FILE + '.imported')
+            print(f"已从 {Config.SESSION_FILE} 导入 {len(session_data)} 个会话")
         except Exception as e:
-            print(f"Error loading session data: {e}")
-            self._session_data = {}
-    
-    def save_session_data(self):
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            print(f"Error importing session data: {e}")
+
+    def get_session(self, session_id):
+        conn = self._connect()
+        row = conn.execute('SELECT data, accessed_at FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+        if row is None:
+            return None
+        # 访问时间只需要粗略的精度，最多每 ACCESS_RESOLUTION 秒写一次
+        now = time.time()
+        if now - row[1] > self.ACCESS_RESOLUTION:
+            try:
+                conn.execute('UPDATE sessions SET accessed_at = ? WHERE session_id = ?', (now, session_id))
+            except sqlite3.OperationalError as e:
+                print(f"Error updating session access time: {e}")
+        return json.loads(row[0])
+
+    def create_session(self, session_id, data):
+        """新建或整体更新一个会话（只写这一行）"""
+        now = time.time()
         try:
-            with open(Config.SESSION_FILE, 'w') as f:
-                json.dump(self._session_data, f)
+            self._connect().execute('''INSERT INTO sessions (session_id, data, created_at, updated_at, accessed_at)
+                                       VALUES (?, ?, ?, ?, ?)
+                                       ON CONFLICT(session_id) DO UPDATE SET data = excluded.data,
+                                                                             updated_at = excluded.updated_at,
+                                                                             accessed_at = excluded.accessed_at''',
+                                    (session_id, json.dumps(data), now, now, now))
         except Exception as e:
             print(f"Error saving session data: {e}")
-    
-    def get_session(self, session_id):
-        return self._session_data.get(session_id)
-    
-    def create_session(self, session_id, data):
-        self._session_data[session_id] = data
-        self.save_session_data()
-    
+
+    def update_session(self, session_id, **fields):
+        """在一个事务里读取、合并 fields 并写回，避免并发更新互相覆盖；会话不存在时返回 None"""
+        return self.update_session_if(session_id, None, **fields)
+
+    def update_session_if(self, session_id, condition, **fields):
+        """
+        同 update_session，但只在 condition(当前会话数据) 为真时写入，不满足时返回 False；
+        判断和写入在同一个事务里，多个进程同时调用时只有一个能成功（如把 status 改为 generating）
+        """
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT data FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            data = json.loads(row[0])
+            if condition is not None and not condition(data):
+                conn.execute('COMMIT')
+                return False
+            data.update(fields)
+            now = time.time()
+            conn.execute('UPDATE sessions SET data = ?, updated_at = ?, accessed_at = ? WHERE session_id = ?',
+                         (json.dumps(data), now, now, session_id))
+            conn.execute('COMMIT')
+            return data
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def delete_session(self, session_id):
+        self._connect().execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+
+    def delete_sessions(self, session_ids):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('DELETE FROM sessions WHERE session_id = ?', [(session_id,) for session_id in session_ids])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def expired_sessions(self, before, limit=500):
+        """最近访问时间早于 before 的会话ID，最久未访问的在前，最多 limit 个"""
+        rows = self._connect().execute('SELECT session_id FROM sessions WHERE accessed_at < ? '
+                                       'ORDER BY accessed_at LIMIT ?', (before, limit)).fetchall()
+        return [row[0] for row in rows]
+
+    def least_recently_used(self, limit=500, offset=0):
+        """按最近访问时间从旧到新返回 [(会话ID, 会话数据)]"""
+        rows = self._connect().execute('SELECT session_id, data FROM sessions ORDER BY accessed_at LIMIT ? OFFSET ?',
+                                       (limit, offset)).fetchall()
+        return [(row[0], json.loads(row[1])) for row in rows]
+
+    def count(self):
+        return self._connect().execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
     def session_exists(self, session_id):
-        return session_id in self._session_data 
\ No newline at end of file
+        return self._connect().execute('SELECT 1 FROM sessions WHERE session_id = ?', (session_id,)).fetchone() is not None
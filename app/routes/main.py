@@ -1,13 +1,22 @@
 import os
 import uuid
 import re
-from flask import Blueprint, request, send_file, render_template, jsonify
+import threading
+from io import BytesIO
+from flask import Blueprint, Response, request, send_file, render_template, jsonify
 from werkzeug.utils import secure_filename
 from app.config.config import Config
 from app.models.session import SessionManager
 from app.utils import transform
-from app.utils.infer import infer
-from app.utils.utils import slice_midi
+from app.utils.infer import infer, regenerate_range, model_fingerprint, save_candidates
+from app.utils.result_cache import result_cache
+from app.utils.file_etag import content_hashes
+from app.utils.scheduler import generation_scheduler
+from app.utils.pdf_render import pdf_renderer
+from app.utils.hand_split import split_hands_bytes
+from app.utils.batch import BatchJob, read_zip_entries, is_midi_name
+from app.utils.cancellation import jobs, watch_disconnect, GenerationCancelled
+from app.utils.utils import slice_midi, slice_midi_file, parse_timecode, midi_to_event, load_midi, midi_to_bytes
 
 main = Blueprint('main', __name__)
 session_manager = SessionManager()
@@ -20,6 +29,236 @@ def contains_chinese(text):
     match = pattern.search(text)
     return match is not None
 
+def generation_cache_key(input_data, left_data, **params):
+    """
+    生成结果的缓存键：原始右手文件内容 + 左手文件内容（bytes，可为 None）+ 所有影响结果的参数
+    模型文件不存在时返回 None（不缓存）
+    """
+    model_id = model_fingerprint(Config.MODEL_NAME)
+    if model_id is None:
+        return None
+    draft_id = model_fingerprint(Config.DRAFT_MODEL_NAME) if Config.DRAFT_MODEL_NAME else None
+    return result_cache.make_key(input_data, left_data,
+                                 kind='midi', model=model_id, draft_model=draft_id, **params)
+
+def source_token_count(source):
+    """右手（第一条音轨）的事件 token 数，用于估计生成耗时；source 为路径或 MIDI 文件内容"""
+    try:
+        midi_file = load_midi(source)
+        return len(midi_to_event(midi_file.tracks[0])) if midi_file.tracks else 0
+    except Exception:
+        return 0
+
+def range_token_count(midi_path, start_sec, end_sec):
+    """区间重新生成的右手 token 数估计：整首右手的 token 数按区间占全曲时长的比例折算"""
+    try:
+        midi_file = load_midi(midi_path)
+        total = len(midi_to_event(midi_file.tracks[0])) if midi_file.tracks else 0
+        length = midi_file.length
+    except Exception:
+        return 0
+    if length <= 0:
+        return total
+    return int(total * max(0.0, min(end_sec, length) - start_sec) / length)
+
+def write_bytes(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def persist_result(result, output_midi_path):
+    """把生成结果（内存中的 MIDI）保存为会话文件：合并后的 MIDI 和多候选时的其它候选"""
+    write_bytes(output_midi_path, result['midi_bytes'])
+    result['output_path'] = output_midi_path
+    if result.get('candidates'):
+        save_candidates(result['candidates'], output_midi_path)
+    return result
+
+def remove_session_files(session_id, *paths):
+    """
+    删除属于该会话的文件：按命名规则直接删除已知路径（截取的输入、预览、输出 MIDI 和候选、
+    转换后的乐谱及其渲染标记、原始乐谱 original_<会话ID>.pdf），不需要列出整个目录；
+    名字里带上传文件名的输入文件（右手 / 左手）由调用方通过 paths 传入，None 会被跳过
+    """
+    output_midi_path = os.path.join(Config.OUTPUT_FOLDER, f"{session_id}_output.mid")
+    base, ext = os.path.splitext(output_midi_path)
+    known = [os.path.join(Config.UPLOAD_FOLDER, f"{session_id}_sliced.mid"),
+             os.path.join(Config.OUTPUT_FOLDER, f"{session_id}_preview.mid"),
+             output_midi_path,
+             os.path.join(Config.OUTPUT_FOLDER, f"original_{session_id}.pdf")]
+    known += [f"{base}_candidate{i}{ext}" for i in range(1, Config.MAX_CANDIDATES)]
+    # PDF 可能正在后台渲染，通过 pdf_renderer 删除，连同渲染标记一起清掉
+    pdf_renderer.invalidate(os.path.join(Config.OUTPUT_FOLDER, f"{session_id}_output.pdf"))
+    for path in known + [path for path in paths if path]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"删除会话文件失败 {path}: {e}")
+
+def send_artifact(file_path, immutable=False, **kwargs):
+    """
+    发送会话文件：以内容 sha256 作为强 ETag，If-None-Match 命中时直接返回 304（不打开文件），
+    支持 Range 请求（PDF 查看器按需分段加载）。
+    immutable=True 用于写入后不会再被覆盖的文件，浏览器缓存 ARTIFACT_MAX_AGE 秒不再请求；
+    其它文件（会被区间重新生成覆盖的输出 MIDI、PDF）每次都向服务器验证，没变时得到 304。
+    """
+    etag = content_hashes.etag(file_path)
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+    else:
+        response = send_file(file_path, etag=etag if etag is not None else True, conditional=True, **kwargs)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    if immutable:
+        response.cache_control.no_cache = None
+        response.cache_control.max_age = Config.ARTIFACT_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+def queue_full_response():
+    response = jsonify({'error': '服务器繁忙，请稍后重试'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(generation_scheduler.retry_after())
+    return response
+
+def duplicate_job_response(job_id):
+    """客户端指定的 job_id 已被正在运行的任务使用"""
+    return jsonify({'error': f'任务ID {job_id} 已被正在运行的任务使用', 'job_id': job_id}), 409
+
+def error_response(error):
+    """把 generate_accompaniment 返回的 (错误信息, HTTP状态码) 转换成响应"""
+    message, status = error
+    if status == 503:
+        return queue_full_response()
+    return jsonify({'error': message}), status
+
+def result_summary(result):
+    """生成结果中需要返回给前端（并保存到会话）的附加信息"""
+    summary = {}
+    if result.get('stopped_early'):
+        summary['stopped_early'] = True
+        summary['progress'] = result['progress']
+    if result.get('candidates'):
+        summary['candidates'] = [
+            {'index': i, 'score': c['score'], 'mean_logprob': c['mean_logprob'], 'alignment': c['alignment']}
+            for i, c in enumerate(result['candidates'])
+        ]
+    return summary
+
+def upload_response(session_id, job_id, filename, message, result):
+    response = {
+        'success': True,
+        'session_id': session_id,
+        'job_id': job_id,
+        'message': message,
+        'converted_midi_name': f"converted_{filename}",
+        'converted_pdf_name': filename.replace('.mid', '.pdf')
+    }
+    response.update(result_summary(result))
+    if result.get('stopped_early'):
+        response['message'] += f"（时间预算内完成 {result['progress']:.0%}）"
+    return response
+
+def generate_accompaniment(process_data, input_data, left_data, options, cancel, preview_path=None, on_preview=None):
+    """
+    /upload 的生成流水线：查结果缓存 → 按估计耗时排队 → 生成左手 → 存入结果缓存，全程在内存中进行
+    process_data 为送入模型的右手 MIDI 内容（截取过时间区间的），input_data / left_data 为上传的原始内容
+    （用于缓存键，left_data 可为 None）；options 为 /upload 解析出的参数（target_len、seed、num_candidates、
+    time_budget、full_length、parallel_sections、start_time、end_time）；preview_path / on_preview 见 infer
+    返回 (result, error)：成功时 error 为 None，result['midi_bytes'] 为合并后的 MIDI，是否落盘由调用方决定
+    （见 persist_result）；失败时 result 为 None，error 为 (错误信息, HTTP状态码)，排队已满时状态码为 503。
+    取消时抛出 GenerationCancelled
+    """
+    # 给定 seed 的单候选生成是确定的，按输入内容和参数查结果缓存；不给 seed 时用户期望每次不同，不缓存
+    # 带时间预算的生成在哪里结束取决于当时的机器负载，同样不缓存
+    midi_cache_key = None
+    if options['seed'] is not None and options['num_candidates'] == 1 and options['time_budget'] is None:
+        midi_cache_key = generation_cache_key(
+            input_data, left_data, seed=options['seed'], temperature=Config.TEMPERATURE,
+            target_len=options['target_len'], start_time=options['start_time'], end_time=options['end_time'],
+            top_k=Config.SAMPLING_TOP_K, top_p=Config.SAMPLING_TOP_P,
+            repetition_penalty=Config.REPETITION_PENALTY, full_length=options['full_length'],
+            parallel_sections=options['parallel_sections'])
+    cached = result_cache.get(midi_cache_key, '.mid') if midi_cache_key is not None else None
+    if cached is not None:
+        result = {'midi_bytes': cached, 'output_path': None, 'cached': True}
+    else:
+        # 按估计耗时排队（短任务优先），排队已满时拒绝
+        cost = generation_scheduler.estimate_cost(source_token_count(process_data), options['target_len'],
+                                                  full_length=options['full_length'],
+                                                  time_budget=options['time_budget'])
+        ticket = generation_scheduler.acquire(cost, cancel=cancel)
+        if ticket is None:
+            cancel.check()
+            return None, ('服务器繁忙，请稍后重试', 503)
+        try:
+            result = infer(right_input_path=process_data, output_path=None, left_input_path=left_data,
+                           target_len=options['target_len'], model_name=Config.MODEL_NAME, temperature=Config.TEMPERATURE,
+                           draft_model_name=Config.DRAFT_MODEL_NAME, num_draft=Config.SPECULATIVE_NUM_DRAFT,
+                           top_k=Config.SAMPLING_TOP_K, top_p=Config.SAMPLING_TOP_P,
+                           repetition_penalty=Config.REPETITION_PENALTY, seed=options['seed'],
+                           num_candidates=options['num_candidates'], alignment_weight=Config.CANDIDATE_ALIGNMENT_WEIGHT,
+                           full_length=options['full_length'], window_tokens=Config.WINDOW_TOKENS,
+                           window_overlap=Config.WINDOW_OVERLAP_TOKENS,
+                           parallel_sections=options['parallel_sections'], section_workers=Config.SECTION_WORKERS,
+                           time_budget=options['time_budget'], cancel=cancel,
+                           preview_path=preview_path, preview_steps=Config.PREVIEW_TOKENS, on_preview=on_preview)
+        finally:
+            generation_scheduler.release(ticket)
+        if result and midi_cache_key is not None:
+            result_cache.put_bytes(midi_cache_key, '.mid', result['midi_bytes'])
+    if not result:
+        return None, ('MIDI处理失败，可能是文件格式不正确或模型加载失败', 500)
+    # PDF 不在这里导出，第一次查看 / 下载时由 pdf_renderer 在后台渲染
+    cancel.check()
+    return result, None
+
+def finish_background_generation(session_id, outcome):
+    """预览模式的后台生成结束后更新会话状态：ready / failed / cancelled；失败或取消时清理文件"""
+    session = session_manager.get_session(session_id)
+    if session is None:
+        return
+    inputs = (session.get('input_path'), session.get('left_input_path'))
+    if outcome.get('cancelled'):
+        remove_session_files(session_id, *inputs)
+        fields = {'status': 'cancelled'}
+    elif outcome.get('error'):
+        remove_session_files(session_id, *inputs)
+        fields = {'status': 'failed', 'error': outcome['error'][0]}
+    else:
+        result = outcome['result']
+        fields = {'status': 'ready'}
+        if result.get('candidates'):
+            fields['candidates'] = result['candidates']
+        fields.update({key: value for key, value in result_summary(result).items() if key != 'candidates'})
+        if result.get('stopped_early'):
+            fields['message'] = session['message'] + f"（时间预算内完成 {result['progress']:.0%}）"
+    session_manager.update_session(session_id, **fields)
+
+def pdf_pending(session):
+    """
+    转换后的乐谱还没渲染好时返回 202（没有渲染任务时提交一个），渲染失败返回 500；PDF 已就绪时返回 None
+    """
+    status = pdf_renderer.request(session['output_midi_path'], session['output_pdf_path'])
+    if status == 'rendering':
+        response = jsonify({'status': 'rendering', 'message': '乐谱正在生成，请稍后'})
+        response.status_code = 202
+        response.headers['Retry-After'] = '1'
+        return response
+    if status == 'failed':
+        return jsonify({'error': 'PDF生成失败，请检查MuseScore是否正确安装'}), 500
+    return None
+
+def generation_pending(session):
+    """预览模式下完整结果还在后台生成时返回 202 响应，否则返回 None"""
+    if session.get('status') == 'generating':
+        return jsonify({'status': 'generating', 'message': '完整伴奏仍在生成中'}), 202
+    return None
+
 @main.route('/')
 def startup():
     return render_template('startup.html')
@@ -70,6 +309,38 @@ def upload_file():
     except (ValueError, TypeError):
         target_len = 800
     
+    # 获取随机种子参数（可选，给定时同样的输入生成同样的结果）
+    seed = request.form.get('seed')
+    try:
+        seed = int(seed) if seed not in (None, '') else None
+    except (ValueError, TypeError):
+        return jsonify({'error': 'seed 必须是整数'}), 400
+    
+    # 获取候选数参数（可选，默认1）：一次生成多个左手并按得分排序
+    num_candidates = request.form.get('num_candidates', '1')
+    try:
+        num_candidates = min(max(int(num_candidates), 1), Config.MAX_CANDIDATES)
+    except (ValueError, TypeError):
+        num_candidates = 1
+    
+    # 获取时间预算参数（可选，秒）：预算快用完时在合适的位置提前结束生成
+    time_budget = request.form.get('time_budget')
+    try:
+        time_budget = float(time_budget) if time_budget not in (None, '') else None
+    except (ValueError, TypeError):
+        return jsonify({'error': 'time_budget 必须是数字'}), 400
+    if time_budget is not None and time_budget <= 0:
+        return jsonify({'error': 'time_budget 必须大于0'}), 400
+    
+    # 是否生成覆盖整首曲子的左手（分窗生成，忽略 target_len）
+    full_length = request.form.get('full_length', '').lower() in ('1', 'true', 'yes', 'on')
+    # 整曲生成时是否按乐句切段并行生成（多核 CPU 上更快，段落之间左手不互相衔接）
+    parallel_sections = full_length and request.form.get('parallel', '').lower() in ('1', 'true', 'yes', 'on')
+    # 预览模式：先返回前几小节的合并 MIDI，完整结果在后台继续生成（多候选 / 分段并行生成不支持）
+    preview = request.form.get('preview', '').lower() in ('1', 'true', 'yes', 'on')
+    # 是否保存为会话（默认保存）；persist=0 时不写任何文件，直接返回合并后的 MIDI（不支持预览）
+    persist = request.form.get('persist', '1').lower() not in ('0', 'false', 'no', 'off')
+    
     # 检查文件名是否包含中文
     if contains_chinese(file.filename):
         return jsonify({'error': '文件名不能包含中文'}), 400
@@ -83,125 +354,251 @@ def upload_file():
         return jsonify({'error': '左手文件必须是MIDI格式'}), 400
     
     if file and file.filename.endswith('.mid'):
-        # 生成会话ID并保存文件
+        # 生成会话ID；上传内容直接从请求流读入内存，解析、截取、生成都不经过磁盘
         session_id = str(uuid.uuid4())
         filename = secure_filename(file.filename)
         input_path = os.path.join(Config.UPLOAD_FOLDER, f"{session_id}_{filename}")
         output_midi_path = os.path.join(Config.OUTPUT_FOLDER, f"{session_id}_output.mid")
         output_pdf_path = os.path.join(Config.OUTPUT_FOLDER, f"{session_id}_output.pdf")
+        preview_midi_path = os.path.join(Config.OUTPUT_FOLDER, f"{session_id}_preview.mid")
+        input_data = file.read()
         
         # 左手文件路径（如果有的话）
         left_input_path = None
+        left_data = None
         if has_left_hand_file:
             left_hand_filename = secure_filename(left_hand_file.filename)
             left_input_path = os.path.join(Config.UPLOAD_FOLDER, f"{session_id}_left_{left_hand_filename}")
+            left_data = left_hand_file.read()
+        
+        # 任务ID（可由客户端指定，用于 /cancel/<job_id>）；客户端断开连接时同样取消任务
+        job_id = request.form.get('job_id') or session_id
+        cancel = jobs.register(job_id)
+        if cancel is None:
+            return duplicate_job_response(job_id)
+        request_done = threading.Event()
+        watch_disconnect(request.environ, cancel, request_done)
+        # 预览模式下任务交给后台线程，由它负责注销
+        handed_off = False
         
         try:
-            file.save(input_path)
+            # 如果指定了时间区间，先在内存中截取
+            process_data = input_data
+            process_input_path = input_path
+            if has_time_interval:
+                process_data = midi_to_bytes(slice_midi_file(load_midi(input_data), start_time, end_time))
+                process_input_path = os.path.join(Config.UPLOAD_FOLDER, f"{session_id}_sliced.mid")
             
-            # 保存左手文件（如果有的话）
+            # 处理MIDI文件
+            print(f"开始处理MIDI文件: {filename}（{len(process_data)} 字节），目标生成序列长度: {target_len}")
             if has_left_hand_file:
-                left_hand_file.save(left_input_path)
+                print(f"使用左手伴奏文件: {left_hand_filename}")
+            options = {
+                'target_len': target_len,
+                'seed': seed,
+                'num_candidates': num_candidates,
+                'time_budget': time_budget,
+                'full_length': full_length,
+                'parallel_sections': parallel_sections,
+                'start_time': start_time if has_time_interval else None,
+                'end_time': end_time if has_time_interval else None,
+            }
             
-            # 如果指定了时间区间，先截取文件
-            process_input_path = input_path
+            if not persist:
+                # 不保存会话：生成结果直接作为响应返回，整个请求不写任何文件
+                result, error = generate_accompaniment(process_data, input_data, left_data, options, cancel)
+                if error is not None:
+                    return error_response(error)
+                return send_file(BytesIO(result['midi_bytes']), mimetype='audio/midi', as_attachment=True,
+                                 download_name=f"converted_{filename}")
+            
+            # 保存会话需要的输入文件（下载原始 MIDI、导出原始乐谱时使用）
+            write_bytes(input_path, input_data)
+            if has_left_hand_file:
+                write_bytes(left_input_path, left_data)
             if has_time_interval:
-                sliced_path = os.path.join(Config.UPLOAD_FOLDER, f"{session_id}_sliced.mid")
-                slice_midi(input_path, sliced_path, start_time, end_time)
-                process_input_path = sliced_path
+                write_bytes(process_input_path, process_data)
             
-            # 处理MIDI文件
-            print(f"开始处理MIDI文件: {process_input_path}，目标生成序列长度: {target_len}")
+            # 保存会话数据
+            session_data = {
+                'original_filename': filename,
+                'input_path': input_path,
+                'output_midi_path': output_midi_path,
+                'output_pdf_path': output_pdf_path
+            }
+            
+            # 如果有左手文件，保存相关信息
             if has_left_hand_file:
-                print(f"使用左手伴奏文件: {left_input_path}")
-            if not infer(right_input_path=process_input_path, output_path=output_midi_path, left_input_path=left_input_path,target_len=target_len):
-                # 清理已上传的文件
-                if os.path.exists(input_path):
-                    os.remove(input_path)
-                if has_left_hand_file and os.path.exists(left_input_path):
-                    os.remove(left_input_path)
-                if has_time_interval and os.path.exists(process_input_path):
-                    os.remove(process_input_path)
-                return jsonify({'error': 'MIDI处理失败，可能是文件格式不正确或模型加载失败'}), 500
-            # 验证输出文件是否创建成功
-            if not os.path.exists(output_midi_path):
-                if os.path.exists(input_path):
-                    os.remove(input_path)
-                if has_left_hand_file and os.path.exists(left_input_path):
-                    os.remove(left_input_path)
-                if has_time_interval and os.path.exists(process_input_path):
-                    os.remove(process_input_path)
-                return jsonify({'error': 'MIDI处理失败，输出文件未生成'}), 500
+                session_data['left_input_path'] = left_input_path
+                session_data['left_hand_filename'] = left_hand_filename
+            
+            # 如果有时间区间，保存相关信息
+            if has_time_interval:
+                session_data['sliced_path'] = process_input_path
+                session_data['start_time'] = start_time
+                session_data['end_time'] = end_time
+                if has_left_hand_file:
+                    message = f'左手伴奏生成成功（使用左手伴奏文件，时间区间：{start_time}-{end_time}，目标生成序列长度：{target_len}）'
+                else:
+                    message = f'左手伴奏生成成功（时间区间：{start_time}-{end_time}，目标生成序列长度：{target_len}）'
+            else:
+                if has_left_hand_file:
+                    message = f'左手伴奏生成成功（使用左手伴奏文件，目标生成序列长度：{target_len}）'
+                else:
+                    message = f'左手伴奏生成成功（目标生成序列长度：{target_len}）'
+            
+            # 保存target_len到会话数据
+            session_data['target_len'] = target_len
+            session_data['seed'] = seed
+            session_data['full_length'] = full_length
+            
+            if preview and num_candidates == 1 and not parallel_sections:
+                # 预览模式：先返回前几小节，完整结果在后台从同一个 decoder 状态接着生成，前端轮询 /status/<session_id>
+                session_data['status'] = 'generating'
+                session_data['preview_midi_path'] = preview_midi_path
+                session_data['message'] = message
+                session_manager.create_session(session_id, session_data)
+                outcome = {}
+                settled = threading.Event()
                 
-            # 直接生成PDF
-            print(f"开始生成PDF: {output_pdf_path}")
-            if not transform.export_pdf(output_midi_path, output_pdf_path):
-                return jsonify({'error': 'PDF生成失败，请检查MuseScore是否正确安装'}), 500
+                def on_preview(info):
+                    outcome['preview'] = info
+                    settled.set()
+                
+                def run():
+                    try:
+                        outcome['result'], outcome['error'] = generate_accompaniment(
+                            process_data, input_data, left_data, options, cancel,
+                            preview_path=preview_midi_path, on_preview=on_preview)
+                        if outcome['result']:
+                            persist_result(outcome['result'], output_midi_path)
+                    except GenerationCancelled:
+                        print(f"任务 {job_id} 已取消（{cancel.reason}），清理文件")
+                        outcome['cancelled'] = True
+                    except Exception as e:
+                        print(f"后台生成过程中发生错误: {str(e)}")
+                        outcome['result'], outcome['error'] = None, (f'文件处理失败: {str(e)}', 500)
+                    finally:
+                        finish_background_generation(session_id, outcome)
+                        jobs.unregister(job_id)
+                        settled.set()
+                
+                threading.Thread(target=run, daemon=True).start()
+                handed_off = True
+                settled.wait()
+                
+                # 预览之前就已结束（命中结果缓存、生成很短或失败）时按普通上传返回
+                if outcome.get('cancelled'):
+                    return jsonify({'error': '任务已取消'}), 499
+                if 'preview' not in outcome:
+                    if outcome.get('error'):
+                        return error_response(outcome['error'])
+                    return jsonify(upload_response(session_id, job_id, filename, message, outcome['result']))
+                return jsonify({
+                    'success': True,
+                    'session_id': session_id,
+                    'job_id': job_id,
+                    'status': 'generating',
+                    'preview': True,
+                    'preview_url': f'/download/preview/{session_id}',
+                    'preview_seconds': outcome['preview']['elapsed'],
+                    'message': '预览已生成，完整伴奏正在后台生成',
+                    'converted_midi_name': f"converted_{filename}",
+                    'converted_pdf_name': filename.replace('.mid', '.pdf')
+                })
+            
+            result, error = generate_accompaniment(process_data, input_data, left_data, options, cancel)
+            if error is not None:
+                # 清理已保存的输入文件
+                remove_session_files(session_id, input_path, left_input_path)
+                return error_response(error)
+            persist_result(result, output_midi_path)
                 
+        except GenerationCancelled:
+            print(f"任务 {job_id} 已取消（{cancel.reason}），清理文件")
+            remove_session_files(session_id, input_path, left_input_path)
+            # 499: 客户端已关闭请求（nginx 约定），主动取消时调用方会收到这个响应
+            return jsonify({'error': '任务已取消'}), 499
         except Exception as e:
             print(f"文件处理过程中发生错误: {str(e)}")
-            # 清理可能的临时文件
-            for temp_file in [input_path, output_midi_path, output_pdf_path]:
-                if os.path.exists(temp_file):
-                    try:
-                        os.remove(temp_file)
-                    except:
-                        pass
-            if has_left_hand_file and os.path.exists(left_input_path):
-                try:
-                    os.remove(left_input_path)
-                except:
-                    pass
-            if has_time_interval and os.path.exists(process_input_path):
-                try:
-                    os.remove(process_input_path)
-                except:
-                    pass
+            # 清理可能已写入的文件
+            remove_session_files(session_id, input_path, left_input_path)
             return jsonify({'error': f'文件处理失败: {str(e)}'}), 500
+        finally:
+            request_done.set()
+            if not handed_off:
+                jobs.unregister(job_id)
         
-        # 保存会话数据
-        session_data = {
-            'original_filename': filename,
-            'input_path': input_path,
-            'output_midi_path': output_midi_path,
-            'output_pdf_path': output_pdf_path
-        }
-        
-        # 如果有左手文件，保存相关信息
-        if has_left_hand_file:
-            session_data['left_input_path'] = left_input_path
-            session_data['left_hand_filename'] = left_hand_filename
-        
-        # 如果有时间区间，保存相关信息
-        if has_time_interval:
-            session_data['sliced_path'] = process_input_path
-            session_data['start_time'] = start_time
-            session_data['end_time'] = end_time
-            if has_left_hand_file:
-                message = f'左手伴奏生成成功（使用左手伴奏文件，时间区间：{start_time}-{end_time}，目标生成序列长度：{target_len}）'
-            else:
-                message = f'左手伴奏生成成功（时间区间：{start_time}-{end_time}，目标生成序列长度：{target_len}）'
-        else:
-            if has_left_hand_file:
-                message = f'左手伴奏生成成功（使用左手伴奏文件，目标生成序列长度：{target_len}）'
-            else:
-                message = f'左手伴奏生成成功（目标生成序列长度：{target_len}）'
-        
-        # 保存target_len到会话数据
-        session_data['target_len'] = target_len
+        if result.get('candidates'):
+            session_data['candidates'] = result['candidates']
             
         session_manager.create_session(session_id, session_data)
         
-        return jsonify({
-            'success': True,
-            'session_id': session_id,
-            'message': message,
-            'converted_midi_name': f"converted_{filename}",
-            'converted_pdf_name': filename.replace('.mid', '.pdf')
-        })
+        return jsonify(upload_response(session_id, job_id, filename, message, result))
     
     return jsonify({'error': '只支持MIDI文件格式'}), 400
 
+@main.route('/batch', methods=['POST'])
+def batch_generate():
+    """
+    批量生成：file 为包含 MIDI 的 zip，或用 files 上传多个 MIDI（如选择整个目录），所有文件共用
+    target_len / seed / full_length；pdf=1 时同时导出乐谱。
+    返回流式的 zip：converted_<名称>.mid（和 <名称>.pdf），以及记录每个文件状态的 manifest.json。
+    不创建会话，也不保存任何文件；可以用 job_id 调用 /cancel/<job_id> 取消
+    """
+    entries = []
+    archive = request.files.get('file')
+    try:
+        if archive and archive.filename:
+            entries = read_zip_entries(archive.stream, Config.BATCH_MAX_FILES, Config.BATCH_MAX_BYTES)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    for midi in request.files.getlist('files'):
+        if midi.filename and is_midi_name(midi.filename):
+            entries.append((midi.filename, midi.read()))
+    if not entries:
+        return jsonify({'error': '没有找到MIDI文件'}), 400
+    if len(entries) > Config.BATCH_MAX_FILES:
+        return jsonify({'error': f'一次最多处理 {Config.BATCH_MAX_FILES} 个文件'}), 400
+    
+    try:
+        target_len = min(max(int(request.form.get('target_len', '800')), 0), 4000)
+    except (ValueError, TypeError):
+        target_len = 800
+    seed = request.form.get('seed')
+    try:
+        seed = int(seed) if seed not in (None, '') else None
+    except (ValueError, TypeError):
+        return jsonify({'error': 'seed 必须是整数'}), 400
+    options = {
+        'target_len': target_len,
+        'seed': seed,
+        'full_length': request.form.get('full_length', '').lower() in ('1', 'true', 'yes', 'on'),
+    }
+    with_pdf = request.form.get('pdf', '').lower() in ('1', 'true', 'yes', 'on')
+    
+    job_id = request.form.get('job_id') or str(uuid.uuid4())
+    cancel = jobs.register(job_id)
+    if cancel is None:
+        return duplicate_job_response(job_id)
+    request_done = threading.Event()
+    watch_disconnect(request.environ, cancel, request_done)
+    print(f"批量生成：{len(entries)} 个文件，目标生成序列长度: {target_len}")
+    job = BatchJob(entries, options, cancel, with_pdf=with_pdf)
+    
+    def generate():
+        try:
+            yield from job.stream()
+        finally:
+            request_done.set()
+            jobs.unregister(job_id)
+    
+    response = Response(generate(), mimetype='application/zip')
+    response.headers['Content-Disposition'] = 'attachment; filename=batch_results.zip'
+    response.headers['X-Job-Id'] = job_id
+    response.headers['X-Batch-Files'] = str(len(entries))
+    return response
+
 @main.route('/auto-process-midi', methods=['POST'])
 def auto_process_midi():
     """
@@ -219,53 +616,20 @@ def auto_process_midi():
         return jsonify({'error': '文件名不能包含中文'}), 400
     
     if file and (file.filename.endswith('.mid') or file.filename.endswith('.midi')):
-        # 生成临时ID和文件路径
-        temp_id = str(uuid.uuid4())
         filename = secure_filename(file.filename)
-        temp_input_path = os.path.join(Config.UPLOAD_FOLDER, f"temp_{temp_id}_{filename}")
-        temp_output_path = os.path.join(Config.OUTPUT_FOLDER, f"temp_{temp_id}_processed.mid")
         
         try:
-            # 保存临时文件
-            file.save(temp_input_path)
-            
-            # 处理MIDI文件
-            if not transform.split_midi(temp_input_path, temp_output_path):
-                return jsonify({'error': 'MIDI处理失败'}), 500
-            
-            # 检查处理后的文件是否存在
-            if not os.path.exists(temp_output_path):
-                return jsonify({'error': '处理后的MIDI文件不存在'}), 500
-            
-            # 读取处理后的文件内容到内存中
-            with open(temp_output_path, 'rb') as f:
-                midi_content = f.read()
-            
-            # 创建一个BytesIO对象
-            from io import BytesIO
-            midi_buffer = BytesIO(midi_content)
-            midi_buffer.seek(0)
-                
-            # 返回处理后的MIDI文件
-            response = send_file(midi_buffer, 
-                               mimetype='audio/midi',
-                               as_attachment=False,
-                               download_name=f"processed_{filename}")
-            
-            return response
-                           
+            # 在内存中拆分左右手，不写临时文件，也不经过 MuseScore
+            midi_content = split_hands_bytes(file.read())
         except Exception as e:
             print(f"自动处理MIDI文件时发生错误: {str(e)}")
             return jsonify({'error': f'处理失败: {str(e)}'}), 500
-        finally:
-            # 清理临时文件
-            try:
-                if os.path.exists(temp_input_path):
-                    os.remove(temp_input_path)
-                if os.path.exists(temp_output_path):
-                    os.remove(temp_output_path)
-            except:
-                pass  # 忽略清理错误
+        
+        # 返回处理后的MIDI文件
+        return send_file(BytesIO(midi_content),
+                         mimetype='audio/midi',
+                         as_attachment=False,
+                         download_name=f"processed_{filename}")
     
     return jsonify({'error': '只支持MIDI文件格式'}), 400
 
@@ -274,40 +638,197 @@ def convert_to_pdf(session_id):
     session = session_manager.get_session(session_id)
     if not session:
         return jsonify({'error': '会话不存在'}), 404
+    pending = generation_pending(session)
+    if pending:
+        return pending
     
-    # 使用转换后的MIDI文件而不是原始文件
-    input_path = session['output_midi_path']
-    output_pdf_path = session['output_pdf_path']
-    
-    # 调用transform.py的PDF转换函数
-    success = transform.export_pdf(input_path, output_pdf_path)
+    # 使用转换后的MIDI文件而不是原始文件；在后台渲染，未完成时返回 202
+    pending = pdf_pending(session)
+    if pending:
+        return pending
     
-    if success:
-        return jsonify({
-            'success': True,
-            'message': 'PDF已生成'
-        })
-    else:
-        return jsonify({
-            'success': False,
-            'error': 'PDF生成失败'
-        }), 500
+    return jsonify({
+        'success': True,
+        'message': 'PDF已生成'
+    })
 
 @main.route('/download/<file_type>/<session_id>', methods=['GET'])
 def download_file(file_type, session_id):
     session = session_manager.get_session(session_id)
     if not session:
         return jsonify({'error': '会话不存在'}), 404
+    pending = generation_pending(session)
+    if pending:
+        return pending
     
     if file_type == 'midi':
         file_path = session['output_midi_path']
-        return send_file(file_path, as_attachment=True, download_name=f"converted_{session['original_filename']}")
+        return send_artifact(file_path, as_attachment=True, download_name=f"converted_{session['original_filename']}")
     elif file_type == 'pdf':
+        pending = pdf_pending(session)
+        if pending:
+            return pending
         file_path = session['output_pdf_path']
-        return send_file(file_path, as_attachment=True, download_name=f"{session['original_filename'].replace('.mid', '.pdf')}")
+        return send_artifact(file_path, as_attachment=True, download_name=f"{session['original_filename'].replace('.mid', '.pdf')}")
     else:
         return jsonify({'error': '未知文件类型'}), 400
 
+@main.route('/download/candidate/<session_id>/<int:index>', methods=['GET'])
+def download_candidate(session_id, index):
+    """
+    下载多候选生成中的第 index 个候选（0 为得分最高、即默认输出的那个）
+    """
+    session = session_manager.get_session(session_id)
+    if not session:
+        return jsonify({'error': '会话不存在'}), 404
+    
+    candidates = session.get('candidates', [])
+    if index < 0 or index >= len(candidates):
+        return jsonify({'error': '候选不存在'}), 404
+    
+    file_path = candidates[index]['path']
+    if not os.path.exists(file_path):
+        return jsonify({'error': '候选MIDI文件不存在'}), 404
+    
+    return send_artifact(file_path, immutable=True, as_attachment=True,
+                         download_name=f"candidate{index}_{session['original_filename']}")
+
+@main.route('/download/preview/<session_id>', methods=['GET'])
+def download_preview(session_id):
+    """
+    预览模式下先生成的前几小节（右手 + 左手）
+    """
+    session = session_manager.get_session(session_id)
+    if not session:
+        return jsonify({'error': '会话不存在'}), 404
+    
+    file_path = session.get('preview_midi_path')
+    if not file_path or not os.path.exists(file_path):
+        return jsonify({'error': '预览MIDI文件不存在'}), 404
+    
+    return send_artifact(file_path, immutable=True, mimetype='audio/midi')
+
+@main.route('/status/<session_id>', methods=['GET'])
+def generation_status(session_id):
+    """
+    预览模式下查询后台生成的进度：generating / ready / failed / cancelled
+    """
+    session = session_manager.get_session(session_id)
+    if not session:
+        return jsonify({'error': '会话不存在'}), 404
+    
+    response = {'session_id': session_id, 'status': session.get('status', 'ready')}
+    if response['status'] == 'ready':
+        response['message'] = session.get('message', '左手伴奏生成成功')
+        response['converted_midi_name'] = f"converted_{session['original_filename']}"
+        response['converted_pdf_name'] = session['original_filename'].replace('.mid', '.pdf')
+        if session.get('stopped_early'):
+            response['stopped_early'] = True
+            response['progress'] = session['progress']
+    elif response['status'] == 'failed':
+        response['error'] = session.get('error')
+    return jsonify(response)
+
+@main.route('/regenerate/<session_id>', methods=['POST'])
+def regenerate(session_id):
+    """
+    只重新生成当前结果中 start_time-end_time（MM:SS）这段时间的左手，其余部分保持不变
+    """
+    session = session_manager.get_session(session_id)
+    if not session:
+        return jsonify({'error': '会话不存在'}), 404
+    pending = generation_pending(session)
+    if pending:
+        return pending
+    
+    try:
+        start_sec = parse_timecode(request.form.get('start_time', ''))
+        end_sec = parse_timecode(request.form.get('end_time', ''))
+    except (ValueError, AttributeError):
+        return jsonify({'error': '时间格式应为 MM:SS'}), 400
+    if end_sec <= start_sec:
+        return jsonify({'error': '结束时间必须大于起始时间'}), 400
+    
+    seed = request.form.get('seed')
+    try:
+        seed = int(seed) if seed not in (None, '') else None
+    except (ValueError, TypeError):
+        return jsonify({'error': 'seed 必须是整数'}), 400
+    
+    # 与 /upload 一样可以用 job_id 取消；把会话标记为 generating，同一会话的重新生成依次进行，
+    # 期间下载 / 查看返回 202（判断和标记在同一个事务里，多个工作进程同时请求时只有一个能成功）
+    job_id = request.form.get('job_id') or str(uuid.uuid4())
+    cancel = jobs.register(job_id)
+    if cancel is None:
+        return duplicate_job_response(job_id)
+    claimed = session_manager.update_session_if(session_id, lambda data: data.get('status') != 'generating',
+                                                status='generating')
+    if claimed is None:
+        jobs.unregister(job_id)
+        return jsonify({'error': '会话不存在'}), 404
+    if claimed is False:
+        jobs.unregister(job_id)
+        return jsonify({'status': 'generating', 'message': '该会话正在生成中，请稍后再试'}), 202
+    request_done = threading.Event()
+    watch_disconnect(request.environ, cancel, request_done)
+    
+    output_midi_path = session['output_midi_path']
+    temp_path = os.path.join(Config.OUTPUT_FOLDER, f"{session_id}_regenerate_{uuid.uuid4().hex}.mid")
+    ticket = None
+    try:
+        # 按区间内的右手长度估计耗时，与 /upload 共用排队和并发上限
+        tokens = range_token_count(output_midi_path, start_sec, end_sec)
+        ticket = generation_scheduler.acquire(generation_scheduler.estimate_cost(tokens, tokens, full_length=True),
+                                              cancel=cancel)
+        if ticket is None:
+            cancel.check()
+            return queue_full_response()
+        result = regenerate_range(output_midi_path, temp_path, start_sec, end_sec, model_name=Config.MODEL_NAME,
+                                  temperature=Config.TEMPERATURE, top_k=Config.SAMPLING_TOP_K,
+                                  top_p=Config.SAMPLING_TOP_P, repetition_penalty=Config.REPETITION_PENALTY,
+                                  seed=seed, context_events=Config.REGENERATE_CONTEXT_EVENTS,
+                                  context_tokens=Config.REGENERATE_CONTEXT_TOKENS,
+                                  window_tokens=Config.WINDOW_TOKENS, cancel=cancel)
+        if not result:
+            return jsonify({'error': '区间重新生成失败'}), 500
+        os.replace(temp_path, output_midi_path)
+        # 旧的乐谱已过期，下次查看时重新渲染
+        pdf_renderer.invalidate(session['output_pdf_path'])
+    except GenerationCancelled:
+        print(f"区间重新生成任务 {job_id} 已取消（{cancel.reason}）")
+        return jsonify({'error': '任务已取消'}), 499
+    finally:
+        if ticket is not None:
+            generation_scheduler.release(ticket)
+        request_done.set()
+        jobs.unregister(job_id)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        session_manager.update_session(session_id, status=session.get('status') or 'ready')
+    
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'message': f"区间 {request.form.get('start_time')}-{request.form.get('end_time')} 的左手已重新生成",
+        'num_events': result['num_events']
+    })
+
+@main.route('/cancel/<job_id>', methods=['POST'])
+def cancel_job(job_id):
+    """
+    取消正在运行（或排队中）的生成任务；正在等待的 /upload 请求会返回 499 并清理已写入的文件
+    """
+    if not jobs.cancel(job_id):
+        # 多进程部署时任务可能在其它工作进程中运行
+        if jobs.relay is not None and jobs.relay(job_id):
+            return jsonify({'success': True, 'message': '已把取消请求转发给其它工作进程'}), 202
+        return jsonify({'error': '任务不存在或已结束'}), 404
+    return jsonify({'success': True, 'message': '已请求取消任务'})
+
+@main.route('/scheduler/status', methods=['GET'])
+def scheduler_status():
+    return jsonify(generation_scheduler.stats())
+
 @main.route('/session/<session_id>', methods=['GET'])
 def get_session(session_id):
     session = session_manager.get_session(session_id)
@@ -326,13 +847,13 @@ def view_pdf(session_id):
     session = session_manager.get_session(session_id)
     if not session:
         return jsonify({'error': '会话不存在'}), 404
+    pending = generation_pending(session) or pdf_pending(session)
+    if pending:
+        return pending
     
     file_path = session['output_pdf_path']
     
-    if not os.path.exists(file_path):
-        return jsonify({'error': 'PDF文件不存在'}), 404
-        
-    return send_file(file_path, mimetype='application/pdf')
+    return send_artifact(file_path, mimetype='application/pdf')
 
 @main.route('/export-original-pdf/<session_id>', methods=['GET'])
 def export_original_pdf(session_id):
@@ -356,8 +877,7 @@ def export_original_pdf(session_id):
     
     if success:
         # 将原始PDF路径添加到会话数据中
-        session['original_pdf_path'] = original_pdf_path
-        session_manager.create_session(session_id, session)
+        session_manager.update_session(session_id, original_pdf_path=original_pdf_path)
         
         return jsonify({
             'success': True,
@@ -387,7 +907,7 @@ def view_original_pdf(session_id):
     if not os.path.exists(file_path):
         return jsonify({'error': '原始MIDI的PDF文件不存在'}), 404
         
-    return send_file(file_path, mimetype='application/pdf')
+    return send_artifact(file_path, mimetype='application/pdf')
 
 @main.route('/download-original-pdf/<session_id>', methods=['GET'])
 def download_original_pdf(session_id):
@@ -407,8 +927,8 @@ def download_original_pdf(session_id):
     if not os.path.exists(file_path):
         return jsonify({'error': '原始MIDI的PDF文件不存在'}), 404
         
-    return send_file(file_path, as_attachment=True, 
-                    download_name=f"original_{session['original_filename'].replace('.mid', '.pdf')}")
+    return send_artifact(file_path, as_attachment=True,
+                         download_name=f"original_{session['original_filename'].replace('.mid', '.pdf')}")
 
 @main.route('/download/original-midi/<session_id>', methods=['GET'])
 def download_original_midi(session_id):
@@ -428,7 +948,7 @@ def download_original_midi(session_id):
     if not os.path.exists(file_path):
         return jsonify({'error': '原始MIDI文件不存在'}), 404
         
-    return send_file(file_path, mimetype='audio/midi')
+    return send_artifact(file_path, immutable=True, mimetype='audio/midi')
 
 @main.route('/upload-with-time-interval', methods=['POST'])
 def upload_with_time_interval():
@@ -469,9 +989,7 @@ def upload_with_time_interval():
             if not transform.split_midi(sliced_path, output_midi_path):
                 return jsonify({'error': 'MIDI处理失败'}), 500
                 
-            # 直接生成PDF
-            if not transform.export_pdf(output_midi_path, output_pdf_path):
-                return jsonify({'error': 'PDF生成失败'}), 500
+            # PDF 在第一次查看 / 下载时由 pdf_renderer 在后台渲染
             
             # 保存会话数据
             session_data = {
@@ -661,6 +661,57 @@ document.addEventListener('DOMContentLoaded', function () {
         });
     }
 
+    // 播放预览（前几小节），同时轮询后台生成状态，完成后再启用转换后文件的播放、下载和查看
+    function playPreviewUntilReady(data) {
+        const sessionId = data.session_id;
+        const pendingButtons = [playConvertedMidiBtn, downloadMidiBtn, viewPdfBtn].filter(btn => btn);
+        pendingButtons.forEach(btn => btn.disabled = true);
+        uploadStatus.textContent = data.message;
+
+        if (checkLibrariesLoaded()) {
+            ensureAudioContext().then(success => {
+                if (!success) return;
+                fetch(data.preview_url)
+                    .then(response => response.blob())
+                    .then(blob => {
+                        midiPlayer.resetPlayStatus();
+                        midiPlayer.loadMidiBlobAndPlay(blob, true);
+                        updateUIForPlayback(true);
+                        midiStatus.textContent = '正在播放预览，完整伴奏生成中...';
+                        midiStatus.className = 'status';
+                    })
+                    .catch(error => {
+                        console.error('获取预览MIDI文件失败:', error);
+                    });
+            });
+        }
+
+        const poll = () => {
+            fetch(`/status/${sessionId}`)
+                .then(response => response.json())
+                .then(status => {
+                    if (status.status === 'generating') {
+                        setTimeout(poll, 1000);
+                    } else if (status.status === 'ready') {
+                        pendingButtons.forEach(btn => btn.disabled = false);
+                        uploadStatus.textContent = status.message;
+                        uploadStatus.className = 'status status-success';
+                        midiStatus.textContent = '完整伴奏已生成，可以播放';
+                        midiStatus.className = 'status status-success';
+                    } else {
+                        uploadStatus.textContent = status.error || '完整伴奏生成失败';
+                        uploadStatus.className = 'status status-error';
+                        uploadBtn.disabled = false;
+                    }
+                })
+                .catch(error => {
+                    console.error('查询生成状态失败:', error);
+                    setTimeout(poll, 3000);
+                });
+        };
+        setTimeout(poll, 1000);
+    }
+
     // 播放转换后的MIDI文件
     if (playConvertedMidiBtn) {
         playConvertedMidiBtn.addEventListener('click', () => {
@@ -936,6 +987,8 @@ document.addEventListener('DOMContentLoaded', function () {
         formData.append('file', rightHandFile);
         formData.append('left_hand_file', leftHandFile);
         formData.append('target_len', targetLen);
+        // 预览模式：先返回前几小节，完整伴奏在后台继续生成
+        formData.append('preview', '1');
 
         uploadBtn.disabled = true;
         uploadProgress.style.width = '0%';
@@ -987,6 +1040,9 @@ document.addEventListener('DOMContentLoaded', function () {
                     if (downloadMidiBtn) downloadMidiBtn.onclick = () => downloadFile('midi', data.session_id);
                     if (viewPdfBtn) viewPdfBtn.onclick = () => viewPdf(data.session_id);
 
+                    // 完整伴奏还在后台生成时先播放预览
+                    if (data.preview) playPreviewUntilReady(data);
+
                     // 显示和启用原始PDF按钮
                     if (viewOriginalPdfBtn) {
                         viewOriginalPdfBtn.style.display = 'inline-block';
@@ -1462,6 +1518,8 @@ document.addEventListener('DOMContentLoaded', function () {
         const targetLenInput = document.getElementById('target-len');
         const targetLen = targetLenInput ? targetLenInput.value : '800';
         formData.append('target_len', targetLen);
+        // 预览模式：先返回前几小节，完整伴奏在后台继续生成
+        formData.append('preview', '1');
 
         uploadBtn.disabled = true;
         uploadProgress.style.width = '0%';
@@ -1513,6 +1571,9 @@ document.addEventListener('DOMContentLoaded', function () {
                     if (downloadMidiBtn) downloadMidiBtn.onclick = () => downloadFile('midi', data.session_id);
                     if (viewPdfBtn) viewPdfBtn.onclick = () => viewPdf(data.session_id);
 
+                    // 完整伴奏还在后台生成时先播放预览
+                    if (data.preview) playPreviewUntilReady(data);
+
                     // 显示和启用原始PDF按钮
                     if (viewOriginalPdfBtn) {
                         viewOriginalPdfBtn.style.display = 'inline-block';
@@ -1565,6 +1626,8 @@ document.addEventListener('DOMContentLoaded', function () {
         const targetLenInput = document.getElementById('target-len');
         const targetLen = targetLenInput ? targetLenInput.value : '800';
         formData.append('target_len', targetLen);
+        // 预览模式：先返回前几小节，完整伴奏在后台继续生成
+        formData.append('preview', '1');
 
         uploadBtn.disabled = true;
         uploadProgress.style.width = '0%';
@@ -1616,6 +1679,9 @@ document.addEventListener('DOMContentLoaded', function () {
                     if (downloadMidiBtn) downloadMidiBtn.onclick = () => downloadFile('midi', data.session_id);
                     if (viewPdfBtn) viewPdfBtn.onclick = () => viewPdf(data.session_id);
 
+                    // 完整伴奏还在后台生成时先播放预览
+                    if (data.preview) playPreviewUntilReady(data);
+
                     // 显示和启用原始PDF按钮
                     if (viewOriginalPdfBtn) {
                         viewOriginalPdfBtn.style.display = 'inline-block';
@@ -1755,7 +1821,17 @@ document.addEventListener('DOMContentLoaded', function () {
 
     // 修改viewPdf函数，在PDF查看器中加载转换后的PDF
     function viewPdf(sessionId) {
-        loadPdfToViewer(`/view-pdf/${sessionId}`);
+        showPdfLoadingIndicator();
+        waitForPdf(sessionId)
+            .then(() => {
+                hidePdfLoadingIndicator();
+                loadPdfToViewer(`/view-pdf/${sessionId}`);
+            })
+            .catch(error => {
+                hidePdfLoadingIndicator();
+                console.error('PDF生成失败:', error);
+                alert(error.message);
+            });
     }
 
     // 在PDF查看器中加载原始MIDI的PDF
@@ -2171,9 +2247,31 @@ document.addEventListener('DOMContentLoaded', () => {
     // 已移除打开编辑器按钮的相关代码
 });
 
+// 转换后的乐谱在第一次请求时才在后台渲染，渲染完成前服务器返回 202，这里轮询直到就绪
+function waitForPdf(sessionId, interval = 1000) {
+    return fetch(`/convert-to-pdf/${sessionId}`).then(response => {
+        if (response.status === 202) {
+            return new Promise(resolve => setTimeout(resolve, interval))
+                .then(() => waitForPdf(sessionId, interval));
+        }
+        return response.json().then(data => {
+            if (!response.ok) {
+                throw new Error(data.error || 'PDF生成失败');
+            }
+            return data;
+        });
+    });
+}
+
 // 修改全局函数，添加Global前缀避免与局部函数冲突
 function downloadFile(type, sessionId) {
-    window.open(`/download/${type}/${sessionId}`, '_blank');
+    if (type !== 'pdf') {
+        window.open(`/download/${type}/${sessionId}`, '_blank');
+        return;
+    }
+    waitForPdf(sessionId)
+        .then(() => { window.location.href = `/download/pdf/${sessionId}`; })
+        .catch(error => alert(error.message));
 }
 
 function viewPdfGlobal(sessionId) {
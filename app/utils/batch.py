@@ -0,0 +1,235 @@
+import os
+import json
+import posixpath
+import time
+import shutil
+import zipfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+try:
+    from .infer import infer_batch
+    from .scheduler import generation_scheduler
+    from .transform import export_pdf
+    from .cancellation import GenerationCancelled
+    from .utils import load_midi, midi_to_event
+    from ..config.config import Config
+except ImportError:
+    from infer import infer_batch
+    from scheduler import generation_scheduler
+    from transform import export_pdf
+    from cancellation import GenerationCancelled
+    from utils import load_midi, midi_to_event
+    from ..config.config import Config
+
+# ========== 批量生成 ==========
+'''
+/batch 一次接收很多首右手（一个 zip，或选择整个目录上传的多个文件），共用同一组生成参数：
+    - 按右手长度排序后每 BATCH_DECODE_SIZE 首拼成一个 batch，由 infer_batch 在同一个解码循环里同时生成
+    - 最多 BATCH_CONCURRENCY 个 batch 同时进行，每个 batch 作为一个任务经过 generation_scheduler 排队，
+      与 /upload 的请求共享并发上限
+    - 结果以 zip 流式返回：每完成一个 batch 就把其中的 MIDI（和可选的 PDF）写入响应，
+      最后写入 manifest.json，记录每个文件的状态
+'''
+
+MIDI_EXTENSIONS = ('.mid', '.midi')
+
+
+class ZipStream:
+    """zipfile 的输出目标：不可 seek，写入的数据暂存，由响应生成器用 take() 取走"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def is_midi_name(name):
+    base = os.path.basename(name)
+    return base.lower().endswith(MIDI_EXTENSIONS) and not base.startswith('.')
+
+
+def read_zip_entries(stream, max_files, max_bytes):
+    """
+    读出 zip 中的所有 MIDI 文件，返回 [(zip 内路径, bytes)]
+    文件数超过 max_files 或解压后总大小超过 max_bytes 时抛出 ValueError
+    """
+    entries, total = [], 0
+    try:
+        with zipfile.ZipFile(stream) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or info.filename.startswith('__MACOSX/') or not is_midi_name(info.filename):
+                    continue
+                total += info.file_size
+                if total > max_bytes:
+                    raise ValueError(f'解压后的文件总大小超过 {max_bytes // 1024 ** 2} MB')
+                if len(entries) >= max_files:
+                    raise ValueError(f'一次最多处理 {max_files} 个文件')
+                entries.append((info.filename, archive.read(info)))
+    except zipfile.BadZipFile:
+        raise ValueError('上传的文件不是有效的 zip')
+    return entries
+
+
+def output_names(entries):
+    """每个输入对应的 (输出 MIDI 名, 输出 PDF 名)，保留 zip 内的目录结构，同名时加序号"""
+    names, used = [], set()
+    for name, _ in entries:
+        folder, base = posixpath.split(name.replace('\\', '/'))
+        stem = os.path.splitext(base)[0]
+        midi_name = f"converted_{stem}.mid"
+        suffix = 1
+        while posixpath.join(folder, midi_name) in used:
+            midi_name = f"converted_{stem}_{suffix}.mid"
+            suffix += 1
+        used.add(posixpath.join(folder, midi_name))
+        pdf_name = midi_name[len('converted_'):-len('.mid')] + '.pdf'
+        names.append((posixpath.join(folder, midi_name), posixpath.join(folder, pdf_name)))
+    return names
+
+
+def token_count(data):
+    try:
+        midi_file = load_midi(data)
+        return len(midi_to_event(midi_file.tracks[0])) if midi_file.tracks else 0
+    except Exception:
+        return 0
+
+
+def plan_chunks(counts, size):
+    """按右手长度排序后每 size 首一组，同一组内补 pad 的浪费最少；返回下标列表的列表"""
+    order = sorted(range(len(counts)), key=lambda i: counts[i])
+    return [order[i:i + size] for i in range(0, len(order), size)]
+
+
+class BatchJob:
+    def __init__(self, entries, options, cancel, with_pdf=False):
+        """
+        参数:
+            entries (list): [(名称, MIDI 文件内容)]
+            options (dict): target_len、seed、full_length
+            cancel (CancellationToken): 取消整个批量任务
+            with_pdf (bool): 同时用 MuseScore 导出每首的乐谱
+        """
+        self.entries = entries
+        self.options = options
+        self.cancel = cancel
+        self.with_pdf = with_pdf
+        self.names = output_names(entries)
+        self.counts = [token_count(data) for _, data in entries]
+
+    def _acquire(self, cost):
+        # 排队已满时等一会再试，批量任务不因为繁忙而失败
+        while True:
+            ticket = generation_scheduler.acquire(cost, cancel=self.cancel)
+            if ticket is not None:
+                return ticket
+            self.cancel.check()
+            self.cancel.wait(generation_scheduler.retry_after())
+
+    def _run_chunk(self, chunk, workdir):
+        """生成一组，返回 [(下标, 结果或 False, PDF bytes 或 None)]"""
+        cost = generation_scheduler.estimate_cost(max(self.counts[i] for i in chunk), self.options['target_len'],
+                                                  full_length=self.options['full_length'])
+        ticket = self._acquire(cost)
+        try:
+            results = infer_batch([self.entries[i][1] for i in chunk], model_name=Config.MODEL_NAME,
+                                  temperature=Config.TEMPERATURE, target_len=self.options['target_len'],
+                                  top_k=Config.SAMPLING_TOP_K, top_p=Config.SAMPLING_TOP_P,
+                                  repetition_penalty=Config.REPETITION_PENALTY, seed=self.options['seed'],
+                                  full_length=self.options['full_length'], window_tokens=Config.WINDOW_TOKENS,
+                                  window_overlap=Config.WINDOW_OVERLAP_TOKENS, cancel=self.cancel)
+        finally:
+            generation_scheduler.release(ticket)
+        pdfs = [None] * len(chunk)
+        if self.with_pdf:
+            # 一组的乐谱同时提交，由 musescore_batcher 合并成一次 MuseScore 调用
+            rendered = [(k, i, result) for k, (i, result) in enumerate(zip(chunk, results)) if result]
+            with ThreadPoolExecutor(max_workers=max(1, len(rendered))) as pool:
+                for (k, _, _), pdf in zip(rendered, pool.map(lambda item: self._render_pdf(item[1], item[2], workdir),
+                                                                rendered)):
+                    pdfs[k] = pdf
+        return list(zip(chunk, results, pdfs))
+
+    def _render_pdf(self, index, result, workdir):
+        """MuseScore 只能读写文件：写出临时 MIDI，导出 PDF 后读回；失败返回 None"""
+        midi_path = os.path.join(workdir, f"{index}.mid")
+        pdf_path = os.path.join(workdir, f"{index}.pdf")
+        with open(midi_path, 'wb') as f:
+            f.write(result['midi_bytes'])
+        if not export_pdf(midi_path, pdf_path, cancel=self.cancel):
+            return None
+        with open(pdf_path, 'rb') as f:
+            return f.read()
+
+    def stream(self):
+        """生成器：逐块产出结果 zip 的字节，每完成一组写入一次，最后写入 manifest.json"""
+        started = time.monotonic()
+        buffer = ZipStream()
+        manifest = [None] * len(self.entries)
+        workdir = tempfile.mkdtemp(prefix='batch_') if self.with_pdf else None
+        executor = ThreadPoolExecutor(max_workers=Config.BATCH_CONCURRENCY, thread_name_prefix='batch')
+        try:
+            with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+                chunks = plan_chunks(self.counts, Config.BATCH_DECODE_SIZE)
+                futures = {executor.submit(self._run_chunk, chunk, workdir): chunk for chunk in chunks}
+                try:
+                    yield from self._collect(futures, archive, buffer, manifest)
+                except GenerationCancelled:
+                    # 通过 /cancel 取消时仍写完 manifest，未完成的文件标记为 cancelled
+                    print(f"批量生成已取消（{self.cancel.reason}）")
+                for i, item in enumerate(manifest):
+                    if item is None:
+                        manifest[i] = {'name': self.entries[i][0], 'status': 'cancelled'}
+                succeeded = sum(1 for item in manifest if item['status'] == 'ok')
+                summary = {'total': len(manifest), 'succeeded': succeeded, 'failed': len(manifest) - succeeded,
+                           'elapsed': time.monotonic() - started, 'files': manifest}
+                archive.writestr('manifest.json', json.dumps(summary, ensure_ascii=False, indent=2))
+                print(f"批量生成完成：{succeeded}/{len(manifest)} 首，耗时 {summary['elapsed']:.1f}s")
+            yield buffer.take()
+        finally:
+            # 客户端中途断开时响应生成器被关闭，取消还没完成的组
+            self.cancel.cancel('batch closed')
+            executor.shutdown(wait=False, cancel_futures=True)
+            if workdir is not None:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    def _collect(self, futures, archive, buffer, manifest):
+        """按完成顺序把各组的结果写入 zip，每组完成后产出一次已写入的字节"""
+        for future in as_completed(futures):
+            try:
+                done = future.result()
+            except GenerationCancelled:
+                raise
+            except Exception as e:
+                print(f"批量生成出错: {str(e)}")
+                done = [(i, False, None) for i in futures[future]]
+                for i, _, _ in done:
+                    manifest[i] = {'name': self.entries[i][0], 'status': 'failed', 'error': str(e)}
+            for i, result, pdf in done:
+                midi_name, pdf_name = self.names[i]
+                if manifest[i] is not None:
+                    continue
+                if not result:
+                    manifest[i] = {'name': self.entries[i][0], 'status': 'failed',
+                                   'error': 'MIDI处理失败，可能是文件格式不正确'}
+                    continue
+                archive.writestr(midi_name, result['midi_bytes'])
+                item = {'name': self.entries[i][0], 'status': 'ok', 'midi': midi_name,
+                        'num_tokens': result['num_tokens']}
+                if pdf is not None:
+                    archive.writestr(pdf_name, pdf)
+                    item['pdf'] = pdf_name
+                elif self.with_pdf:
+                    item['pdf_error'] = 'PDF生成失败'
+                manifest[i] = item
+            yield buffer.take()
@@ -0,0 +1,116 @@
+import select
+import socket
+import threading
+
+# ========== 任务取消 ==========
+'''
+每个 /upload 任务持有一个 CancellationToken：
+    - 解码循环每一步、推测解码每一轮、流水线各阶段之间检查 token，已取消时抛出 GenerationCancelled
+    - MuseScore 导出时轮询子进程，已取消时直接结束子进程
+token 在两种情况下被触发：客户端断开连接（watch_disconnect 在后台线程里检测请求的 socket），
+或调用 /cancel/<job_id>。
+'''
+
+class GenerationCancelled(Exception):
+    pass
+
+
+class CancellationToken:
+    def __init__(self):
+        self._event = threading.Event()
+        self.reason = None
+
+    def cancel(self, reason='cancelled'):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def check(self):
+        if self._event.is_set():
+            raise GenerationCancelled(self.reason)
+
+    def wait(self, timeout):
+        return self._event.wait(timeout)
+
+
+class JobRegistry:
+    """job_id -> CancellationToken，供取消接口查找正在运行的任务"""
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+        # 多进程部署（serve.py）时设置：本进程中找不到任务时，把取消请求转发给其它工作进程
+        self.relay = None
+
+    def register(self, job_id):
+        """
+        登记任务并返回它的 token；job_id 已被本进程中正在运行的任务使用时返回 None（由路由返回 409），
+        否则后登记的任务会顶掉前一个，/cancel 再也找不到前一个任务
+        """
+        with self._lock:
+            if job_id in self._jobs:
+                return None
+            token = CancellationToken()
+            self._jobs[job_id] = token
+        return token
+
+    def unregister(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def cancel(self, job_id, reason='cancelled'):
+        with self._lock:
+            token = self._jobs.get(job_id)
+        if token is None:
+            return False
+        token.cancel(reason)
+        return True
+
+    def count(self):
+        with self._lock:
+            return len(self._jobs)
+
+
+def _request_socket(environ):
+    # werkzeug 开发服务器和 gunicorn 都会把连接的 socket 放进 environ
+    for key in ('werkzeug.socket', 'gunicorn.socket'):
+        sock = environ.get(key)
+        if isinstance(sock, socket.socket):
+            return sock
+    return None
+
+
+def watch_disconnect(environ, token, done, interval=0.01):
+    """
+    在后台线程中检测客户端是否断开，断开时取消 token；done (threading.Event) 被设置后退出。
+    请求体读完之后 socket 变为可读且 peek 不到数据，说明对端已关闭连接。
+    拿不到 socket（其它 WSGI 服务器）时不做检测，只能通过取消接口取消。
+    """
+    sock = _request_socket(environ)
+    if sock is None:
+        return None
+
+    def run():
+        while not done.wait(interval):
+            try:
+                readable, _, _ = select.select([sock], [], [], 0)
+                if readable and sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b'':
+                    print("客户端已断开连接，取消任务")
+                    token.cancel('client disconnected')
+                    return
+            except BlockingIOError:
+                continue
+            except (OSError, ValueError):
+                token.cancel('client disconnected')
+                return
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+jobs = JobRegistry()
@@ -0,0 +1,93 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+# ========== 编码器输出缓存 ==========
+'''
+同一首右手换 temperature / target_len / 左手前缀重新生成时，编码器的输出完全相同。
+这里按 "模型标识 + 右手 token 内容" 的哈希缓存编码器输出 memory 以及每个 decoder 层预计算的
+cross-attention K/V，命中时直接进入解码。按张量占用的字节数做 LRU 淘汰。
+'''
+
+def _tensor_bytes(tensor):
+    return tensor.numel() * tensor.element_size()
+
+
+class EncoderCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> entry，越靠后越新
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model_id, src):
+        """src: (1, S) 的右手 token 张量"""
+        h = hashlib.sha1(str(model_id).encode('utf-8'))
+        h.update(src.detach().cpu().numpy().tobytes())
+        return h.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, memory, cross_kv):
+        nbytes = _tensor_bytes(memory) + sum(_tensor_bytes(k) + _tensor_bytes(v) for k, v in cross_kv)
+        return self._insert(key, {'memory': memory, 'cross_kv': cross_kv, 'nbytes': nbytes})
+
+    def _insert(self, key, entry):
+        nbytes = entry['nbytes']
+        if nbytes > self.max_bytes:
+            return entry  # 单条就超过预算，不缓存
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old['nbytes']
+            self._entries[key] = entry
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted['nbytes']
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+class DecoderStateCache(EncoderCache):
+    '''
+    局部重新生成时，同一段左手前缀会被反复送入 decoder。这里缓存前缀送入后各层的 self-attn K/V
+    以及最后一个位置的 logits，键由模型标识、右手 token 和前缀共同决定。
+    decode 追加 K/V 时用 torch.cat 生成新张量，缓存中的张量不会被修改，取出时浅拷贝每层的 dict 即可。
+    '''
+
+    @staticmethod
+    def make_key(model_id, src, prefix=()):
+        return EncoderCache.make_key(f"{model_id}|{','.join(map(str, prefix))}", src)
+
+    def get(self, key):
+        entry = super().get(key)
+        if entry is None:
+            return None
+        return {'cache': [dict(layer) for layer in entry['cache']], 'logits': entry['logits']}
+
+    def put(self, key, cache, logits):
+        # cross-attention K/V 与编码器缓存共用，不计入字节数
+        nbytes = _tensor_bytes(logits) + sum(_tensor_bytes(layer['k']) + _tensor_bytes(layer['v'])
+                                             for layer in cache if 'k' in layer)
+        return self._insert(key, {'cache': [dict(layer) for layer in cache], 'logits': logits, 'nbytes': nbytes})
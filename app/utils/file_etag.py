@@ -0,0 +1,53 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from app.config.config import Config
+
+# ========== 文件内容哈希（强 ETag） ==========
+'''
+下载 / 查看接口用文件内容的 sha256 作为强 ETag。每次都重新读文件算哈希就失去了 304 的意义，
+这里按 (路径, mtime_ns, 大小, inode) 缓存哈希：文件没变时只需要一次 stat；
+区间重新生成、PDF 重新渲染会替换文件（inode / mtime 改变），下次请求时重新计算。
+缓存按最近使用淘汰，最多 ETAG_CACHE_ENTRIES 个文件；每个工作进程各有一份。
+'''
+
+class ContentHashCache:
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # path -> ((mtime_ns, size, inode), 哈希)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(path):
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def etag(self, path):
+        """返回文件内容的 sha256（十六进制）；文件不存在时返回 None"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        version = (st.st_mtime_ns, st.st_size, st.st_ino)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(path)
+                return entry[1]
+        try:
+            digest = self._digest(path)
+        except OSError:
+            return None
+        with self._lock:
+            self._entries[path] = (version, digest)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return digest
+
+
+content_hashes = ContentHashCache(Config.ETAG_CACHE_ENTRIES)
@@ -0,0 +1,134 @@
+import torch
+try:
+    from .utils import build_vocab
+except ImportError:
+    from utils import build_vocab
+
+# ========== 语法约束采样 ==========
+'''
+midi_to_event 产生的事件序列满足固定语法：
+    bos → shift_time → (note_on | note_off) → shift_time → (note_on | note_off) → ... → eos
+即 shift_time 与音符事件严格交替。模型偶尔会采样出违反语法的 token（连续两个 shift_time、
+松开一个没按下的音、序列中间出现 bos/pad），event_to_midi 会把它们丢掉或产生不松开的长音。
+
+GrammarConstraint 为每条序列维护很小的状态：上一个 token 是否为 shift_time、当前按住的音（128 维 bool），
+在采样前把不合法的 token 的 logits 置为 -inf。所有掩码预先算好放在设备上，状态更新全部是向量化操作，
+支持 batch，不需要和主机同步。
+'''
+
+class GrammarState:
+    def __init__(self, after_shift, held):
+        self.after_shift = after_shift  # (B,) bool，上一个 token 是 shift_time
+        self.held = held                # (B, 128) bool，当前按住的音
+
+    def clone(self):
+        return GrammarState(self.after_shift.clone(), self.held.clone())
+
+
+class GrammarConstraint:
+    def __init__(self, device, vocab_size=410):
+        my_dict, _ = build_vocab()
+        self.eos_id = my_dict[("eos", 0)]
+        self.shift_lo = my_dict[("shift_time", 0)]
+        self.note_on_lo = my_dict[("note_on", 0)]
+        self.note_off_lo = my_dict[("note_off", 0)]
+        self.shift_hi = self.note_on_lo  # shift_time 的 id 区间为 [shift_lo, shift_hi)
+        self.device = device
+
+        # 预计算的两类掩码：shift_time 之后只能是音符事件；音符事件（或序列开头）之后只能是 shift_time 或 eos
+        self.after_shift_mask = torch.zeros(vocab_size, dtype=torch.bool, device=device)
+        self.after_shift_mask[self.note_on_lo:self.note_off_lo + 128] = True
+        self.after_event_mask = torch.zeros(vocab_size, dtype=torch.bool, device=device)
+        self.after_event_mask[self.shift_lo:self.shift_hi] = True
+        self.after_event_mask[self.eos_id] = True
+
+    def init_state(self, batch_size=1):
+        return GrammarState(torch.zeros(batch_size, dtype=torch.bool, device=self.device),
+                            torch.zeros(batch_size, 128, dtype=torch.bool, device=self.device))
+
+    def update(self, state, tokens):
+        """tokens: (B,) 本步采样出的 token，原地更新 state"""
+        is_shift = (tokens >= self.shift_lo) & (tokens < self.shift_hi)
+        is_on = (tokens >= self.note_on_lo) & (tokens < self.note_on_lo + 128)
+        is_off = (tokens >= self.note_off_lo) & (tokens < self.note_off_lo + 128)
+        note = torch.where(is_on, tokens - self.note_on_lo, tokens - self.note_off_lo).clamp(0, 127).unsqueeze(1)
+        current = state.held.gather(1, note)
+        new = torch.where(is_on.unsqueeze(1), torch.ones_like(current),
+                          torch.where(is_off.unsqueeze(1), torch.zeros_like(current), current))
+        state.held.scatter_(1, note, new)
+        state.after_shift = is_shift
+        return state
+
+    def feed(self, state, tokens):
+        """把已有前缀（如 left_prefix）逐个送入状态；前缀本身不合法时只做容错更新"""
+        for token in tokens:
+            self.update(state, torch.full_like(state.after_shift, token, dtype=torch.long))
+        return state
+
+    def allowed(self, state):
+        """返回 (B, vocab) bool，True 表示该 token 在当前状态下合法"""
+        allowed = torch.where(state.after_shift.unsqueeze(1), self.after_shift_mask, self.after_event_mask)
+        allowed[:, self.note_on_lo:self.note_on_lo + 128] &= ~state.held
+        allowed[:, self.note_off_lo:self.note_off_lo + 128] &= state.held
+        # 还有音按住时不允许结束，避免产生不松开的长音
+        allowed[:, self.eos_id] &= ~state.held.any(dim=1)
+        return allowed
+
+    def apply(self, logits, state):
+        """logits: (B, vocab) 或 (vocab,)（batch 为 1 时）"""
+        allowed = self.allowed(state)
+        if logits.dim() == 1:
+            allowed = allowed[0]
+        return logits.masked_fill(~allowed, float('-inf'))
+
+    def resting(self, state, tokens):
+        """(B,) bool：本步 token 是 note_off 且之后没有音按住，是可以干净结束的位置（state 需已用 tokens 更新）"""
+        is_off = (tokens >= self.note_off_lo) & (tokens < self.note_off_lo + 128)
+        return is_off & ~state.held.any(dim=1)
+
+    def closing_len(self, state):
+        """(B,) closing_tokens 会补上的 token 数：每个按住的音一个 note_off，前面不是 shift_time 时再加一个 shift_time 0"""
+        held = state.held.sum(dim=1)
+        return torch.where(held > 0, 2 * held - state.after_shift.long(), torch.zeros_like(held))
+
+    def fit_len(self, tokens, limit):
+        """
+        tokens 最长能保留多少个，使保留部分的长度加上收尾补的 note_off（closing_len）不超过 limit。
+        在 Python 里逐 token 跟踪按住的音，只需一遍，不经过张量运算
+        """
+        held, after_shift, best = set(), False, 0
+        for i in range(min(len(tokens), limit) + 1):
+            closing = 2 * len(held) - after_shift if held else 0
+            if i + closing <= limit:
+                best = i
+            if i == len(tokens):
+                break
+            token = tokens[i]
+            if self.note_on_lo <= token < self.note_on_lo + 128:
+                held.add(token - self.note_on_lo)
+            elif self.note_off_lo <= token < self.note_off_lo + 128:
+                held.discard(token - self.note_off_lo)
+            after_shift = self.shift_lo <= token < self.shift_hi
+        return best
+
+    def closing_tokens(self, state, index=0):
+        """生成被 target_len 截断时，给仍按住的音补上 note_off，保证输出合法"""
+        tokens = []
+        after_shift = bool(state.after_shift[index])
+        for note in torch.nonzero(state.held[index]).flatten().tolist():
+            if not after_shift:
+                tokens.append(self.shift_lo)  # shift_time 0
+            tokens.append(self.note_off_lo + note)
+            after_shift = False
+        return tokens
+
+
+def make_tracker(grammar, deadline, device):
+    """
+    解码循环用来跟踪按住的音的对象：有语法约束时就是 grammar；没有约束但带截止时间时新建一个，
+    只用于跟踪（收尾阶段判断可以干净结束的位置、结束时补 note_off），不参与掩码；两者都没有时返回 None。
+    sample_generate_batch 和 speculative_generate 用同一规则，同样的 time_budget 请求收尾方式一致
+    """
+    if grammar is not None or deadline is None:
+        return grammar
+    return GrammarConstraint(device)
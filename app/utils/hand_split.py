@@ -0,0 +1,174 @@
+import io
+import mido
+
+# ========== 左右手拆分（纯 Python，内存中完成） ==========
+'''
+拖入的 MIDI 原来要经过 MuseScore 导入再导出一遍才会拆成右手 / 左手两条音轨，这里直接在内存中拆分：
+    - 已经分好两条音轨的文件：沿用 music_transformer/判断音轨数及左右手.py 中 judge_hand_bynote 的办法，
+      按音高相对中央 E（64）的平均偏移判断哪条是左手
+    - 其它情况（单音轨、多声部混在一起）：把所有音符按时间合并后逐个分配：
+        * 同时按下的和弦跨度超过 chord_span 时，在相邻音高间隔最大的地方分开，低的归左手、高的归右手
+        * 否则整组归到音高中心更近的那只手；两只手的音高中心随分配结果滑动更新（声部跟踪），分界点随之移动
+        * 一只手当前按住的音加上新音会超过 hand_span 时改给另一只手
+      note_off 跟随对应的 note_on 所在的手
+输出的第一条音轨是右手（含所有 meta 消息和控制器消息），第二条是左手，与 infer 读取右手的约定一致。
+'''
+
+MIDDLE = 64
+
+
+def judge_hand_bynote(track):
+    """与 music_transformer 中的同名函数相同：返回 (相对 64 的音高偏移之和, 是否左手)"""
+    average_note = 0
+    for msg in track:
+        if msg.type in ['note_on', 'note_off']:
+            average_note += msg.note - MIDDLE
+    return average_note, average_note < 0
+
+
+def _absolute_messages(tracks):
+    """所有音轨的消息按绝对 tick 合并，同一时刻保持原来的先后顺序"""
+    merged = []
+    for index, track in enumerate(tracks):
+        ticks = 0
+        for order, msg in enumerate(track):
+            ticks += msg.time
+            if msg.type != 'end_of_track':
+                merged.append((ticks, index, order, msg))
+    merged.sort(key=lambda item: (item[0], item[1], item[2]))
+    return [(ticks, msg) for ticks, _, _, msg in merged]
+
+
+def _to_track(timed_messages):
+    track = mido.MidiTrack()
+    last = 0
+    for ticks, msg in timed_messages:
+        track.append(msg.copy(time=ticks - last))
+        last = ticks
+    track.append(mido.MetaMessage('end_of_track', time=0))
+    return track
+
+
+def _is_note_on(msg):
+    return msg.type == 'note_on' and msg.velocity > 0
+
+
+def _is_note_off(msg):
+    return msg.type == 'note_off' or (msg.type == 'note_on' and msg.velocity == 0)
+
+
+class _HandTracker:
+    def __init__(self, chord_span=12, hand_span=14, smoothing=0.2):
+        self.chord_span = chord_span
+        self.hand_span = hand_span
+        self.smoothing = smoothing
+        self.centers = {'right': MIDDLE + 8, 'left': MIDDLE - 12}
+        self.held = {'right': set(), 'left': set()}
+
+    def _update(self, hand, pitch):
+        self.centers[hand] += self.smoothing * (pitch - self.centers[hand])
+        # 两只手的中心至少相隔 5 个半音，避免分界点塌缩到一边
+        if self.centers['right'] - self.centers['left'] < 5:
+            middle = (self.centers['right'] + self.centers['left']) / 2
+            self.centers['right'], self.centers['left'] = middle + 2.5, middle - 2.5
+
+    def _fits(self, hand, pitches):
+        notes = self.held[hand] | set(pitches)
+        return max(notes) - min(notes) <= self.hand_span
+
+    def assign(self, pitches):
+        """给同一时刻按下的一组音分配手，返回 {音高: 'right' / 'left'}"""
+        pitches = sorted(set(pitches))
+        if pitches[-1] - pitches[0] > self.chord_span:
+            gaps = [pitches[i + 1] - pitches[i] for i in range(len(pitches) - 1)]
+            cut = gaps.index(max(gaps)) + 1
+            groups = [('left', pitches[:cut]), ('right', pitches[cut:])]
+        else:
+            mean = sum(pitches) / len(pitches)
+            hand = 'right' if abs(mean - self.centers['right']) <= abs(mean - self.centers['left']) else 'left'
+            other = 'left' if hand == 'right' else 'right'
+            if not self._fits(hand, pitches) and self._fits(other, pitches):
+                hand = other
+            groups = [(hand, pitches)]
+        assignment = {}
+        for hand, group in groups:
+            for pitch in group:
+                assignment[pitch] = hand
+                self.held[hand].add(pitch)
+            self._update(hand, sum(group) / len(group))
+        return assignment
+
+    def release(self, hand, pitch):
+        self.held[hand].discard(pitch)
+
+
+def split_hands(midi_file, chord_span=12, hand_span=14):
+    """
+    把 mido.MidiFile 拆成 [右手, 左手] 两条音轨，返回新的 MidiFile
+
+    参数:
+        chord_span (int): 同时按下的音跨度超过该值（半音）时拆给两只手
+        hand_span (int): 一只手同时按住的音的最大跨度（半音）
+    """
+    note_tracks = [track for track in midi_file.tracks if any(_is_note_on(msg) for msg in track)]
+    timed = _absolute_messages(midi_file.tracks)
+    right, left = [], []
+
+    if len(note_tracks) == 2:
+        hands = [judge_hand_bynote(track)[1] for track in note_tracks]
+        if hands[0] != hands[1]:
+            left_track = note_tracks[hands.index(True)]
+            right_track = note_tracks[hands.index(False)]
+            left = [(ticks, msg) for ticks, msg in _absolute_messages([left_track]) if not msg.is_meta]
+            others = [track for track in midi_file.tracks if track is not left_track]
+            right = [(ticks, msg) for ticks, msg in _absolute_messages(others)]
+            return _build(midi_file, right, left)
+
+    tracker = _HandTracker(chord_span=chord_span, hand_span=hand_span)
+    # (channel, note) -> 按下顺序的手，同一个音重复按下时 note_off 依次对应
+    sounding = {}
+    i = 0
+    while i < len(timed):
+        ticks, msg = timed[i]
+        if _is_note_on(msg):
+            # 同一时刻按下的音一起分配
+            j = i
+            while j < len(timed) and timed[j][0] == ticks and (_is_note_on(timed[j][1]) or timed[j][1].is_meta):
+                j += 1
+            group = [(t, m) for t, m in timed[i:j] if _is_note_on(m)]
+            assignment = tracker.assign([m.note for _, m in group])
+            for t, m in timed[i:j]:
+                if m.is_meta:
+                    right.append((t, m))
+                    continue
+                hand = assignment[m.note]
+                sounding.setdefault((m.channel, m.note), []).append(hand)
+                (right if hand == 'right' else left).append((t, m))
+            i = j
+            continue
+        if _is_note_off(msg):
+            hands = sounding.get((msg.channel, msg.note))
+            if hands:
+                hand = hands.pop(0)
+                tracker.release(hand, msg.note)
+                (right if hand == 'right' else left).append((ticks, msg))
+        else:
+            # meta、踏板等控制器消息放在右手音轨
+            right.append((ticks, msg))
+        i += 1
+    return _build(midi_file, right, left)
+
+
+def _build(midi_file, right, left):
+    output = mido.MidiFile(type=1, ticks_per_beat=midi_file.ticks_per_beat)
+    output.tracks.append(_to_track(right))
+    output.tracks.append(_to_track(left))
+    return output
+
+
+def split_hands_bytes(data, **kwargs):
+    """MIDI 文件内容（bytes）→ 拆分后的 MIDI 文件内容，全程在内存中完成"""
+    midi_file = mido.MidiFile(file=io.BytesIO(data))
+    buffer = io.BytesIO()
+    split_hands(midi_file, **kwargs).save(file=buffer)
+    return buffer.getvalue()
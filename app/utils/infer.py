@@ -4,56 +4,453 @@ import mido
 try:
     # 当作为模块导入时使用相对导入
     from .music_transformer import Seq2SeqTransformer
-    from .utils import midi_to_event, event_to_midi ,event_to_num, num_to_event, build_vocab
+    from .speculative import speculative_generate
+    from .sectional import sectional_generate
+    from .grammar import GrammarConstraint, make_tracker
+    from .sampling import Sampler
+    from .encoder_cache import EncoderCache, DecoderStateCache
+    from .throughput import throughput
+    from .cancellation import GenerationCancelled
+    from .utils import midi_to_event, event_to_midi ,event_to_num, num_to_event, build_vocab, onset_alignment
+    from .utils import load_midi, midi_to_bytes
+    from .utils import events_to_timeline, timeline_to_events, event_windows, close_timeline, seconds_to_units, track_to_timeline, held_notes
     from ..config.config import Config
 except ImportError:
     # 当直接运行时使用直接导入
     from music_transformer import Seq2SeqTransformer
-    from utils import midi_to_event, event_to_midi ,event_to_num, num_to_event, build_vocab
+    from speculative import speculative_generate
+    from sectional import sectional_generate
+    from grammar import GrammarConstraint, make_tracker
+    from sampling import Sampler
+    from encoder_cache import EncoderCache, DecoderStateCache
+    from throughput import throughput
+    from cancellation import GenerationCancelled
+    from utils import midi_to_event, event_to_midi ,event_to_num, num_to_event, build_vocab, onset_alignment
+    from utils import load_midi, midi_to_bytes
+    from utils import events_to_timeline, timeline_to_events, event_windows, close_timeline, seconds_to_units, track_to_timeline, held_notes
     from ..config.config import Config
 import os
+import time
+import threading
 
 my_dict, dict_list = build_vocab()
+# 每个 token 对应的 shift_time 量化单位数（非 shift_time 为 0），用于在设备上累计生成的时长
+shift_units = torch.tensor([val if name == "shift_time" else 0 for name, val in dict_list], dtype=torch.float)
 
-# ========== Softmax Temperature Sampling ==========
-def temperature_sample(logits, temperature=1.0):
-    logits = logits / temperature
-    probs = torch.softmax(logits, dim=-1)
-    token = torch.multinomial(probs, num_samples=1)
-    return token.item()
+def prefix_time(tokens):
+    return sum(dict_list[t][1] for t in tokens if dict_list[t][0] == "shift_time")
 
+# 编码器输出缓存：同一右手重复生成时跳过编码器
+encoder_cache = EncoderCache(Config.ENCODER_CACHE_MAX_BYTES)
+# 左手前缀送入 decoder 后的状态缓存：同一区间反复重新生成时跳过前缀的计算
+decoder_state_cache = DecoderStateCache(Config.DECODER_STATE_CACHE_MAX_BYTES)
+
+def encode_source(model, src, pad_id):
+    """
+    返回 src 的编码结果 {'memory', 'cross_kv'}，优先从 encoder_cache 中取；
+    键由模型标识（路径 + 修改时间）和右手 token 内容决定
+    """
+    key = EncoderCache.make_key(getattr(model, 'model_id', id(model)), src)
+    entry = encoder_cache.get(key)
+    if entry is None:
+        memory = model.encode(src, src == pad_id)
+        entry = encoder_cache.put(key, memory, model.cross_kv(memory))
+    return entry
+
+# ========== 逐 token 采样生成 ==========
 @torch.no_grad()
-def sample_generate(model, src, bos_id, eos_id, pad_id, max_len=8000, temperature=1.0,target_len=800,left_prefix=None):
+def sample_generate_batch(model, src, bos_id, eos_id, pad_id, max_len=8000, target_len=800, left_prefix=None,
+                          grammar=None, sampler=None, eos_check_interval=16, num_samples=1, return_logprobs=False,
+                          time_limit=None, reuse_prefix_state=False, deadline=None, wrapup_steps=64, stats=None,
+                          cancel=None, preview_steps=None, on_preview=None):
+    """
+    对 src 中的每一行并行采样一条左手序列。
+
+    decoder 使用因果 mask（与训练一致）并缓存每层的 self-attn K/V，每一步只把新 token 送入 decoder。
+    token 缓冲区在设备上一次性分配，采样结果直接写入，不做 .item() / torch.cat；
+    eos 每 eos_check_interval 步才同步检查一次，已结束的行之后只写 pad。
+
+    参数:
+        grammar (GrammarConstraint, 可选): 给定时在采样前屏蔽不合法的 token
+        sampler (Sampler): 温度 / top-k / top-p / 重复惩罚 / 随机种子
+        num_samples (int): src 只有一行时，编码一次后复制 memory，同时采样 num_samples 条
+        return_logprobs (bool): 同时返回每条序列在模型分布下的平均对数概率（用于候选排序）
+        time_limit (int, 可选): 累计 shift_time（含 left_prefix，量化单位）达到该值时停止该行；
+            因时间到达而停止的行不补 note_off，由调用方（分窗生成）在下一个窗口继续
+        reuse_prefix_state (bool): 单行生成时，从 decoder_state_cache 取（或存入）left_prefix 送入后的 decoder 状态
+        deadline (float, 可选): time.monotonic() 的截止时刻。按本次实测的解码速度估计，剩余时间只够
+            wrapup_steps 步时进入收尾：各行在下一个"note_off 之后没有按住的音"处结束；到达截止时刻仍未结束的行直接截断并补 note_off
+        stats (dict, 可选): 传入时写入 steps / elapsed / steps_per_sec / deadline_hit
+        cancel (CancellationToken, 可选): 每一步检查，已取消时抛出 GenerationCancelled
+        preview_steps / on_preview (可选): 解码完第 preview_steps 步时，用第一行当前的 token（含 left_prefix，
+            未补 note_off）调用一次 on_preview，然后在同一个 decoder 状态上继续解码，不会重新开始
+
+    返回:
+        list[list[int]]: 每行生成的 token（包含 left_prefix）
+        list[float]: 仅 return_logprobs=True 时返回
+    """
     model.eval()
-    memory = model.encoder(model.src_pos_encoder(model.src_embedding(src)))
-    if left_prefix is not None:
-        ys = torch.tensor([[bos_id] + left_prefix], dtype=torch.long).to(src.device)
-        generated = list(left_prefix)
-    else:
-        ys = torch.tensor([[bos_id]], dtype=torch.long).to(src.device)
-        generated = []
-
-    for _ in range(max_len):
-        if target_len is not None and len(generated) >= target_len:
+    device = src.device
+    src_padding_mask = (src == pad_id)
+    encoded = encode_source(model, src, pad_id)
+    memory = encoded['memory']
+    if num_samples > 1:
+        memory = memory.expand(num_samples, -1, -1)
+        src_padding_mask = src_padding_mask.expand(num_samples, -1)
+    B = memory.size(0)
+    cache = model.new_cache(encoded['cross_kv'], batch_size=B)
+    logp_sum = torch.zeros(B, device=device)
+    logp_count = torch.zeros(B, device=device)
+
+    prefix = list(left_prefix or [])
+    start = 1 + len(prefix)
+    steps = max_len
+    if target_len is not None:
+        steps = min(steps, target_len - len(prefix))
+    steps = max(0, min(steps, model.max_positions - start))
+
+    ys = torch.full((B, start + steps), pad_id, dtype=torch.long, device=device)
+    ys[:, 0] = bos_id
+    if prefix:
+        ys[:, 1:start] = torch.tensor(prefix, dtype=torch.long, device=device)
+    finished = torch.zeros(B, dtype=torch.bool, device=device)
+    # 不做语法约束时，带截止时间的生成仍需要跟踪按住的音来判断收尾位置
+    tracker = make_tracker(grammar, deadline, device)
+    state = tracker.feed(tracker.init_state(B), prefix) if tracker is not None else None
+    if tracker is not None:
+        # 前缀按住的音收尾后就已经放不下更多 token 时，不再生成（见循环中同样的判断）
+        finished |= start + tracker.closing_len(state) + 3 > ys.size(1)
+    timed_out = torch.zeros(B, dtype=torch.bool, device=device)
+    if time_limit is not None:
+        elapsed = torch.full((B,), float(prefix_time(prefix)), device=device)
+        units = shift_units.to(device)
+
+    pos = start  # 下一个 token 写入的位置
+    fed = 0      # ys[:, :fed] 已经送入过 decoder
+    state_key, prefill_logits = None, None
+    if reuse_prefix_state and prefix and B == 1:
+        state_key = DecoderStateCache.make_key(getattr(model, 'model_id', id(model)), src, prefix)
+        entry = decoder_state_cache.get(state_key)
+        if entry is not None:
+            cache, prefill_logits = entry['cache'], entry['logits']
+    wrapping, deadline_hit = False, False
+    t0 = time.monotonic()
+    for step in range(steps):
+        if cancel is not None:
+            cancel.check()
+        if step == 0 and prefill_logits is not None:
+            logits = prefill_logits
+        else:
+            logits = model.decode(ys[:, fed:pos], memory, src_padding_mask, cache)[:, -1]  # 最后一个位置的预测
+            if step == 0 and state_key is not None:
+                decoder_state_cache.put(state_key, cache, logits)
+        fed = pos
+        if grammar is not None:
+            logits = grammar.apply(logits, state)
+        tokens = sampler.sample(logits, ys[:, :pos]).masked_fill(finished, pad_id)
+        ys[:, pos] = tokens
+        if return_logprobs:
+            step_logp = torch.log_softmax(logits, dim=-1).gather(1, tokens.unsqueeze(1)).squeeze(1)
+            logp_sum += step_logp.masked_fill(finished, 0)
+            logp_count += (~finished).float()
+        pos += 1
+        if tracker is not None:
+            tracker.update(state, tokens)
+        if wrapping:
+            finished |= tracker.resting(state, tokens)
+        if tracker is not None:
+            # 收尾补的 note_off 也算在长度上限内：再写一个 note_on（最多多 2 个收尾 token）就放不下时结束该行
+            finished |= pos + tracker.closing_len(state) + 3 > ys.size(1)
+        finished |= tokens == eos_id
+        if time_limit is not None:
+            elapsed += units[tokens]
+            reached = (elapsed >= time_limit) & ~finished
+            timed_out |= reached
+            finished |= reached
+        if on_preview is not None and step + 1 == preview_steps:
+            row = ys[0, start:pos].tolist()
+            on_preview(prefix + (row[:row.index(eos_id)] if eos_id in row else row))
+        if (step + 1) % eos_check_interval == 0:
+            if finished.all().item():
+                break
+            if deadline is not None:
+                now = time.monotonic()
+                if now >= deadline:
+                    deadline_hit = True
+                    print(f"到达时间预算，在第 {step + 1} 步截断")
+                    break
+                if not wrapping and now + wrapup_steps * (now - t0) / (step + 1) >= deadline:
+                    wrapping = deadline_hit = True
+                    print(f"时间预算即将用完，第 {step + 1} 步开始收尾")
+
+    elapsed = time.monotonic() - t0
+    results = []
+    steps_done = 0
+    for b, row in enumerate(ys[:, start:pos].tolist()):
+        # 因 eos、收尾或时长上限结束的行，之后写入的都是 pad，在第一个 eos / pad 处截断
+        end = next((i for i, t in enumerate(row) if t == eos_id or t == pad_id), len(row))
+        stopped = end < len(row) and row[end] == eos_id
+        row = row[:end]
+        steps_done = max(steps_done, len(row))
+        if not stopped and tracker is not None and not timed_out[b]:
+            row += tracker.closing_tokens(state, index=b)
+        results.append(prefix + row)
+    # 只按实际生成的 token 数计速度和进度，结束后补的 pad 不算
+    throughput.record(getattr(model, 'model_id', id(model)), steps_done, elapsed)
+    if stats is not None:
+        stats.update(steps=steps_done, elapsed=elapsed, steps_per_sec=steps_done / max(elapsed, 1e-6),
+                     deadline_hit=deadline_hit)
+    if return_logprobs:
+        return results, (logp_sum / logp_count.clamp(min=1)).tolist()
+    return results
+
+def sample_generate(model, src, bos_id, eos_id, pad_id, max_len=8000, temperature=1.0,target_len=800,left_prefix=None,grammar=None,
+                    sampler=None, deadline=None, stats=None, cancel=None, preview_steps=None, on_preview=None):
+    if sampler is None:
+        sampler = Sampler(temperature=temperature, device=src.device)
+    return sample_generate_batch(model, src, bos_id, eos_id, pad_id, max_len=max_len, target_len=target_len,
+                                 left_prefix=left_prefix, grammar=grammar, sampler=sampler,
+                                 deadline=deadline, stats=stats, cancel=cancel,
+                                 preview_steps=preview_steps, on_preview=on_preview)[0]
+
+# ========== 长曲分窗生成 ==========
+def windowed_generate(model, right_events, bos_id, eos_id, pad_id, window_tokens=1024, overlap_tokens=256,
+                      left_prefix=None, grammar=None, sampler=None, deadline=None, stats=None, cancel=None,
+                      preview_steps=None, on_preview=None):
+    """
+    把右手按事件切成时间对齐、相互重叠的窗口，逐窗口生成左手后拼接，得到覆盖整首曲子的伴奏。
+
+    每个窗口的右手单独编码（时间从窗口第一个事件起算），已生成的左手中落在本窗口起点之后的部分
+    作为 left_prefix 接着生成，累计时长到达下一个窗口外的右手事件时停止；只保留时间早于该处的事件。
+    每个窗口的序列长度都不超过 window_tokens / 模型位置上限，内存占用与曲子长度无关。
+
+    参数:
+        right_events (list): midi_to_event 得到的右手事件
+        window_tokens (int): 每个窗口右手的 token 数上限
+        overlap_tokens (int): 相邻窗口重叠的右手 token 数，也是带入下一窗口的左手前缀 token 数上限
+        left_prefix (list[int], 可选): 用户给定的左手开头（不含 bos）
+        deadline (float, 可选): 截止时刻，到达后不再开始新的窗口，当前窗口按 sample_generate_batch 的规则收尾
+        stats (dict, 可选): 写入 deadline_hit，以及左手覆盖到的时间 covered 和右手总时长 total（量化单位）
+        preview_steps / on_preview (可选): 第一个窗口解码完 preview_steps 步时，用到此为止的左手 token 调用一次 on_preview
+
+    返回:
+        list[int]: 整首曲子的左手 token（不含 bos/eos）
+    """
+    timeline_preview = None
+    if on_preview is not None:
+        def timeline_preview(timeline):
+            on_preview(event_to_num(timeline_to_events(timeline), mydict=my_dict))
+    left_timeline = events_to_timeline(num_to_event(left_prefix, dict_list=dict_list)) if left_prefix else []
+    left_timeline = windowed_timeline(model, events_to_timeline(right_events), left_timeline, bos_id, eos_id, pad_id,
+                                      window_tokens=window_tokens, overlap_tokens=overlap_tokens,
+                                      grammar=grammar, sampler=sampler, deadline=deadline, stats=stats, cancel=cancel,
+                                      preview_steps=preview_steps, on_preview=timeline_preview)
+    return event_to_num(timeline_to_events(close_timeline(left_timeline)), mydict=my_dict)
+
+def windowed_timeline(model, right_timeline, left_timeline, bos_id, eos_id, pad_id, window_tokens=1024,
+                      overlap_tokens=256, grammar=None, sampler=None, end_time=None, reuse_prefix_state=False,
+                      deadline=None, stats=None, cancel=None, preview_steps=None, on_preview=None):
+    """
+    windowed_generate 的核心，直接在 [(绝对时间, 事件)] 时间轴上工作：
+    right_timeline 为右手，left_timeline 为已有的左手（其中落在窗口内的部分作为前缀），
+    新生成的事件追加到 left_timeline 后返回（未做 close_timeline 修复）。
+    end_time 给定时生成到该时间为止，默认到右手最后一个事件之后一个最大 shift_time。
+    deadline / stats / cancel 见 windowed_generate 与 sample_generate_batch。
+    on_preview 收到的是第一个窗口解码完 preview_steps 步时的左手时间轴。
+    """
+    device = next(model.parameters()).device
+    window_tokens = min(window_tokens, model.max_positions)
+    if not right_timeline:
+        return left_timeline
+    deadline_hit = False
+    # 每个事件占 shift_time + 音符两个 token，窗口两端还有 bos/eos
+    windows = event_windows(len(right_timeline), max(1, (window_tokens - 2) // 2), overlap_tokens // 2)
+    left_timeline = list(left_timeline)
+    if end_time is None:
+        end_time = right_timeline[-1][0] + dict_list[my_dict[("note_on", 0)] - 1][1]
+
+    for i, (lo, hi) in enumerate(windows):
+        last = i == len(windows) - 1
+        start = right_timeline[lo][0]
+        end = end_time if last else min(right_timeline[hi][0], end_time)
+
+        src_tokens = [bos_id] + event_to_num(timeline_to_events(right_timeline[lo:hi], start), mydict=my_dict) + [eos_id]
+        src = torch.tensor(src_tokens, dtype=torch.long, device=device).unsqueeze(0)
+
+        context = [item for item in left_timeline if item[0] >= start][-(overlap_tokens // 2):] if overlap_tokens else []
+        prefix = event_to_num(timeline_to_events(context, start), mydict=my_dict)
+        prefix_end = context[-1][0] if context else start
+        window_preview = None
+        if on_preview is not None and i == 0:
+            def window_preview(tokens, prefix_end=prefix_end, end=end, num_prefix=len(prefix)):
+                on_preview(left_timeline + _window_timeline(tokens[num_prefix:], prefix_end, end))
+        window_stats = {}
+        tokens = sample_generate_batch(model, src, bos_id, eos_id, pad_id, max_len=model.max_positions,
+                                       target_len=None, left_prefix=prefix, grammar=grammar, sampler=sampler,
+                                       time_limit=end - start, reuse_prefix_state=reuse_prefix_state,
+                                       deadline=deadline, stats=window_stats, cancel=cancel,
+                                       preview_steps=preview_steps, on_preview=window_preview)[0]
+
+        left_timeline.extend(_window_timeline(tokens[len(prefix):], prefix_end, end))
+        if len(windows) > 1:
+            print(f"分窗生成 {i + 1}/{len(windows)}：右手事件 {lo}-{hi}，左手累计 {len(left_timeline)} 个事件")
+        if end >= end_time:
             break
-        tgt_emb = model.tgt_pos_encoder(model.tgt_embedding(ys))
-        out = tgt_emb
-        for layer in model.decoder_layers:
-            out = layer(out, memory, tgt_mask=None, memory_mask=None,
-                        tgt_key_padding_mask=(ys == pad_id), memory_key_padding_mask=(src == pad_id))
-        logits = model.output_layer(out[:, -1])  # 最后一个位置的预测
-        next_token = temperature_sample(logits.squeeze(0), temperature=temperature)
-
-        ys = torch.cat([ys, torch.tensor([[next_token]], device=src.device)], dim=1)
-        if next_token == eos_id:
+        if window_stats.get('deadline_hit') or (deadline is not None and time.monotonic() >= deadline):
+            deadline_hit = True
+            print(f"时间预算用完，分窗生成在第 {i + 1}/{len(windows)} 个窗口后停止")
             break
-        generated.append(next_token)
 
-    return generated    
+    if stats is not None:
+        stats.update(deadline_hit=deadline_hit, covered=left_timeline[-1][0] if left_timeline else 0,
+                     total=right_timeline[-1][0])
+    return left_timeline
+
+def _window_timeline(tokens, event_time, end):
+    """窗口内新生成的 token → [(绝对时间, 事件)]，event_time 为前缀最后一个事件的时间，只保留早于 end 的事件"""
+    timeline = []
+    for event in num_to_event(tokens, dict_list=dict_list):
+        if event[0] == "shift_time":
+            event_time += event[1]
+        elif event[0] in ["note_on", "note_off"] and event_time < end:
+            timeline.append((event_time, event))
+    return timeline
+
+# ========== 多候选排序 ==========
+def rank_candidates(batch_tokens, mean_logprobs, right_events, alignment_weight=1.0):
+    """
+    按 平均对数概率 + alignment_weight * 节奏对齐度 从高到低排序候选
+    节奏对齐度为左手起音时刻落在右手起音附近的比例（见 utils.onset_alignment）
+    """
+    candidates = []
+    for tokens, mean_logprob in zip(batch_tokens, mean_logprobs):
+        alignment = onset_alignment(right_events, num_to_event(tokens, dict_list=dict_list))
+        candidates.append({
+            'tokens': tokens,
+            'mean_logprob': mean_logprob,
+            'alignment': alignment,
+            'score': mean_logprob + alignment_weight * alignment,
+        })
+    candidates.sort(key=lambda c: c['score'], reverse=True)
+    return candidates
+
+# ========== 模型加载（内存映射） ==========
+# 已加载模型的缓存，键为 (模型文件绝对路径, 设备)，同一进程内只加载一次
+_model_cache = {}
+# 每个键一把锁：多个请求线程同时第一次用到同一个模型时只加载一次，加载不同模型时互不等待
+_model_locks = {}
+_model_locks_guard = threading.Lock()
+
+def load_model(model_path, device, vocab_size=410, max_len=4000):
+    """
+    以内存映射方式加载模型权重并直接赋给模块参数
+
+    torch.load(mmap=True) 只建立文件映射，张量数据在首次访问时按页载入；
+    模型先在 meta 设备上构建（不分配参数内存），再用 load_state_dict(assign=True)
+    直接把映射出的张量作为参数，避免"反序列化一份 + 拷贝进新参数一份"的双倍内存峰值。
+    在 CPU 上，同一主机的多个工作进程共享同一份 page cache。
+
+    参数:
+        model_path (str): 模型 checkpoint 路径
+        device (torch.device): 目标设备
+        vocab_size (int): 词表大小
+        max_len (int): 位置编码长度
+
+    返回:
+        Seq2SeqTransformer: 处于 eval 模式的模型
+    """
+    key = (os.path.abspath(model_path), str(device))
+    model = _model_cache.get(key)
+    if model is not None:
+        return model
+    with _model_locks_guard:
+        lock = _model_locks.setdefault(key, threading.Lock())
+    with lock:
+        # 等锁期间其它线程可能已经加载完成
+        model = _model_cache.get(key)
+        if model is None:
+            model = _load_model_mmap(model_path, device, vocab_size, max_len)
+            _model_cache[key] = model
+    return model
+
+
+def _load_model_mmap(model_path, device, vocab_size, max_len):
+    """load_model 的实际加载过程（不经过缓存）"""
+    try:
+        checkpoint = torch.load(model_path, map_location=device, mmap=True)
+    except RuntimeError:
+        # 旧版（非 zip）格式的 checkpoint 不支持 mmap，退回普通加载
+        checkpoint = torch.load(model_path, map_location=device)
+    state_dict = checkpoint['model_state_dict'] if 'model_state_dict' in checkpoint else checkpoint
+    # 蒸馏导出的学生模型在 model_config 中记录了自己的结构参数
+    model_config = {'vocab_size': vocab_size, 'max_len': max_len}
+    model_config.update(checkpoint.get('model_config', {}))
+
+    with torch.device('meta'):
+        model = Seq2SeqTransformer(**model_config)
+    model.load_state_dict(state_dict, assign=True)
+    model.eval()
+    model.model_id = f"{os.path.abspath(model_path)}@{os.path.getmtime(model_path)}"
+    return model
+
+def model_fingerprint(model_name):
+    """模型文件名 + 修改时间，用作结果缓存键的一部分；文件不存在时返回 None"""
+    model_path = os.path.join(Config.MODEL_PATH, model_name)
+    if not os.path.exists(model_path):
+        return None
+    return f"{model_name}@{os.path.getmtime(model_path)}"
+
+def write_preview(path, right_events, left_tokens, ticks_per_beat):
+    """预览 MIDI：到目前为止生成的左手补齐 note_off，右手截到左手最后一个事件的时刻"""
+    left_timeline = close_timeline(events_to_timeline(num_to_event(left_tokens, dict_list=dict_list)))
+    until = left_timeline[-1][0] if left_timeline else 0
+    right_timeline = close_timeline([item for item in events_to_timeline(right_events) if item[0] <= until], end=until)
+    preview_midi = mido.MidiFile()
+    preview_midi.ticks_per_beat = ticks_per_beat
+    for timeline in (right_timeline, left_timeline):
+        preview_midi.tracks.append(event_to_midi(timeline_to_events(timeline) + [("eos", 0)]))
+    preview_midi.save(path)
+
 @torch.no_grad()
-def infer(right_input_path,output_path,left_input_path=None,model_name='model1.pt',vocab_size=410,bos_id= 0,eos_id = 1,pad_id = 2,max_len = 4000,temperature = 0.8,target_len=800):
+def infer(right_input_path,output_path,left_input_path=None,model_name='model1.pt',vocab_size=410,bos_id= 0,eos_id = 1,pad_id = 2,max_len = 4000,temperature = 0.8,target_len=800,
+          draft_model_name=None,num_draft=4,constrained=True,top_k=0,top_p=1.0,repetition_penalty=1.0,seed=None,
+          num_candidates=1,alignment_weight=1.0,full_length=False,window_tokens=1024,window_overlap=256,
+          parallel_sections=False,section_workers=4,time_budget=None,cancel=None,
+          preview_path=None,preview_steps=96,on_preview=None):
+    """
+    由右手 MIDI 生成左手伴奏，合并后的 MIDI 以 bytes 返回（result['midi_bytes']），给了 output_path 时同时保存
+
+    right_input_path / left_input_path 可以是文件路径、MIDI 文件内容（bytes）或文件对象，
+    整个流程可以不经过磁盘；是否落盘（output_path）由调用方决定
+
+    num_candidates > 1 时只编码一次右手，以 batch 方式同时采样多条左手，按
+    "平均对数概率 + alignment_weight * 与右手的节奏对齐度" 排序：最优的作为结果，
+    每个候选的 MIDI 放在 candidate['midi_bytes']；给了 output_path 时其余候选依次保存为
+    <output_path 去掉扩展名>_candidate<i>.mid（candidate['path']）
+
+    full_length=True 或右手超过 max_len 个 token 时使用分窗生成（见 windowed_generate），
+    左手覆盖整首曲子，此时忽略 target_len，也不使用多候选 / 推测解码；
+    再加上 parallel_sections=True 时改为按乐句切段、由 section_workers 个进程并行生成（见 sectional.py）
+
+    time_budget (秒，可选): 整个请求的时间预算。解码时实测速度，预算快用完时在没有按住的音的 note_off 处
+    提前结束（分段并行生成不支持）
+
+    cancel (CancellationToken, 可选): 在解码的每一步和各阶段之间检查，已取消时抛出 GenerationCancelled
+    （不会被当作普通失败返回 False），由调用方清理文件
+
+    preview_path / on_preview (可选): 预览模式。左手解码到 preview_steps 个 token 时，把这部分左手（补齐 note_off）
+    和同一时间段的右手合并保存到 preview_path，并以 {'preview_path', 'num_tokens', 'elapsed'} 调用 on_preview，
+    之后在同一个 decoder 状态上继续生成完整结果（多候选 / 分段并行生成不支持预览）
+
+    返回:
+        失败返回 False；成功返回 dict（真值），包含 midi_bytes、output_path（可能为 None）、num_tokens、elapsed、
+        stopped_early（是否因时间预算提前结束）、progress（完成比例，0~1），
+        以及多候选时的 candidates 列表（按得分从高到低）
+    """
     global my_dict
     global dict_list
+    started = time.monotonic()
+    deadline = started + time_budget if time_budget else None
     try:
         model_path = os.path.join(Config.MODEL_PATH,model_name)
         print(f"正在加载模型: {model_path}")
@@ -67,54 +464,128 @@ def infer(right_input_path,output_path,left_input_path=None,model_name='model1.p
         print(f"使用设备: {device}")
         
         # ========== 1. 加载模型 ==========
-        model = Seq2SeqTransformer(vocab_size=vocab_size, max_len=max_len).to(device)
-        
         try:
-            checkpoint = torch.load(model_path, map_location=device)
-            model.load_state_dict(checkpoint['model_state_dict'])
-            model.eval()
+            model = load_model(model_path, device, vocab_size=vocab_size, max_len=max_len)
             print("模型加载成功")
         except Exception as e:
             print(f"模型加载失败: {str(e)}")
             return False
 
+        # 草稿模型（可选）：加载失败时退回普通采样
+        draft_model = None
+        if draft_model_name is not None:
+            draft_path = os.path.join(Config.MODEL_PATH, draft_model_name)
+            try:
+                draft_model = load_model(draft_path, device, vocab_size=vocab_size, max_len=max_len)
+                print(f"使用草稿模型进行推测解码: {draft_path}")
+            except Exception as e:
+                print(f"草稿模型加载失败，使用普通采样: {str(e)}")
+
         # ========== 2. 加载右手 MIDI ==========
         try:
-            midi_file = mido.MidiFile(right_input_path)
+            midi_file = load_midi(right_input_path)
             if len(midi_file.tracks) == 0:
                 print("错误: MIDI文件没有音轨")
                 return False
                 
             right_events = midi_to_event(midi_file.tracks[0])
-            right_tokens = event_to_num(right_events, mydict=my_dict)[:max_len]
+            right_tokens = event_to_num(right_events, mydict=my_dict)
+            num_right_tokens = len(right_tokens)
+            windowed = full_length or num_right_tokens > max_len
+            right_tokens = right_tokens[:max_len]
             
             if len(right_tokens) == 0:
                 print("错误: 无法从MIDI文件提取有效的音符事件")
                 return False
                 
             src_tensor = torch.tensor(right_tokens, dtype=torch.long).unsqueeze(0).to(device)
-            print(f"MIDI文件加载成功，提取到 {len(right_tokens)} 个事件")
+            print(f"MIDI文件加载成功，提取到 {num_right_tokens} 个事件")
         except Exception as e:
             print(f"MIDI文件处理失败: {str(e)}")
             return False
         # ========== 2. 加载左手 MIDI ==========
         left_tokens=None
         if left_input_path is not None:
-            lmidi_file = mido.MidiFile(left_input_path)
+            lmidi_file = load_midi(left_input_path)
             left_events = midi_to_event(lmidi_file.tracks[0])
             left_tokens = event_to_num(left_events, mydict=my_dict)[:300]
+            # midi_to_event 以 bos 开头、以 eos 结尾，而解码序列已经有自己的 bos，且前缀之后还要接着生成，
+            # 两者都去掉，避免序列中间出现 bos / eos
+            if left_tokens and left_tokens[0] == bos_id:
+                left_tokens = left_tokens[1:]
+            if left_tokens and left_tokens[-1] == eos_id:
+                left_tokens = left_tokens[:-1]
 
 
 
         # ========== 3. 生成左手 ==========
+        if cancel is not None:
+            cancel.check()
+        grammar = GrammarConstraint(device, vocab_size=vocab_size) if constrained else None
+        sampler = Sampler(temperature=temperature, top_k=top_k, top_p=top_p,
+                          repetition_penalty=repetition_penalty, seed=seed, device=device)
+        candidates = None
+        stats = {}
+        preview_callback = None
+        if preview_path is not None and on_preview is not None:
+            def preview_callback(tokens):
+                try:
+                    write_preview(preview_path, right_events, tokens, midi_file.ticks_per_beat)
+                except Exception as e:
+                    print(f"预览MIDI保存失败: {str(e)}")
+                    return
+                print(f"预览已生成：{preview_path}（{len(tokens)} 个 token）")
+                on_preview({'preview_path': preview_path, 'num_tokens': len(tokens),
+                            'elapsed': time.monotonic() - started})
+            if num_candidates > 1 or (windowed and parallel_sections):
+                print("多候选 / 分段并行生成不支持预览，忽略 preview")
         try:
-            generated_tokens = sample_generate(model, src_tensor, bos_id=bos_id, eos_id=eos_id,pad_id=pad_id, max_len=max_len, temperature=temperature,target_len=target_len,left_prefix=left_tokens)
+            if windowed and parallel_sections:
+                if deadline is not None:
+                    print("分段并行生成不支持时间预算，忽略 time_budget")
+                generated_tokens = sectional_generate(model_path, right_events, bos_id=bos_id, eos_id=eos_id, pad_id=pad_id,
+                                                      workers=section_workers, vocab_size=vocab_size, max_len=max_len,
+                                                      rest_units=Config.SECTION_REST_UNITS, max_units=Config.SECTION_MAX_UNITS,
+                                                      context_events=Config.SECTION_CONTEXT_EVENTS, constrained=constrained,
+                                                      temperature=temperature, top_k=top_k, top_p=top_p,
+                                                      repetition_penalty=repetition_penalty, seed=seed, cancel=cancel)
+            elif windowed:
+                if num_candidates > 1 or draft_model is not None:
+                    print("分窗生成不支持多候选 / 推测解码，使用普通采样")
+                generated_tokens = windowed_generate(model, right_events, bos_id=bos_id, eos_id=eos_id, pad_id=pad_id,
+                                                     window_tokens=window_tokens, overlap_tokens=window_overlap,
+                                                     left_prefix=left_tokens, grammar=grammar, sampler=sampler,
+                                                     deadline=deadline, stats=stats, cancel=cancel,
+                                                     preview_steps=preview_steps, on_preview=preview_callback)
+            elif num_candidates > 1:
+                batch_tokens, mean_logprobs = sample_generate_batch(model, src_tensor, bos_id=bos_id, eos_id=eos_id, pad_id=pad_id,
+                                                                    max_len=max_len, target_len=target_len, left_prefix=left_tokens,
+                                                                    grammar=grammar, sampler=sampler,
+                                                                    num_samples=num_candidates, return_logprobs=True,
+                                                                    deadline=deadline, stats=stats, cancel=cancel)
+                candidates = rank_candidates(batch_tokens, mean_logprobs, right_events, alignment_weight)
+                generated_tokens = candidates[0]['tokens']
+            elif draft_model is not None:
+                generated_tokens = speculative_generate(model, draft_model, src_tensor, bos_id=bos_id, eos_id=eos_id, pad_id=pad_id,
+                                                        max_len=max_len, target_len=target_len, left_prefix=left_tokens,
+                                                        num_draft=num_draft, grammar=grammar, sampler=sampler,
+                                                        encode=encode_source, deadline=deadline, stats=stats,
+                                                        cancel=cancel, preview_steps=preview_steps,
+                                                        on_preview=preview_callback)
+            else:
+                generated_tokens = sample_generate(model, src_tensor, bos_id=bos_id, eos_id=eos_id,pad_id=pad_id, max_len=max_len, temperature=temperature,target_len=target_len,left_prefix=left_tokens,grammar=grammar,
+                                                   sampler=sampler, deadline=deadline, stats=stats, cancel=cancel,
+                                                   preview_steps=preview_steps, on_preview=preview_callback)
             print(f"左手生成成功，生成了 {len(generated_tokens)} 个音符事件")
+        except GenerationCancelled:
+            raise
         except Exception as e:
             print(f"左手生成失败: {str(e)}")
             return False
 
         # ========== 4. 转换为 MIDI ==========
+        if cancel is not None:
+            cancel.check()
         try:
             left_events = num_to_event(generated_tokens, dict_list=dict_list)
             left_track = event_to_midi(left_events)
@@ -122,27 +593,225 @@ def infer(right_input_path,output_path,left_input_path=None,model_name='model1.p
             print(f"左手MIDI转换失败: {str(e)}")
             return False
 
-        # ========== 5. 合并并保存 ==========
+        # ========== 5. 合并（在内存中序列化），给了 output_path 时保存 ==========
         try:
             output_midi = mido.MidiFile()
             output_midi.ticks_per_beat = midi_file.ticks_per_beat
             output_midi.tracks.append(event_to_midi(right_events))  # 右手
             output_midi.tracks.append(left_track)                   # 左手
-            output_midi.save(output_path)
-            
-            # 验证输出文件是否成功创建
-            if not os.path.exists(output_path):
-                print("错误: 输出文件创建失败")
-                return False
+            midi_bytes = midi_to_bytes(output_midi)
+            if output_path is not None:
+                with open(output_path, 'wb') as f:
+                    f.write(midi_bytes)
                 
-            print(f"✅ 采样生成完成：{output_path}")
-            return True
+            print(f"✅ 采样生成完成：{output_path or f'{len(midi_bytes)} 字节'}")
+            stopped_early = bool(stats.get('deadline_hit'))
+            if not stopped_early:
+                progress = 1.0
+            elif 'total' in stats:
+                progress = min(1.0, stats['covered'] / max(stats['total'], 1))
+            else:
+                progress = min(1.0, stats.get('steps', 0) / max(target_len - len(left_tokens or []), 1))
+            result = {'midi_bytes': midi_bytes, 'output_path': output_path, 'num_tokens': len(generated_tokens),
+                      'elapsed': time.monotonic() - started, 'stopped_early': stopped_early, 'progress': progress}
+            if stopped_early:
+                print(f"因时间预算提前结束，完成 {progress:.0%}")
+
+            if candidates is not None:
+                for i, candidate in enumerate(candidates):
+                    if i == 0:
+                        candidate['midi_bytes'] = midi_bytes
+                        continue
+                    candidate_midi = mido.MidiFile()
+                    candidate_midi.ticks_per_beat = midi_file.ticks_per_beat
+                    candidate_midi.tracks.append(event_to_midi(right_events))
+                    candidate_midi.tracks.append(event_to_midi(num_to_event(candidate['tokens'], dict_list=dict_list)))
+                    candidate['midi_bytes'] = midi_to_bytes(candidate_midi)
+                if output_path is not None:
+                    save_candidates(candidates, output_path)
+                for candidate in candidates:
+                    del candidate['tokens']
+                result['candidates'] = candidates
+                print(f"已生成 {len(candidates)} 个候选，最优得分 {candidates[0]['score']:.3f}")
+            return result
         except Exception as e:
             print(f"MIDI文件保存失败: {str(e)}")
             return False
             
+    except GenerationCancelled:
+        print("生成任务已取消")
+        raise
     except Exception as e:
         print(f"推理过程发生未预期的错误: {str(e)}")
         return False
+@torch.no_grad()
+def infer_batch(sources, model_name='model1.pt', vocab_size=410, bos_id=0, eos_id=1, pad_id=2, max_len=4000,
+                temperature=0.8, target_len=800, constrained=True, top_k=0, top_p=1.0, repetition_penalty=1.0,
+                seed=None, full_length=False, window_tokens=1024, window_overlap=256, cancel=None):
+    """
+    为多首右手（sources 中每一项为 MIDI 文件内容 / 路径 / 文件对象）各生成一条左手，全程在内存中进行
+
+    能一次送入模型的右手（不超过 max_len 个 token，且不要求整曲生成）补 pad 拼成一个 batch，
+    编码一次、同一个解码循环里同时采样，多首曲子共享每一步的 decoder 调用；
+    其余的（整曲 / 超长）逐首走 infer 的分窗生成。
+    同一个 seed 下结果只在 batch 组成相同时可复现，与单首调用 infer 的结果不同。
+
+    返回:
+        与 sources 等长的列表，每项失败为 False，成功为 dict：midi_bytes、num_tokens、elapsed
+    """
+    results = [False] * len(sources)
+    started = time.monotonic()
+    model_path = os.path.join(Config.MODEL_PATH, model_name)
+    if not os.path.exists(model_path):
+        print(f"错误: 模型文件不存在 - {model_path}")
+        return results
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    try:
+        model = load_model(model_path, device, vocab_size=vocab_size, max_len=max_len)
+    except Exception as e:
+        print(f"模型加载失败: {str(e)}")
+        return results
+
+    batch = []  # (下标, ticks_per_beat, 右手事件, 右手 token)
+    for i, source in enumerate(sources):
+        if cancel is not None:
+            cancel.check()
+        try:
+            midi_file = load_midi(source)
+            right_events = midi_to_event(midi_file.tracks[0]) if midi_file.tracks else []
+            right_tokens = event_to_num(right_events, mydict=my_dict)
+        except Exception as e:
+            print(f"第 {i} 个MIDI文件处理失败: {str(e)}")
+            continue
+        if not right_tokens:
+            print(f"第 {i} 个MIDI文件没有有效的音符事件")
+            continue
+        if full_length or len(right_tokens) > max_len:
+            results[i] = infer(midi_file, None, model_name=model_name, vocab_size=vocab_size, bos_id=bos_id,
+                               eos_id=eos_id, pad_id=pad_id, max_len=max_len, temperature=temperature,
+                               target_len=target_len, constrained=constrained, top_k=top_k, top_p=top_p,
+                               repetition_penalty=repetition_penalty, seed=seed, full_length=True,
+                               window_tokens=window_tokens, window_overlap=window_overlap, cancel=cancel)
+            continue
+        batch.append((i, midi_file.ticks_per_beat, right_events, right_tokens))
+    if not batch:
+        return results
+
+    width = max(len(item[3]) for item in batch)
+    src = torch.full((len(batch), width), pad_id, dtype=torch.long, device=device)
+    for row, (_, _, _, right_tokens) in enumerate(batch):
+        src[row, :len(right_tokens)] = torch.tensor(right_tokens, dtype=torch.long, device=device)
+    grammar = GrammarConstraint(device, vocab_size=vocab_size) if constrained else None
+    sampler = Sampler(temperature=temperature, top_k=top_k, top_p=top_p,
+                      repetition_penalty=repetition_penalty, seed=seed, device=device)
+    try:
+        generated = sample_generate_batch(model, src, bos_id=bos_id, eos_id=eos_id, pad_id=pad_id, max_len=max_len,
+                                          target_len=target_len, grammar=grammar, sampler=sampler, cancel=cancel)
+    except GenerationCancelled:
+        raise
+    except Exception as e:
+        print(f"批量生成失败: {str(e)}")
+        return results
+    print(f"批量生成完成：{len(batch)} 首，耗时 {time.monotonic() - started:.2f}s")
+
+    for (i, ticks_per_beat, right_events, _), tokens in zip(batch, generated):
+        try:
+            output_midi = mido.MidiFile()
+            output_midi.ticks_per_beat = ticks_per_beat
+            output_midi.tracks.append(event_to_midi(right_events))
+            output_midi.tracks.append(event_to_midi(num_to_event(tokens, dict_list=dict_list)))
+            results[i] = {'midi_bytes': midi_to_bytes(output_midi), 'num_tokens': len(tokens),
+                          'elapsed': time.monotonic() - started}
+        except Exception as e:
+            print(f"第 {i} 个左手MIDI转换失败: {str(e)}")
+    return results
+
+def save_candidates(candidates, output_path):
+    """把候选保存到磁盘：第一个（最优）就是 output_path，其余为 <output_path 去掉扩展名>_candidate<i>.mid
+    每个候选记录 path，并去掉 midi_bytes（候选列表会存入会话数据）"""
+    base, ext = os.path.splitext(output_path)
+    for i, candidate in enumerate(candidates):
+        data = candidate.pop('midi_bytes', None)
+        candidate['path'] = output_path if i == 0 else f"{base}_candidate{i}{ext}"
+        if i > 0 and data is not None:
+            with open(candidate['path'], 'wb') as f:
+                f.write(data)
+    return candidates
+
+# ========== 局部重新生成 ==========
+@torch.no_grad()
+def regenerate_range(midi_path, output_path, start_sec, end_sec, model_name='model1.pt', vocab_size=410, bos_id=0, eos_id=1,
+                     pad_id=2, max_len=4000, temperature=0.8, constrained=True, top_k=0, top_p=1.0,
+                     repetition_penalty=1.0, seed=None, context_events=64, context_tokens=256, window_tokens=1024,
+                     cancel=None):
+    """
+    只重新生成已有结果中 [start_sec, end_sec) 这段时间的左手，区间前后的左手保持不变
+
+    midi_path 为 infer 输出的合并 MIDI（音轨 0 右手、音轨 1 左手）。区间之前的左手作为前缀
+    （最多 context_tokens 个 token），右手只取区间前 context_events 个事件到区间结束这一段送入模型，
+    生成到区间结束为止，再把原来区间之后的左手接上。耗时只与区间长度有关，与整首曲子的长度无关；
+    同一区间反复重新生成时，前缀的 decoder 状态从 decoder_state_cache 中取出。
+    cancel (CancellationToken, 可选): 传给解码循环，已取消时抛出 GenerationCancelled
+
+    返回:
+        失败返回 False；成功返回 dict，包含 output_path 和 num_events（新生成的左手事件数）
+    """
+    try:
+        model_path = os.path.join(Config.MODEL_PATH, model_name)
+        if not os.path.exists(model_path):
+            print(f"错误: 模型文件不存在 - {model_path}")
+            return False
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        model = load_model(model_path, device, vocab_size=vocab_size, max_len=max_len)
+
+        midi_file = mido.MidiFile(midi_path)
+        if len(midi_file.tracks) < 2:
+            print("错误: MIDI文件中没有左手音轨")
+            return False
+        start = seconds_to_units(midi_file, start_sec)
+        end = seconds_to_units(midi_file, end_sec)
+        if end <= start:
+            print("错误: 结束时间必须大于起始时间")
+            return False
+
+        right_timeline = track_to_timeline(midi_file.tracks[0])
+        left_timeline = track_to_timeline(midi_file.tracks[1])
+        head = [item for item in left_timeline if item[0] < start]
+        tail = [item for item in left_timeline if item[0] >= end]
+
+        # 右手：区间前 context_events 个事件起，到区间结束后第一个事件为止
+        lo = next((i for i, item in enumerate(right_timeline) if item[0] >= start), len(right_timeline))
+        hi = next((i for i, item in enumerate(right_timeline) if item[0] >= end), len(right_timeline))
+        right_window = right_timeline[max(0, lo - context_events):min(len(right_timeline), hi + 1)]
+        if not right_window:
+            print("错误: 区间内没有右手音符")
+            return False
+
+        grammar = GrammarConstraint(device, vocab_size=vocab_size) if constrained else None
+        sampler = Sampler(temperature=temperature, top_k=top_k, top_p=top_p,
+                          repetition_penalty=repetition_penalty, seed=seed, device=device)
+        generated = windowed_timeline(model, right_window, head, bos_id, eos_id, pad_id, window_tokens=window_tokens,
+                                      overlap_tokens=context_tokens, grammar=grammar, sampler=sampler,
+                                      end_time=end, reuse_prefix_state=True, cancel=cancel)
+        # 模型可能在最后一个前缀事件和区间起点之间也放了音符，那里保留原来的左手
+        new = [item for item in generated[len(head):] if start <= item[0] < end]
+        # 原来在区间结束时仍按住、由后半段松开的音，不在区间结束处提前松开
+        carried = held_notes(left_timeline, end)
+        merged = close_timeline(close_timeline(head + new, end=end, keep=carried) + tail)
+
+        output_midi = mido.MidiFile()
+        output_midi.ticks_per_beat = midi_file.ticks_per_beat
+        output_midi.tracks.append(midi_file.tracks[0])
+        output_midi.tracks.append(event_to_midi(timeline_to_events(merged, max_time=None)))
+        output_midi.save(output_path)
+        print(f"✅ 区间重新生成完成：{output_path}（{start_sec}s-{end_sec}s，新生成 {len(new)} 个事件）")
+        return {'output_path': output_path, 'num_events': len(new)}
+    except GenerationCancelled:
+        print("区间重新生成已取消")
+        raise
+    except Exception as e:
+        print(f"区间重新生成失败: {str(e)}")
+        return False
+
 if __name__=='__main__':
     pass
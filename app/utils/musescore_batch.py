@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import tempfile
+import threading
+import subprocess
+from app.config.config import Config
+
+# ========== MuseScore 批量转换 ==========
+'''
+每次转换都单独启动一个 MuseScore 进程时，大部分时间花在启动上（Qt、插件、音色库）。
+这里把短时间窗口（window 秒）内到达的转换请求收集起来，写成一个 JSON 批处理任务文件：
+    [{"in": "a.mid", "out": "a.pdf"}, {"in": "b.mid", "out": "b.mid"}, ...]
+用一次 `mscore -j 任务文件` 完成，再按输出文件是否生成把结果分别交还给各自等待的请求。
+窗口内只有一个请求时仍用 `mscore -o 输出 输入`。
+'''
+
+class ConversionJob:
+    def __init__(self, mscore, input_file, output_file):
+        self.mscore = mscore
+        self.input_file = os.path.abspath(input_file)
+        self.output_file = os.path.abspath(output_file)
+        self.enqueued_at = time.monotonic()
+        self.done = threading.Event()
+        self.success = False
+        # 等待方已取消：转换完成后删除输出
+        self.abandoned = False
+
+
+class MuseScoreBatcher:
+    def __init__(self, window=0.2, max_batch=16, workers=2):
+        """
+        参数:
+            window (float): 第一个请求到达后最多再等多少秒收集同一批的请求
+            max_batch (int): 一批最多的转换数，攒够时立即开始
+            workers (int): 同时运行的 MuseScore 进程数
+        """
+        self.window = window
+        self.max_batch = max_batch
+        self.workers = workers
+        self._pending = []
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def _ensure_workers(self):
+        self._threads = [t for t in self._threads if t.is_alive()]
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._worker, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def convert(self, mscore, input_file, output_file, cancel=None):
+        """
+        把 input_file 转换为 output_file（格式由扩展名决定），阻塞直到所在的批次完成
+        返回 bool；cancel 被取消时不再等待，由 cancel.check() 抛出 GenerationCancelled（已开始的批次不受影响，输出被丢弃）
+        """
+        job = ConversionJob(mscore, input_file, output_file)
+        with self._cond:
+            self._pending.append(job)
+            self._ensure_workers()
+            self._cond.notify_all()
+        if cancel is None:
+            job.done.wait()
+            return job.success
+        while not job.done.wait(0.01):
+            if cancel.cancelled:
+                with self._cond:
+                    if job in self._pending:
+                        self._pending.remove(job)
+                    else:
+                        job.abandoned = True
+                cancel.check()
+        return job.success
+
+    def _take_batch(self):
+        with self._cond:
+            while True:
+                while not self._pending:
+                    self._cond.wait()
+                # 从最早的请求到达起等满一个窗口，或攒够 max_batch 个
+                first = self._pending[0]
+                remaining = first.enqueued_at + self.window - time.monotonic()
+                while remaining > 0 and len(self._pending) < self.max_batch and first in self._pending:
+                    self._cond.wait(timeout=remaining)
+                    remaining = first.enqueued_at + self.window - time.monotonic()
+                if not self._pending:
+                    continue
+                mscore = self._pending[0].mscore
+                batch = [job for job in self._pending if job.mscore == mscore][:self.max_batch]
+                for job in batch:
+                    self._pending.remove(job)
+                return batch
+
+    def _worker(self):
+        while True:
+            batch = self._take_batch()
+            try:
+                self._run_batch(batch)
+            except Exception as e:
+                print(f"❌ MuseScore 批量转换出错: {str(e)}")
+            finally:
+                for job in batch:
+                    if job.abandoned and os.path.exists(job.output_file):
+                        os.remove(job.output_file)
+                    job.done.set()
+
+    def _run_batch(self, batch):
+        # 输出文件是否存在就是每个转换的结果，先删掉旧文件
+        for job in batch:
+            if os.path.exists(job.output_file):
+                os.remove(job.output_file)
+        mscore = batch[0].mscore
+        job_path = None
+        if len(batch) == 1:
+            cmd = [mscore, "-o", batch[0].output_file, batch[0].input_file]
+        else:
+            with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+                json.dump([{"in": job.input_file, "out": job.output_file} for job in batch], f)
+                job_path = f.name
+            cmd = [mscore, "-j", job_path]
+        try:
+            print(f"▶ MuseScore 转换 {len(batch)} 个文件：{cmd}")
+            returncode = subprocess.run(cmd, shell=False).returncode
+            if returncode != 0:
+                # 批处理中某个文件失败时 MuseScore 仍会处理其它文件，按输出文件逐个判断
+                print(f"❌ MuseScore 返回错误码 {returncode}")
+        except FileNotFoundError:
+            print(f"❌ 找不到 MuseScore 可执行文件: {mscore}")
+        finally:
+            if job_path is not None:
+                os.remove(job_path)
+        for job in batch:
+            job.success = os.path.isfile(job.output_file)
+
+
+musescore_batcher = MuseScoreBatcher(Config.MUSESCORE_BATCH_WINDOW, Config.MUSESCORE_BATCH_MAX,
+                                     Config.MUSESCORE_BATCH_WORKERS)
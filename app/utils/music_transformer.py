@@ -4,6 +4,7 @@
 import torch
 import torch.nn as nn
 import torch.optim as optim
+import torch.nn.functional as F
 from torch.utils.data import Dataset, DataLoader
 import numpy as np
 import matplotlib.pyplot as plt
@@ -42,8 +43,9 @@ class PositionalEncoding(nn.Module):
         pe[:, 1::2] = torch.cos(position * div_term)
         self.register_buffer('pe', pe.unsqueeze(0))
 
-    def forward(self, x):
-        x = x + self.pe[:, :x.size(1)]
+    def forward(self, x, offset=0):
+        # offset: 增量解码时新 token 在整个序列中的起始位置
+        x = x + self.pe[:, offset:offset + x.size(1)]
         return self.dropout(x)
 
 # ================== Transformer 模型 ===================
@@ -56,10 +58,11 @@ class RelativePositionalBias(nn.Module):
         self.relative_attention_bias = nn.Embedding(2 * max_relative_position + 1, num_heads)
         nn.init.normal_(self.relative_attention_bias.weight, std=0.02)
 
-    def forward(self, qlen, klen):
+    def forward(self, qlen, klen, offset=0):
         device = next(self.parameters()).device  # 获取当前模块所在设备
 
-        context_position = torch.arange(qlen, dtype=torch.long, device=device)[:, None]
+        # 增量解码时 query 是序列末尾的 qlen 个位置，从 offset 开始
+        context_position = torch.arange(offset, offset + qlen, dtype=torch.long, device=device)[:, None]
         memory_position = torch.arange(klen, dtype=torch.long, device=device)[None, :]
 
         relative_position = memory_position - context_position
@@ -83,14 +86,22 @@ class RelPosSelfAttention(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.rel_bias = RelativePositionalBias(nhead, max_relative_position)
 
-    def forward(self, x, attn_mask=None, key_padding_mask=None):
+    def forward(self, x, attn_mask=None, key_padding_mask=None, cache=None):
         B, L, _ = x.shape
         qkv = self.qkv_proj(x)
         qkv = qkv.reshape(B, L, 3, self.nhead, self.head_dim).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]
 
+        # cache: 本层的 self-attn K/V 缓存（dict），增量解码时把新 token 的 K/V 拼到末尾
+        if cache is not None:
+            if 'k' in cache:
+                k = torch.cat([cache['k'], k], dim=2)
+                v = torch.cat([cache['v'], v], dim=2)
+            cache['k'], cache['v'] = k, v
+        klen = k.size(2)
+
         attn_scores = torch.matmul(q, k.transpose(-2, -1)) * self.scaling
-        rel_pos_bias = self.rel_bias(L, L).unsqueeze(0)
+        rel_pos_bias = self.rel_bias(L, klen, offset=klen - L).unsqueeze(0)
         attn_scores = attn_scores + rel_pos_bias
 
         if attn_mask is not None:
@@ -123,14 +134,17 @@ class RelativeTransformerDecoderLayer(nn.Module):
         self.activation = nn.ReLU()
 
     def forward(self, tgt, memory, tgt_mask=None, memory_mask=None,
-                tgt_key_padding_mask=None, memory_key_padding_mask=None):
-        tgt2 = self.self_attn(tgt, attn_mask=tgt_mask, key_padding_mask=tgt_key_padding_mask)
+                tgt_key_padding_mask=None, memory_key_padding_mask=None, cache=None):
+        tgt2 = self.self_attn(tgt, attn_mask=tgt_mask, key_padding_mask=tgt_key_padding_mask, cache=cache)
         tgt = tgt + self.dropout1(tgt2)
         tgt = self.norm1(tgt)
 
-        tgt2, _ = self.multihead_attn(tgt, memory, memory,
-                                      attn_mask=memory_mask,
-                                      key_padding_mask=memory_key_padding_mask)
+        if cache is not None and 'cross_k' in cache:
+            tgt2 = self._cached_cross_attn(tgt, cache['cross_k'], cache['cross_v'], memory_key_padding_mask)
+        else:
+            tgt2, _ = self.multihead_attn(tgt, memory, memory,
+                                          attn_mask=memory_mask,
+                                          key_padding_mask=memory_key_padding_mask)
         tgt = tgt + self.dropout2(tgt2)
         tgt = self.norm2(tgt)
 
@@ -139,6 +153,33 @@ class RelativeTransformerDecoderLayer(nn.Module):
         tgt = self.norm3(tgt)
         return tgt
 
+    def cross_kv(self, memory):
+        """预先计算 cross-attention 的 K/V，形状 (B, nhead, S, head_dim)；同一段 memory 的每个解码步都可复用"""
+        attn = self.multihead_attn
+        d_model = attn.embed_dim
+        head_dim = d_model // attn.num_heads
+        w_k, w_v = attn.in_proj_weight[d_model:2 * d_model], attn.in_proj_weight[2 * d_model:]
+        b_k, b_v = attn.in_proj_bias[d_model:2 * d_model], attn.in_proj_bias[2 * d_model:]
+        B, S, _ = memory.shape
+        k = F.linear(memory, w_k, b_k).reshape(B, S, attn.num_heads, head_dim).transpose(1, 2)
+        v = F.linear(memory, w_v, b_v).reshape(B, S, attn.num_heads, head_dim).transpose(1, 2)
+        return k, v
+
+    def _cached_cross_attn(self, tgt, k, v, key_padding_mask=None):
+        """与 multihead_attn(tgt, memory, memory) 等价（推理模式），但 K/V 使用预计算结果"""
+        attn = self.multihead_attn
+        d_model = attn.embed_dim
+        head_dim = d_model // attn.num_heads
+        B, L, _ = tgt.shape
+        q = F.linear(tgt, attn.in_proj_weight[:d_model], attn.in_proj_bias[:d_model])
+        q = q.reshape(B, L, attn.num_heads, head_dim).transpose(1, 2)
+        attn_scores = torch.matmul(q, k.transpose(-2, -1)) * head_dim ** -0.5
+        if key_padding_mask is not None:
+            attn_scores = attn_scores.masked_fill(key_padding_mask.unsqueeze(1).unsqueeze(2), float('-inf'))
+        attn_output = torch.matmul(torch.softmax(attn_scores, dim=-1), v)
+        attn_output = attn_output.transpose(1, 2).reshape(B, L, d_model)
+        return attn.out_proj(attn_output)
+
 
 
 
@@ -170,6 +211,59 @@ class Seq2SeqTransformer(nn.Module):
             out = layer(out, memory, tgt_mask, None, tgt_padding_mask, src_padding_mask)
         return self.output_layer(out)
 
+    # ---------- 推理用的增量解码接口 ----------
+    def encode(self, src, src_padding_mask=None):
+        return self.encoder(self.src_pos_encoder(self.src_embedding(src)), src_key_padding_mask=src_padding_mask)
+
+    def new_cache(self, cross_kv=None, batch_size=None):
+        """
+        每个 decoder 层一个 dict，存放已处理 token 的 self-attn K/V；
+        给定 cross_kv（cross_kv() 的返回值）时一并放入，解码时不再重复投影 memory。
+        batch_size 大于 cross_kv 的 batch 时按 batch 展开（多候选共享同一份右手）
+        """
+        cache = [{} for _ in self.decoder_layers]
+        if cross_kv is not None:
+            for layer_cache, (k, v) in zip(cache, cross_kv):
+                if batch_size is not None and batch_size != k.size(0):
+                    k, v = k.expand(batch_size, -1, -1, -1), v.expand(batch_size, -1, -1, -1)
+                layer_cache['cross_k'], layer_cache['cross_v'] = k, v
+        return cache
+
+    def cross_kv(self, memory):
+        return [layer.cross_kv(memory) for layer in self.decoder_layers]
+
+    @staticmethod
+    def cache_len(cache):
+        return cache[0]['k'].size(2) if 'k' in cache[0] else 0
+
+    @staticmethod
+    def truncate_cache(cache, length):
+        """回退缓存，只保留前 length 个位置（推测解码拒绝草稿 token 时使用）"""
+        for layer_cache in cache:
+            if 'k' in layer_cache:
+                layer_cache['k'] = layer_cache['k'][:, :, :length]
+                layer_cache['v'] = layer_cache['v'][:, :, :length]
+
+    def decode(self, tgt, memory, memory_key_padding_mask=None, cache=None):
+        """
+        带因果 mask 的解码。cache 为 new_cache() 的返回值时，tgt 只需包含尚未处理的新 token，
+        它们的 K/V 会追加进 cache；返回 tgt 每个位置的 logits，与整段重算的结果一致。
+        """
+        offset = self.cache_len(cache) if cache is not None else 0
+        L = tgt.size(1)
+        tgt_mask = None
+        if L > 1:
+            tgt_mask = torch.ones(L, offset + L, device=tgt.device).triu(offset + 1).bool()
+        out = self.tgt_pos_encoder(self.tgt_embedding(tgt), offset=offset)
+        for i, layer in enumerate(self.decoder_layers):
+            out = layer(out, memory, tgt_mask=tgt_mask, memory_key_padding_mask=memory_key_padding_mask,
+                        cache=cache[i] if cache is not None else None)
+        return self.output_layer(out)
+
+    @property
+    def max_positions(self):
+        return self.tgt_pos_encoder.pe.size(1)
+
 
 
 
@@ -0,0 +1,155 @@
+import os
+import json
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from .transform import export_pdf
+    from ..config.config import Config
+except ImportError:
+    from transform import export_pdf
+    from ..config.config import Config
+
+# ========== 乐谱（PDF）后台渲染 ==========
+'''
+MuseScore 导出 PDF 要好几秒，而很多用户只需要 MIDI。/upload 不再导出 PDF：
+    - 第一次请求某个 PDF（查看 / 下载）时才提交给渲染线程池，从未请求的 PDF 不会渲染
+    - 渲染期间请求返回 'rendering'，由路由返回 202，前端稍后重试
+    - MIDI 被改写（区间重新生成）后调用 invalidate，旧的 PDF 被删除，正在进行的旧渲染结果被丢弃
+渲染先写到临时文件，完成后再替换到目标路径，不会读到写了一半的 PDF。
+多进程部署（serve.py）时轮询请求会落到不同的工作进程，渲染任务因此不记在进程内，而是用 PDF 旁的
+标记文件 <pdf>.rendering 协调：以 O_EXCL 创建成功的进程才提交渲染，其它进程看到标记就返回 'rendering'。
+标记中记录渲染进程的 pid（进程已不存在时视为残留标记）和渲染结果；渲染开始时记下 MIDI 的
+(mtime_ns, 大小, inode)，完成时 MIDI 已被改写（无论在哪个进程中）则丢弃结果。
+'''
+
+class PdfRenderer:
+    def __init__(self, workers=2):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pdf-render')
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _marker_path(pdf_path):
+        return pdf_path + '.rendering'
+
+    @staticmethod
+    def _midi_version(midi_path):
+        try:
+            st = os.stat(midi_path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _read_marker(self, pdf_path):
+        """返回标记内容 dict；标记不存在返回 None，刚创建还没写入内容时返回空 dict"""
+        try:
+            with open(self._marker_path(pdf_path), 'r', encoding='utf-8') as f:
+                content = f.read()
+        except OSError:
+            return None
+        try:
+            return json.loads(content)
+        except ValueError:
+            return {}
+
+    def _write_marker(self, pdf_path, marker):
+        # 先写临时文件再替换，其它进程不会读到写了一半的标记
+        temp_path = f"{self._marker_path(pdf_path)}.{marker['token']}"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(marker, f)
+        os.replace(temp_path, self._marker_path(pdf_path))
+
+    def _remove_marker(self, pdf_path, token=None):
+        """删除标记；给定 token 时只删除自己创建的（invalidate 后可能已有新一轮渲染的标记）"""
+        if token is not None:
+            marker = self._read_marker(pdf_path)
+            if marker is None or marker.get('token') != token:
+                return
+        try:
+            os.remove(self._marker_path(pdf_path))
+        except OSError:
+            pass
+
+    @staticmethod
+    def _owner_alive(marker):
+        pid = marker.get('pid')
+        if pid is None:
+            return True  # 刚创建的标记
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _claim(self, pdf_path, token):
+        """以 O_EXCL 创建标记，成功返回 True；标记已存在（其它进程或线程正在渲染）返回 False"""
+        try:
+            fd = os.open(self._marker_path(pdf_path), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'pid': os.getpid(), 'token': token, 'status': 'rendering'}, f)
+        return True
+
+    def _render(self, midi_path, pdf_path, version, token):
+        base, ext = os.path.splitext(pdf_path)
+        # MuseScore 按扩展名决定输出格式，临时文件也要以 .pdf 结尾
+        temp_path = f"{base}.rendering.{token}{ext}"
+        success = False
+        try:
+            success = export_pdf(midi_path, temp_path)
+            with self._lock:
+                current = self._midi_version(midi_path) == version
+                if success and current:
+                    os.replace(temp_path, pdf_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            marker = self._read_marker(pdf_path)
+            if marker is not None and marker.get('token') == token:
+                if success:
+                    self._remove_marker(pdf_path)
+                else:
+                    # 失败记在标记里，由下一次请求（可能在其它进程中）报告
+                    self._write_marker(pdf_path, {'pid': os.getpid(), 'token': token, 'status': 'failed'})
+        return success
+
+    def request(self, midi_path, pdf_path):
+        """
+        需要 pdf_path 时调用。返回:
+            'ready': PDF 已存在
+            'rendering': 正在渲染（没有渲染任务时提交一个）
+            'failed': 上一次渲染失败；失败只报告一次，下一次请求会重新渲染
+        """
+        with self._lock:
+            marker = self._read_marker(pdf_path)
+            if marker is not None:
+                if marker.get('status') == 'failed':
+                    self._remove_marker(pdf_path, marker.get('token'))
+                    return 'failed'
+                if self._owner_alive(marker):
+                    return 'rendering'
+                # 渲染进程已退出（崩溃或被重启），清掉残留标记重新渲染
+                self._remove_marker(pdf_path, marker.get('token'))
+            if os.path.exists(pdf_path):
+                return 'ready'
+            version = self._midi_version(midi_path)
+            if version is None:
+                return 'failed'
+            token = f"{os.getpid()}.{uuid.uuid4().hex[:8]}"
+            if not self._claim(pdf_path, token):
+                return 'rendering'
+            self._executor.submit(self._render, midi_path, pdf_path, version, token)
+            return 'rendering'
+
+    def invalidate(self, pdf_path):
+        """对应的 MIDI 已改变：删除旧 PDF 和渲染标记，正在进行的渲染完成后发现 MIDI 已变，结果不会被使用"""
+        with self._lock:
+            self._remove_marker(pdf_path)
+            if os.path.exists(pdf_path):
+                os.remove(pdf_path)
+
+
+pdf_renderer = PdfRenderer(Config.PDF_RENDER_WORKERS)
@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+from app.config.config import Config
+
+# ========== 结果缓存（内容寻址） ==========
+'''
+以 "输入文件内容 + 生成参数" 的 sha256 作为键，把生成的 MIDI / 导出的 PDF 存在磁盘上。
+同样的输入再次到来时直接取出结果，不经过模型或 MuseScore。
+缓存目录按总字节数上限做 LRU 淘汰：命中时刷新文件的 mtime，淘汰时先删 mtime 最旧的。
+取出时优先用硬链接放到目标路径，缓存条目被淘汰不会影响已经取出的会话文件。
+'''
+
+class ResultCache:
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # 缓存目录的总字节数：启动后第一次写入时扫描一次，之后随写入 / 淘汰增减
+        self._total = None
+        # 上次遍历以来本进程写入的字节数，超过上限的 10% 时重新遍历一次，校正其它进程写入造成的偏差
+        self._written = 0
+
+    @staticmethod
+    def make_key(*contents, **params):
+        """contents: 若干 bytes（如上传文件内容）；params: 影响结果的参数，需可 JSON 序列化"""
+        h = hashlib.sha256()
+        for content in contents:
+            h.update(hashlib.sha256(content or b'').digest())
+        h.update(json.dumps(params, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+        return h.hexdigest()
+
+    def _path(self, key, ext):
+        return os.path.join(self.cache_dir, key[:2], key + ext)
+
+    def fetch(self, key, ext, dest_path):
+        """命中时把缓存文件放到 dest_path 并返回 True"""
+        path = self._path(key, ext)
+        if not os.path.isfile(path):
+            return False
+        try:
+            os.utime(path)  # 刷新 LRU 时间
+            if os.path.exists(dest_path):
+                os.remove(dest_path)
+            try:
+                os.link(path, dest_path)
+            except OSError:
+                shutil.copyfile(path, dest_path)
+            print(f"结果缓存命中: {key[:12]}{ext}")
+            return True
+        except OSError as e:
+            print(f"读取结果缓存失败: {e}")
+            return False
+
+    def get(self, key, ext):
+        """命中时返回缓存内容（bytes），否则返回 None"""
+        path = self._path(key, ext)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)  # 刷新 LRU 时间
+        except OSError:
+            return None
+        print(f"结果缓存命中: {key[:12]}{ext}")
+        return data
+
+    def put_bytes(self, key, ext, data):
+        """把内存中的结果存入缓存；同样先写临时文件再原子替换"""
+        path = self._path(key, ext)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            self._commit(tmp_path, path)
+        except OSError as e:
+            print(f"写入结果缓存失败: {e}")
+            return
+        self._evict()
+
+    def put(self, key, ext, src_path):
+        """把 src_path 的内容存入缓存；写入临时文件后原子替换，避免并发读到半个文件"""
+        path = self._path(key, ext)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            shutil.copyfile(src_path, tmp_path)
+            self._commit(tmp_path, path)
+        except OSError as e:
+            print(f"写入结果缓存失败: {e}")
+            return
+        self._evict()
+
+    def _scan(self):
+        """遍历缓存目录，返回 (总字节数, [(mtime, 大小, 路径)])；其它写入者还没替换到位的 .tmp 文件不计入"""
+        files = []
+        total = 0
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        return total, files
+
+    def _commit(self, tmp_path, path):
+        """把写好的临时文件替换到位，并更新总字节数（覆盖已有条目时减去旧文件的大小）"""
+        size = os.path.getsize(tmp_path)
+        with self._lock:
+            if self._total is None:
+                self._total = self._scan()[0]
+            try:
+                old_size = os.path.getsize(path)
+            except OSError:
+                old_size = 0
+            os.replace(tmp_path, path)
+            self._total += size - old_size
+            self._written += size
+
+    def _evict(self):
+        """
+        总字节数超过上限时按 mtime 从旧到新删除，删到上限的 90%，避免之后每次写入都要再遍历目录。
+        只在需要淘汰、或本进程写入累计超过上限的 10% 时才遍历目录（多进程部署时其它进程的写入
+        不会计入本进程的总数，由这次遍历校正），平时写入只更新计数
+        """
+        with self._lock:
+            if self._total is None:
+                return
+            if self._total <= self.max_bytes and self._written <= self.max_bytes * 0.1:
+                return
+            total, files = self._scan()
+            self._written = 0
+            if total <= self.max_bytes:
+                self._total = total
+                return
+            target = self.max_bytes * 0.9
+            files.sort()
+            for _, size, path in files:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+            self._total = total
+
+
+result_cache = ResultCache(Config.RESULT_CACHE_FOLDER, Config.RESULT_CACHE_MAX_BYTES)
@@ -0,0 +1,149 @@
+import os
+import re
+import time
+import threading
+from app.config.config import Config
+from app.models.session import SessionManager
+
+# ========== 会话过期与磁盘配额 ==========
+'''
+上传目录和输出目录中的文件、会话数据库都不会自己变小。后台清理线程每隔 interval 秒做一次：
+    1. TTL：最近访问时间超过 ttl 秒的会话，删除它的所有文件和会话记录（每批 batch_size 个）
+    2. 孤儿文件：不属于任何会话、修改时间超过 ttl 的文件（崩溃的请求留下的临时文件等）直接删除
+    3. 配额：两个目录的总大小超过 max_bytes 时，按最近访问时间从旧到新淘汰会话，直到低于配额；
+       正在后台生成（status 为 generating）的会话不淘汰
+会话的文件名都以会话ID开头（原始乐谱为 original_<会话ID>.pdf），扫描一遍目录就能把文件归到各个会话。
+'''
+
+_SESSION_ID = re.compile(r'([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})')
+
+
+class RetentionSweeper:
+    def __init__(self, ttl=3 * 24 * 3600, max_bytes=2 * 1024 ** 3, interval=600, batch_size=500,
+                 folders=None):
+        """
+        参数:
+            ttl (float): 会话在最近一次访问后保留的秒数
+            max_bytes (int): 上传目录 + 输出目录的总大小上限
+            interval (float): 两次清理之间的秒数
+            batch_size (int): 每批删除的会话数
+        """
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.batch_size = batch_size
+        self.folders = folders or [Config.UPLOAD_FOLDER, Config.OUTPUT_FOLDER]
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _scan(self):
+        """扫描目录，返回 ({会话ID: [(路径, 大小)]}, [(不属于会话的路径, 大小, 修改时间)], 总大小)"""
+        by_session, others, total = {}, [], 0
+        for folder in self.folders:
+            if not os.path.isdir(folder):
+                continue
+            for entry in os.scandir(folder):
+                if not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                total += stat.st_size
+                match = _SESSION_ID.search(entry.name)
+                if match:
+                    by_session.setdefault(match.group(1), []).append((entry.path, stat.st_size, stat.st_mtime))
+                else:
+                    others.append((entry.path, stat.st_size, stat.st_mtime))
+        return by_session, others, total
+
+    @staticmethod
+    def _remove(files):
+        freed = 0
+        for path, size, _ in files:
+            try:
+                os.remove(path)
+                freed += size
+            except OSError:
+                pass
+        return freed
+
+    def sweep(self):
+        """执行一次清理，返回 {'expired', 'evicted', 'orphans', 'freed_bytes', 'total_bytes'}"""
+        sessions = SessionManager()
+        now = time.time()
+        by_session, others, total = self._scan()
+        report = {'expired': 0, 'evicted': 0, 'orphans': 0, 'freed_bytes': 0}
+
+        def drop(session_ids):
+            freed = sum(self._remove(by_session.pop(session_id, [])) for session_id in session_ids)
+            sessions.delete_sessions(session_ids)
+            report['freed_bytes'] += freed
+            return freed
+
+        # 1) 过期会话（stop() 之后不再开始新的一批，见 stop）
+        while not self._stop.is_set():
+            expired = sessions.expired_sessions(now - self.ttl, limit=self.batch_size)
+            if not expired:
+                break
+            total -= drop(expired)
+            report['expired'] += len(expired)
+
+        # 2) 孤儿文件：会话已不存在或文件名不含会话ID
+        orphans = [f for f in others if f[2] < now - self.ttl]
+        for session_id in list(by_session):
+            files = by_session[session_id]
+            if max(f[2] for f in files) < now - self.ttl and not sessions.session_exists(session_id):
+                orphans.extend(by_session.pop(session_id))
+        freed = self._remove(orphans)
+        total -= freed
+        report['orphans'] = len(orphans)
+        report['freed_bytes'] += freed
+
+        # 3) 超出配额时按 LRU 淘汰
+        offset = 0
+        while total > self.max_bytes and not self._stop.is_set():
+            batch = sessions.least_recently_used(limit=self.batch_size, offset=offset)
+            if not batch:
+                break
+            victims = []
+            for session_id, data in batch:
+                if data.get('status') == 'generating':
+                    offset += 1
+                    continue
+                victims.append(session_id)
+                total -= sum(size for _, size, _ in by_session.get(session_id, []))
+                if total <= self.max_bytes:
+                    break
+            if victims:
+                drop(victims)
+                report['evicted'] += len(victims)
+
+        report['total_bytes'] = total
+        if report['expired'] or report['evicted'] or report['orphans']:
+            print(f"清理完成：过期会话 {report['expired']} 个，淘汰会话 {report['evicted']} 个，"
+                  f"孤儿文件 {report['orphans']} 个，释放 {report['freed_bytes'] / 1024 ** 2:.1f} MB")
+        return report
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"清理过期会话时发生错误: {str(e)}")
+
+    def start(self):
+        """启动后台清理线程（重复调用无效）"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止后台清理；正在进行的一次清理处理完当前这一批就结束（平滑重载时新旧工作进程的清理不会同时进行）"""
+        self._stop.set()
+
+
+retention_sweeper = RetentionSweeper(Config.SESSION_TTL, Config.STORAGE_MAX_BYTES, Config.RETENTION_SWEEP_INTERVAL,
+                                     Config.RETENTION_BATCH_SIZE)
@@ -0,0 +1,80 @@
+import torch
+
+# ========== 设备端采样 ==========
+'''
+所有 logits 处理（温度、重复惩罚、top-k、top-p）都是对 (B, vocab) 张量的向量化操作，
+采样用 torch.multinomial 直接得到设备上的 token 张量，不调用 .item()，
+因此解码循环中每一步都不需要设备→主机同步。
+每个请求持有自己的 torch.Generator，给定 seed 时结果可复现。
+'''
+
+class Sampler:
+    def __init__(self, temperature=1.0, top_k=0, top_p=1.0, repetition_penalty=1.0, repetition_window=64,
+                 seed=None, device=torch.device("cpu")):
+        """
+        参数:
+            temperature (float): 温度，越小越保守
+            top_k (int): 只在概率最高的 k 个 token 中采样，0 表示不限制
+            top_p (float): nucleus 采样阈值，1.0 表示不限制
+            repetition_penalty (float): 对最近 repetition_window 个 token 中出现过的 token 的惩罚，1.0 表示不惩罚
+            repetition_window (int): 重复惩罚只看最近这么多个 token（左手本身有大量重复的 shift_time，不宜看全局）
+            seed (int, 可选): 随机种子
+        """
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        self.repetition_window = repetition_window
+        self.seed = seed
+        self.generator = torch.Generator(device=device)
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        else:
+            self.generator.seed()
+
+    def process(self, logits, history=None):
+        """
+        logits: (B, vocab)；history: (B, T) 已生成的 token（用于重复惩罚）
+        返回处理后的 logits，被过滤的位置为 -inf
+        """
+        logits = logits / self.temperature
+
+        if self.repetition_penalty != 1.0 and history is not None and history.size(1) > 0:
+            recent = history[:, -self.repetition_window:]
+            seen = torch.zeros_like(logits, dtype=torch.bool).scatter_(1, recent, True)
+            penalized = torch.where(logits > 0, logits / self.repetition_penalty, logits * self.repetition_penalty)
+            logits = torch.where(seen, penalized, logits)
+
+        if self.top_k and self.top_k < logits.size(-1):
+            kth = torch.topk(logits, self.top_k, dim=-1).values[:, -1:]
+            logits = logits.masked_fill(logits < kth, float('-inf'))
+
+        if self.top_p < 1.0:
+            sorted_logits, sorted_idx = torch.sort(logits, dim=-1, descending=True)
+            sorted_probs = torch.softmax(sorted_logits, dim=-1)
+            # 累计概率（不含自身）已超过 top_p 的 token 被移除，概率最高的 token 总会保留
+            remove = (torch.cumsum(sorted_probs, dim=-1) - sorted_probs) > self.top_p
+            remove = torch.zeros_like(remove).scatter_(1, sorted_idx, remove)
+            logits = logits.masked_fill(remove, float('-inf'))
+        return logits
+
+    def probs(self, logits, history=None):
+        squeeze = logits.dim() == 1
+        if squeeze:
+            logits = logits.unsqueeze(0)
+            history = history.unsqueeze(0) if history is not None else None
+        probs = torch.softmax(self.process(logits, history), dim=-1)
+        return probs[0] if squeeze else probs
+
+    def draw(self, probs):
+        """从概率分布采样，probs: (B, vocab) 或 (vocab,)"""
+        if probs.dim() == 1:
+            return torch.multinomial(probs, num_samples=1, generator=self.generator)[0]
+        return torch.multinomial(probs, num_samples=1, generator=self.generator).squeeze(1)
+
+    def sample(self, logits, history=None):
+        """返回 (B,) 设备上的 token 张量"""
+        return self.draw(self.probs(logits, history))
+
+    def uniform(self, device):
+        return torch.rand(1, device=device, generator=self.generator)
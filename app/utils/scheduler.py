@@ -0,0 +1,119 @@
+import math
+import threading
+import time
+import itertools
+try:
+    from .throughput import throughput
+    from ..config.config import Config
+except ImportError:
+    from throughput import throughput
+    from ..config.config import Config
+
+# ========== 生成任务调度与准入控制 ==========
+'''
+/upload 的生成任务不再按到达顺序执行：
+    - 每个任务按右手长度和 target_len 估计耗时（解码速度来自 throughput 的实测值）
+    - 同时运行的任务数不超过 max_concurrent，避免多个请求互相拖慢
+    - 有空位时优先放行估计耗时最短的任务（SJF）；排队越久优先级越高（aging），长任务不会一直饿死
+    - 排队数达到 max_queue 时直接拒绝，由路由返回 503 和 Retry-After
+'''
+
+class GenerationTicket:
+    def __init__(self, job_id, cost):
+        self.job_id = job_id
+        self.cost = cost
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+
+
+class GenerationScheduler:
+    def __init__(self, max_concurrent=2, max_queue=16, aging=1.0):
+        """
+        参数:
+            max_concurrent (int): 同时运行的生成任务数上限
+            max_queue (int): 排队任务数上限，超过时拒绝新任务
+            aging (float): 排队每等待 1 秒，估计耗时相当于减少 aging 秒
+        """
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.aging = aging
+        self._running = {}
+        self._queue = []
+        self._ids = itertools.count()
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def estimate_cost(src_tokens, target_len, full_length=False, time_budget=None):
+        """
+        估计任务耗时（秒）= (左手步数 + SCHEDULER_SOURCE_WEIGHT × src_tokens) / 实测解码速度
+        左手步数：整曲生成时为 src_tokens；否则为 min(target_len, src_tokens)（左手与右手长度相当，
+        右手很短时提前遇到 eos）。右手长度未知（src_tokens 为 0）时按 target_len 估计
+        """
+        if not src_tokens:
+            steps = target_len
+        else:
+            steps = src_tokens if full_length else min(target_len, src_tokens)
+            steps += Config.SCHEDULER_SOURCE_WEIGHT * src_tokens
+        cost = throughput.estimate_seconds(steps)
+        if time_budget is not None:
+            cost = min(cost, time_budget)
+        return cost
+
+    def _priority(self, ticket, now):
+        return ticket.cost - self.aging * (now - ticket.enqueued_at)
+
+    def _next_ticket(self):
+        now = time.monotonic()
+        return min(self._queue, key=lambda t: (self._priority(t, now), t.job_id))
+
+    def acquire(self, cost, timeout=None, cancel=None):
+        """
+        阻塞直到任务可以开始，返回 GenerationTicket；排队已满（或等待超过 timeout 秒、排队时被取消）时返回 None
+        """
+        with self._cond:
+            if len(self._running) >= self.max_concurrent and len(self._queue) >= self.max_queue:
+                return None
+            ticket = GenerationTicket(next(self._ids), cost)
+            self._queue.append(ticket)
+            deadline = time.monotonic() + timeout if timeout is not None else None
+            while len(self._running) >= self.max_concurrent or self._next_ticket() is not ticket:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if (remaining is not None and remaining <= 0) or (cancel is not None and cancel.cancelled):
+                    self._queue.remove(ticket)
+                    self._cond.notify_all()
+                    return None
+                # 优先级随时间变化，定期醒来重新比较
+                interval = 0.05 if cancel is not None else 1.0
+                self._cond.wait(timeout=min(remaining, interval) if remaining is not None else interval)
+            self._queue.remove(ticket)
+            ticket.started_at = time.monotonic()
+            self._running[ticket.job_id] = ticket
+            # 还有空位时让下一个任务也开始
+            self._cond.notify_all()
+            return ticket
+
+    def release(self, ticket):
+        with self._cond:
+            self._running.pop(ticket.job_id, None)
+            self._cond.notify_all()
+
+    def retry_after(self):
+        """估计多少秒后再来能被接收：正在运行和排队的任务的剩余耗时之和 / 并发数"""
+        with self._cond:
+            now = time.monotonic()
+            pending = sum(max(t.cost - (now - t.started_at), 0) for t in self._running.values())
+            pending += sum(t.cost for t in self._queue)
+        return max(1, math.ceil(pending / self.max_concurrent))
+
+    def stats(self):
+        with self._cond:
+            return {
+                'running': len(self._running),
+                'queued': len(self._queue),
+                'max_concurrent': self.max_concurrent,
+                'max_queue': self.max_queue,
+                'steps_per_sec': throughput.steps_per_sec(),
+            }
+
+
+generation_scheduler = GenerationScheduler(Config.MAX_CONCURRENT_JOBS, Config.MAX_QUEUE_DEPTH, Config.SCHEDULER_AGING)
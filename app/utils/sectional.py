@@ -0,0 +1,140 @@
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import torch
+try:
+    from .utils import event_to_num, num_to_event, build_vocab, events_to_timeline, timeline_to_events
+    from .utils import split_sections, close_timeline
+except ImportError:
+    from utils import event_to_num, num_to_event, build_vocab, events_to_timeline, timeline_to_events
+    from utils import split_sections, close_timeline
+
+# ========== 分段并行生成 ==========
+'''
+长曲逐 token 顺序解码是瓶颈。这里在长休止处（或每隔固定时长）把右手切成乐句大小的段落，
+每个段落连同前后相邻段落的少量右手事件作为上下文，交给进程池中的一个工作进程独立生成左手，
+最后按时间拼接成一条左手音轨。各段互不依赖，总耗时接近最长的那一段。
+
+工作进程用 spawn 方式启动，各自以 mmap 方式加载同一个模型文件（共享 page cache），
+每个进程只用 threads_per_worker 个线程，避免多个进程抢占同一批核心。
+进程池在同一配置下复用，只有第一次请求需要等待进程启动和模型加载。
+'''
+
+my_dict, dict_list = build_vocab()
+
+_pool = None
+_pool_key = None
+_pool_lock = threading.Lock()
+
+# 工作进程内的模型，由 _init_worker 加载
+_worker_model = None
+
+
+def _init_worker(model_path, vocab_size, max_len, threads_per_worker):
+    global _worker_model
+    from .infer import load_model
+    torch.set_num_threads(threads_per_worker)
+    _worker_model = load_model(model_path, torch.device("cpu"), vocab_size=vocab_size, max_len=max_len)
+
+
+def _generate_section(task):
+    """在工作进程中生成一个段落的左手，返回该段落内的 [(绝对时间, 事件)]"""
+    from .infer import sample_generate_batch
+    from .grammar import GrammarConstraint
+    from .sampling import Sampler
+    device = torch.device("cpu")
+    src = torch.tensor(task['src'], dtype=torch.long).unsqueeze(0)
+    grammar = GrammarConstraint(device) if task['constrained'] else None
+    sampler = Sampler(device=device, **task['sampling'])
+    tokens = sample_generate_batch(_worker_model, src, task['bos_id'], task['eos_id'], task['pad_id'],
+                                   max_len=_worker_model.max_positions, target_len=None, grammar=grammar,
+                                   sampler=sampler, time_limit=task['end'] - task['context_start'])[0]
+
+    # 前置上下文部分生成的左手只用来让模型"接得上"，只保留段落时间范围内的事件
+    kept = []
+    time = task['context_start']
+    for event in num_to_event(tokens, dict_list=dict_list):
+        if event[0] == "shift_time":
+            time += event[1]
+        elif event[0] in ["note_on", "note_off"] and task['start'] <= time < task['end']:
+            kept.append((time, event))
+    return close_timeline(kept, end=task['end'])
+
+
+def get_pool(model_path, workers, vocab_size=410, max_len=4000, threads_per_worker=1):
+    """返回（必要时创建）加载了 model_path 的进程池；模型或进程数变化时重建"""
+    global _pool, _pool_key
+    key = (model_path, workers, vocab_size, max_len, threads_per_worker)
+    with _pool_lock:
+        if _pool is None or _pool_key != key:
+            if _pool is not None:
+                _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=_init_worker,
+                                        initargs=(model_path, vocab_size, max_len, threads_per_worker))
+            _pool_key = key
+        return _pool
+
+
+def sectional_generate(model_path, right_events, bos_id, eos_id, pad_id, workers=4, vocab_size=410, max_len=4000,
+                       rest_units=100, max_units=2000, context_events=16, constrained=True, temperature=0.8,
+                       top_k=0, top_p=1.0, repetition_penalty=1.0, seed=None, cancel=None):
+    """
+    参数:
+        model_path (str): 模型文件路径，由工作进程各自加载
+        right_events (list): midi_to_event 得到的右手事件
+        workers (int): 工作进程数
+        rest_units / max_units: 段落切分参数（量化单位），见 utils.split_sections
+        context_events (int): 每个段落前后各带入的相邻右手事件数
+        seed (int, 可选): 第 i 个段落使用 seed + i，结果可复现
+        cancel (CancellationToken, 可选): 取消时撤回尚未开始的段落并抛出 GenerationCancelled；
+            已在工作进程中运行的段落会跑完，结果被丢弃
+
+    返回:
+        list[int]: 整首曲子的左手 token（不含 bos/eos）
+    """
+    right_timeline = events_to_timeline(right_events)
+    if not right_timeline:
+        return []
+    # 每个段落（含上下文）都要放得进模型的位置编码
+    max_section_events = (max_len - 2) // 2 - 2 * context_events
+    sections = []
+    for lo, hi in split_sections(right_timeline, rest_units=rest_units, max_units=max_units):
+        for start in range(lo, hi, max_section_events):
+            sections.append((start, min(start + max_section_events, hi)))
+    max_shift = dict_list[my_dict[("note_on", 0)] - 1][1]
+
+    tasks = []
+    for i, (lo, hi) in enumerate(sections):
+        ctx_lo = max(0, lo - context_events)
+        ctx_hi = min(len(right_timeline), hi + context_events)
+        context_start = right_timeline[ctx_lo][0]
+        src = [bos_id] + event_to_num(timeline_to_events(right_timeline[ctx_lo:ctx_hi], context_start),
+                                      mydict=my_dict) + [eos_id]
+        tasks.append({
+            'src': src,
+            'context_start': context_start,
+            'start': right_timeline[lo][0],
+            'end': right_timeline[hi][0] if hi < len(right_timeline) else right_timeline[-1][0] + max_shift,
+            'bos_id': bos_id, 'eos_id': eos_id, 'pad_id': pad_id,
+            'constrained': constrained,
+            'sampling': {'temperature': temperature, 'top_k': top_k, 'top_p': top_p,
+                         'repetition_penalty': repetition_penalty,
+                         'seed': seed + i if seed is not None else None},
+        })
+
+    pool = get_pool(model_path, workers, vocab_size=vocab_size, max_len=max_len)
+    print(f"分段并行生成：{len(tasks)} 个段落，{workers} 个工作进程")
+    # 先提交最长的段落，总耗时才能接近最长段落的耗时
+    order = sorted(range(len(tasks)), key=lambda i: len(tasks[i]['src']), reverse=True)
+    futures = {i: pool.submit(_generate_section, tasks[i]) for i in order}
+
+    left_timeline = []
+    for i in range(len(tasks)):
+        while cancel is not None and not futures[i].done():
+            if cancel.wait(0.01):
+                for future in futures.values():
+                    future.cancel()
+                cancel.check()
+        left_timeline.extend(futures[i].result())
+    return event_to_num(timeline_to_events(close_timeline(left_timeline)), mydict=my_dict)
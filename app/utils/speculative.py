@@ -0,0 +1,180 @@
+import time
+import torch
+try:
+    from .sampling import Sampler
+    from .throughput import throughput
+    from .grammar import make_tracker
+except ImportError:
+    from sampling import Sampler
+    from throughput import throughput
+    from grammar import make_tracker
+
+# ========== 推测解码（Speculative Sampling） ==========
+'''
+小的草稿模型（如 music_transformer/蒸馏.py 导出的学生模型）先逐个提出 k 个 token，
+主模型在一次并行的 decoder 前向中给出这 k 个位置（以及之后一个位置）的分布，
+按标准接受规则 min(1, p/q) 逐个接受；第一个被拒绝的位置从 norm(max(p - q, 0)) 重新采样，
+全部接受时再从主模型的下一个分布多采一个 token。
+这样得到的序列分布与直接用主模型做温度采样完全相同。
+'''
+
+def _probs(logits, sampler, history, grammar=None, state=None):
+    if grammar is not None:
+        logits = grammar.apply(logits, state)
+    return sampler.probs(logits, history)
+
+@torch.no_grad()
+def speculative_generate(model, draft_model, src, bos_id, eos_id, pad_id, max_len=8000, temperature=1.0,
+                         target_len=800, left_prefix=None, num_draft=4, grammar=None, sampler=None, encode=None,
+                         deadline=None, wrapup_steps=64, stats=None, cancel=None, preview_steps=None, on_preview=None):
+    """
+    参数与 infer.sample_generate 相同，另加:
+        draft_model (Seq2SeqTransformer): 草稿模型，需与主模型共用词表
+        num_draft (int): 每轮草稿模型提出的 token 数 k
+        grammar (GrammarConstraint, 可选): 主模型与草稿模型的分布都在同一语法掩码下计算，
+            接受规则作用于掩码后的分布，因此结果仍与约束下的普通采样同分布
+        sampler (Sampler, 可选): 两个模型使用同一套 logits 处理（温度 / top-k / top-p / 重复惩罚）和随机数发生器
+        encode (callable, 可选): encode(model, src, pad_id) -> {'memory', 'cross_kv'}，用于复用编码器缓存
+        deadline / wrapup_steps / stats: 与 infer.sample_generate_batch 相同；收尾阶段在某一轮接受的最后一个 token
+            是 note_off 且没有按住的音时结束。按住的音由 make_tracker 跟踪：没有 grammar 但给了 deadline 时
+            另建一个只跟踪、不掩码的 GrammarConstraint，与 sample_generate_batch 一样在结束时补上 note_off
+        cancel (CancellationToken, 可选): 每一轮检查，已取消时抛出 GenerationCancelled
+        preview_steps / on_preview (可选): 生成的 token 数第一次达到 preview_steps 时用当前序列调用一次 on_preview，
+            之后在同样的缓存上继续
+
+    返回:
+        list[int]: 生成的 token（包含 left_prefix）
+    """
+    model.eval()
+    draft_model.eval()
+    if sampler is None:
+        sampler = Sampler(temperature=temperature, device=src.device)
+    src_padding_mask = (src == pad_id)
+    if encode is not None:
+        encoded, draft_encoded = encode(model, src, pad_id), encode(draft_model, src, pad_id)
+        memory, draft_memory = encoded['memory'], draft_encoded['memory']
+        cache = model.new_cache(encoded['cross_kv'])
+        draft_cache = draft_model.new_cache(draft_encoded['cross_kv'])
+    else:
+        memory = model.encode(src, src_padding_mask)
+        draft_memory = draft_model.encode(src, src_padding_mask)
+        cache = model.new_cache()
+        draft_cache = draft_model.new_cache()
+
+    # seq 是完整序列（含 bos），两个缓存各自记录已经处理到 seq 的哪个位置
+    seq = [bos_id] + list(left_prefix or [])
+    limit = len(seq) - 1 + max_len
+    if target_len is not None:
+        limit = min(limit, target_len)
+    max_positions = min(model.max_positions, draft_model.max_positions)
+    # grammar 只用于掩码；tracker 跟踪按住的音（收尾、补 note_off），规则与 sample_generate_batch 相同
+    tracker = make_tracker(grammar, deadline, src.device)
+    state = tracker.feed(tracker.init_state(), seq[1:]) if tracker is not None else None
+    proposed, accepted = 0, 0
+    wrapping, deadline_hit = False, False
+    t0 = time.monotonic()
+    start_len = len(seq)
+
+    while len(seq) - 1 < limit:
+        if cancel is not None:
+            cancel.check()
+        if deadline is not None:
+            now = time.monotonic()
+            if now >= deadline:
+                deadline_hit = True
+                print(f"到达时间预算，在第 {len(seq) - start_len} 个 token 处截断")
+                break
+            done = len(seq) - start_len
+            if not wrapping and done and now + wrapup_steps * (now - t0) / done >= deadline:
+                wrapping = deadline_hit = True
+
+        k = min(num_draft, limit - (len(seq) - 1), max_positions - len(seq))
+        if k <= 0:
+            break
+        base = len(seq)
+
+        # 1) 草稿模型逐个提出 k 个 token
+        draft_tokens, draft_probs = [], []
+        # states[i] 是第 i 个草稿位置之前的语法状态，验证时主模型在同一状态下做掩码
+        states = [state.clone()] if tracker is not None else [None]
+        pending = seq[draft_model.cache_len(draft_cache):]
+        for i in range(k):
+            step = torch.tensor([pending], dtype=torch.long, device=src.device)
+            history = torch.tensor(seq + draft_tokens, dtype=torch.long, device=src.device)
+            q = _probs(draft_model.decode(step, draft_memory, src_padding_mask, draft_cache)[0, -1], sampler, history,
+                       grammar, states[-1])
+            token = sampler.draw(q).item()
+            draft_tokens.append(token)
+            draft_probs.append(q)
+            if tracker is not None:
+                states.append(tracker.update(states[-1].clone(), torch.tensor([token], device=src.device)))
+            else:
+                states.append(None)
+            if token == eos_id:
+                break
+            pending = [token]
+        k = len(draft_tokens)
+
+        # 2) 主模型一次前向验证所有草稿 token：取最后 k+1 个位置的分布
+        feed = seq[model.cache_len(cache):] + draft_tokens
+        step = torch.tensor([feed], dtype=torch.long, device=src.device)
+        target_logits = model.decode(step, memory, src_padding_mask, cache)[0, -(k + 1):]
+        history = torch.tensor(seq + draft_tokens, dtype=torch.long, device=src.device)
+        p_all = [_probs(target_logits[i], sampler, history[:base + i], grammar, states[i]) for i in range(k + 1)]
+
+        # 3) 按接受规则逐个检查
+        n = 0
+        next_token = None
+        for i, token in enumerate(draft_tokens):
+            p, q = p_all[i], draft_probs[i]
+            if sampler.uniform(p.device).item() * q[token].item() < p[token].item():
+                n += 1
+                continue
+            residual = torch.clamp(p - q, min=0)
+            if residual.sum().item() <= 0:
+                residual = p
+            next_token = sampler.draw(residual / residual.sum()).item()
+            break
+        if next_token is None and draft_tokens[-1] != eos_id:
+            next_token = sampler.draw(p_all[k]).item()
+        proposed += k
+        accepted += n
+
+        new_tokens = draft_tokens[:n] + ([next_token] if next_token is not None else [])
+        if tracker is not None:
+            state = states[n]
+            if next_token is not None:
+                tracker.update(state, torch.tensor([next_token], device=src.device))
+        if eos_id in new_tokens:
+            seq.extend(new_tokens[:new_tokens.index(eos_id)])
+            break
+        seq.extend(new_tokens)
+        if on_preview is not None and len(seq) - len(new_tokens) - start_len < preview_steps <= len(seq) - start_len:
+            on_preview(seq[1:])
+        if wrapping and state is not None and tracker.resting(state, torch.tensor([seq[-1]], device=src.device)).item():
+            break
+        if state is not None and len(seq) - 1 + tracker.closing_len(state).item() + 2 >= limit:
+            break  # 收尾补的 note_off 也算在 limit 内，剩下的位置不够再按下一个音
+
+        # 4) 回退缓存：只保留已接受的前缀，被拒绝的草稿 token 的 K/V 丢弃
+        model.truncate_cache(cache, base + n)
+        draft_model.truncate_cache(draft_cache, min(draft_model.cache_len(draft_cache), base + n))
+
+    if proposed:
+        print(f"推测解码接受率: {accepted}/{proposed} ({accepted / proposed:.1%})")
+    elapsed = time.monotonic() - t0
+    # 与 sample_generate_batch 一样按主模型记录解码速度，供调度器估计耗时和 Retry-After
+    throughput.record(getattr(model, 'model_id', id(model)), len(seq) - start_len, elapsed)
+    if stats is not None:
+        stats.update(steps=len(seq) - start_len, elapsed=elapsed,
+                     steps_per_sec=(len(seq) - start_len) / max(elapsed, 1e-6), deadline_hit=deadline_hit)
+    generated = seq[1:limit + 1]
+    if tracker is not None:
+        # 被截断时补上 note_off，总长度（含补上的 note_off）不超过 limit；
+        # 最后一轮多接受的 token 被截掉时状态要按截断后的序列重算
+        keep = max(tracker.fit_len(seq[1:], limit), start_len - 1)  # 用户给的前缀不截
+        if keep < len(seq) - 1:
+            generated = seq[1:keep + 1]
+            state = tracker.feed(tracker.init_state(), generated)
+        generated += tracker.closing_tokens(state)
+    return generated
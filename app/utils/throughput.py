@@ -0,0 +1,43 @@
+import threading
+
+# ========== 解码速度估计 ==========
+'''
+按模型记录最近的解码速度（每秒解码步数，指数滑动平均），用于：
+    - 带时间预算的生成：估计剩余时间还能解码多少步，提前进入收尾
+    - 调度与准入：由 target_len 估计一个任务要跑多久
+没有测量值时使用 default_steps_per_sec。
+'''
+
+class ThroughputEstimator:
+    def __init__(self, default_steps_per_sec=100.0, smoothing=0.3):
+        self.default_steps_per_sec = default_steps_per_sec
+        self.smoothing = smoothing
+        self._rates = {}
+        self._lock = threading.Lock()
+
+    def record(self, model_id, steps, seconds):
+        if steps <= 0 or seconds <= 0:
+            return
+        rate = steps / seconds
+        with self._lock:
+            old = self._rates.get(model_id)
+            self._rates[model_id] = rate if old is None else (1 - self.smoothing) * old + self.smoothing * rate
+
+    def steps_per_sec(self, model_id=None):
+        with self._lock:
+            if model_id in self._rates:
+                return self._rates[model_id]
+            if model_id is None and self._rates:
+                return sum(self._rates.values()) / len(self._rates)
+        return self.default_steps_per_sec
+
+    def estimate_seconds(self, steps, model_id=None):
+        """解码 steps 步预计需要的秒数"""
+        return steps / self.steps_per_sec(model_id)
+
+    def steps_within(self, seconds, model_id=None):
+        """seconds 秒内预计能解码的步数"""
+        return int(seconds * self.steps_per_sec(model_id))
+
+
+throughput = ThroughputEstimator()
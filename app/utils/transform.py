@@ -2,6 +2,9 @@ import subprocess
 import os
 import platform
 from app.config.config import Config
+from app.utils.result_cache import result_cache
+from app.utils.cancellation import GenerationCancelled
+from app.utils.musescore_batch import musescore_batcher
 def find_musescore_executable():
     if platform.system() == "Windows":
         return Config.MUSESCORE_PATH_WINDOWS
@@ -17,6 +20,14 @@ def split_midi(input_file, output_file, musescore_path=None):
     # 2) 确定 MuseScore CLI 路径
     mscore =find_musescore_executable()
 
+    # 与同一时间窗口内的其它转换合并成一次 MuseScore 调用
+    if Config.MUSESCORE_BATCH_WINDOW > 0:
+        if musescore_batcher.convert(mscore, input_file, output_file):
+            print(f"✅ 导出成功：{output_file}")
+            return True
+        print(f"❌ MuseScore 导出失败：{output_file}")
+        return False
+
     # 3) 构造命令列表，交给 subprocess.run 自动处理路径
     cmd = [
         mscore,
@@ -37,7 +48,25 @@ def split_midi(input_file, output_file, musescore_path=None):
         print(f"❌ MuseScore 导出失败，错误码 {e.returncode}")
         return False
 
-def export_pdf(input_file, output_file, musescore_path=None):
+def run_cancellable(cmd, cancel, poll_interval=0.01):
+    """
+    运行子进程，每 poll_interval 秒检查一次 cancel；取消时结束子进程并抛出 GenerationCancelled
+    返回码非 0 时与 subprocess.run(check=True) 一样抛出 CalledProcessError
+    """
+    process = subprocess.Popen(cmd, shell=False)
+    while True:
+        try:
+            returncode = process.wait(timeout=poll_interval)
+            break
+        except subprocess.TimeoutExpired:
+            if cancel.cancelled:
+                process.kill()
+                process.wait()
+                cancel.check()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+def export_pdf(input_file, output_file, musescore_path=None, use_cache=True, cancel=None):
     """
     使用MuseScore将MIDI文件导出为PDF格式
     
@@ -45,6 +74,8 @@ def export_pdf(input_file, output_file, musescore_path=None):
         input_file (str): 输入MIDI文件路径
         output_file (str): 输出PDF文件路径
         musescore_path (str, 可选): MuseScore可执行文件路径
+        use_cache (bool): 相同内容的MIDI已导出过时直接取缓存的PDF，不再运行MuseScore
+        cancel (CancellationToken, 可选): 取消时不再等待（单独运行 MuseScore 时结束进程）、删除未写完的PDF并抛出 GenerationCancelled
     
     返回:
         bool: 成功返回True，失败返回False
@@ -54,6 +85,13 @@ def export_pdf(input_file, output_file, musescore_path=None):
         print(f"❌ 输入文件不存在: {input_file}")
         return False
 
+    cache_key = None
+    if use_cache:
+        with open(input_file, 'rb') as f:
+            cache_key = result_cache.make_key(f.read(), kind='pdf')
+        if result_cache.fetch(cache_key, '.pdf', output_file):
+            return True
+
     # 2) 确定 MuseScore CLI 路径
     mscore = musescore_path or find_musescore_executable()
 
@@ -66,8 +104,23 @@ def export_pdf(input_file, output_file, musescore_path=None):
 
     try:
         print(f"▶ 正在导出PDF：{cmd}")
-        subprocess.run(cmd, shell=False, check=True)
+        if Config.MUSESCORE_BATCH_WINDOW > 0 and musescore_path is None:
+            # 与同一时间窗口内的其它转换合并成一次 MuseScore 调用
+            if not musescore_batcher.convert(mscore, input_file, output_file, cancel=cancel):
+                print(f"❌ MuseScore PDF导出失败：{output_file}")
+                return False
+        elif cancel is not None:
+            try:
+                run_cancellable(cmd, cancel)
+            except GenerationCancelled:
+                if os.path.exists(output_file):
+                    os.remove(output_file)
+                raise
+        else:
+            subprocess.run(cmd, shell=False, check=True)
         print(f"✅ PDF导出成功：{output_file}")
+        if cache_key is not None and os.path.isfile(output_file):
+            result_cache.put(cache_key, '.pdf', output_file)
         return True
     except FileNotFoundError:
         print(f"❌ 找不到 MuseScore 可执行文件: {mscore}")
@@ -1,3 +1,4 @@
+import io
 import mido
 import numpy as np
 from collections import defaultdict
@@ -105,20 +106,183 @@ def event_to_midi(events,quantization=10):
     return track
 
 
+def event_onsets(events):
+    """返回所有 note_on 事件的绝对时间（量化单位）"""
+    onsets = []
+    time = 0
+    for msg_type, val in events:
+        if msg_type == "shift_time":
+            time += val
+        elif msg_type == "note_on":
+            onsets.append(time)
+    return onsets
+
+def onset_alignment(right_events, left_events, tolerance=2):
+    """
+    左手与右手的节奏对齐度：左手起音时刻中，与某个右手起音相差不超过 tolerance 个量化单位的比例
+    左手没有音符时返回 0
+    """
+    right_onsets = set(event_onsets(right_events))
+    left_onsets = event_onsets(left_events)
+    if not left_onsets:
+        return 0.0
+    matched = sum(1 for t in left_onsets
+                  if any(t + d in right_onsets for d in range(-tolerance, tolerance + 1)))
+    return matched / len(left_onsets)
+
+
+def events_to_timeline(events):
+    """事件序列 → [(绝对时间, 事件)]，只保留 note_on / note_off，时间为量化单位"""
+    timeline = []
+    time = 0
+    for event in events:
+        if event[0] == "shift_time":
+            time += event[1]
+        elif event[0] in ["note_on", "note_off"]:
+            timeline.append((time, event))
+    return timeline
+
+def track_to_timeline(track, quantization=10):
+    """MIDI 音轨 → [(绝对时间, 事件)]，与 events_to_timeline(midi_to_event(track)) 不同，长休止不会被截断"""
+    timeline = []
+    ticks = 0
+    for msg in track:
+        ticks += msg.time
+        if msg.type in ["note_on", "note_off"]:
+            msg_type = "note_off" if msg.type == "note_off" or msg.velocity == 0 else "note_on"
+            timeline.append((ticks // quantization, (msg_type, msg.note)))
+    return timeline
+
+def timeline_to_events(timeline, start=0, quantization=10, max_time=1500):
+    """
+    [(绝对时间, 事件)] → shift_time 与音符事件交替的序列（不含 bos/eos），时间相对 start
+    间隔超过 max_time 时与 midi_to_event 一样截断；max_time=None 时不截断（只用于直接写 MIDI，不能转成 token）
+    """
+    events = []
+    last = start
+    for time, event in timeline:
+        shift = max(time - last, 0)
+        if max_time is not None:
+            shift = min(shift, max_time // quantization)
+        events.append(("shift_time", shift))
+        events.append(event)
+        last = time
+    return events
+
+def event_windows(num_events, window_size, overlap):
+    """
+    把 num_events 个事件切成相邻重叠 overlap 个事件的窗口，每个窗口最多 window_size 个事件
+    返回 [(起始下标, 结束下标)]（左闭右开）
+    """
+    overlap = min(overlap, window_size - 1)
+    windows = []
+    lo = 0
+    while True:
+        hi = min(lo + window_size, num_events)
+        windows.append((lo, hi))
+        if hi >= num_events:
+            return windows
+        lo = hi - overlap
+
+def split_sections(timeline, rest_units=100, max_units=2000, min_events=8):
+    """
+    把时间轴切成乐句大小的段落，返回 [(起始下标, 结束下标)]（左闭右开）
+    相邻事件间隔不小于 rest_units（长休止）处切开；段落时长超过 max_units 时在下一个事件处强制切开；
+    不足 min_events 个事件的段落不单独切出
+    """
+    sections = []
+    lo = 0
+    for i in range(1, len(timeline)):
+        if i - lo < min_events:
+            continue
+        gap = timeline[i][0] - timeline[i - 1][0]
+        if gap >= rest_units or timeline[i][0] - timeline[lo][0] >= max_units:
+            sections.append((lo, i))
+            lo = i
+    if timeline:
+        sections.append((lo, len(timeline)))
+    return sections
+
+def held_notes(timeline, time):
+    """时间轴在 time 时刻（不含）仍按住的音"""
+    held = set()
+    for t, (msg_type, note) in timeline:
+        if t >= time:
+            break
+        if msg_type == "note_on":
+            held.add(note)
+        else:
+            held.discard(note)
+    return held
+
+def close_timeline(timeline, end=None, keep=()):
+    """
+    修复拼接后的时间轴：重复按下同一个音时先松开，松开没按下的音直接丢弃，结尾补齐 note_off
+    end: 补齐的 note_off 所在的时间，默认为最后一个事件的时间
+    keep: 结尾不补 note_off 的音（后面还会接上松开它们的事件）
+    """
+    fixed = []
+    held = set()
+    for time, (msg_type, note) in timeline:
+        if msg_type == "note_on":
+            if note in held:
+                fixed.append((time, ("note_off", note)))
+            held.add(note)
+            fixed.append((time, (msg_type, note)))
+        elif note in held:
+            held.discard(note)
+            fixed.append((time, (msg_type, note)))
+    if end is None:
+        end = fixed[-1][0] if fixed else 0
+    for note in sorted(held - set(keep)):
+        fixed.append((end, ("note_off", note)))
+    return fixed
+
+
+def seconds_to_units(mid, seconds, quantization=10):
+    """秒 → 量化单位（与 midi_to_event 的时间单位一致），速度取第一个 set_tempo，没有时为 500000 μs/beat"""
+    tempo = 500000
+    for tr in mid.tracks:
+        for msg in tr:
+            if msg.type == 'set_tempo':
+                tempo = msg.tempo
+                break
+        else:
+            continue
+        break
+    return int(second2tick(seconds, mid.ticks_per_beat, tempo)) // quantization
+
+
 def parse_timecode(tc: str) -> float:
     """把 'MM:SS' 形式转换成秒（float）."""
     m, s = tc.split(':')
     return int(m) * 60 + float(s)
 
-def slice_midi(input_path: str, output_path: str, start_tc: str, end_tc: str):
+def load_midi(source):
+    """source 可以是文件路径、MIDI 文件内容（bytes）或已打开的文件对象（如上传的文件流）"""
+    if isinstance(source, MidiFile):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return MidiFile(file=io.BytesIO(source))
+    if hasattr(source, 'read'):
+        return MidiFile(file=source)
+    return MidiFile(source)
+
+def midi_to_bytes(mid):
+    """把 MidiFile 序列化为 bytes（不经过磁盘）"""
+    buffer = io.BytesIO()
+    mid.save(file=buffer)
+    return buffer.getvalue()
+
+def slice_midi_file(mid, start_tc: str, end_tc: str):
+    """截取 MidiFile 中 start_tc ~ end_tc（MM:SS）之间的部分，返回新的 MidiFile"""
     # 1) 解析时间码
     start_sec = parse_timecode(start_tc)
     end_sec   = parse_timecode(end_tc)
     if end_sec <= start_sec:
         raise ValueError("结束时间必须大于起始时间。")
 
-    # 2) 载入 MIDI，获取 ticks_per_beat
-    mid = MidiFile(input_path)
+    # 2) 获取 ticks_per_beat
     tpq = mid.ticks_per_beat
 
     # 3) 找到第一个 set_tempo，若无则使用默认 500000 μs/beat
@@ -168,8 +332,11 @@ def slice_midi(input_path: str, output_path: str, start_tc: str, end_tc: str):
                 new_tr.append(msg.copy(time=delta))
                 prev_tick = abs_tick
         new_mid.tracks.append(new_tr)
+    return new_mid
 
-    # 6) 写出新文件
+def slice_midi(input_path, output_path: str, start_tc: str, end_tc: str):
+    """截取 input_path（路径 / bytes / 文件对象）中的时间区间并保存到 output_path"""
+    new_mid = slice_midi_file(load_midi(input_path), start_tc, end_tc)
     new_mid.save(output_path)
     print(f"已生成截取文件：{output_path}")
 
@@ -0,0 +1,115 @@
+import io
+import os
+import sys
+import json
+import time
+import zipfile
+import argparse
+import tempfile
+import requests
+
+# ========== 批量生成命令行客户端 ==========
+'''
+把一个目录（递归查找 .mid / .midi）或一个 zip 交给服务器的 /batch 接口，结果解压到输出目录：
+    python batch_client.py 右手目录 -o 结果目录 --target-len 800 --seed 1 --pdf
+文件很多时按 --per-request 个一组分多次请求（服务器单次上限见 Config.BATCH_MAX_FILES），
+每组的 manifest 合并成输出目录下的 manifest.json，最后打印成功 / 失败数。
+'''
+
+
+def collect_files(path):
+    """返回 [(相对路径, bytes)]"""
+    if os.path.isfile(path) and zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            return [(info.filename, archive.read(info)) for info in archive.infolist()
+                    if not info.is_dir() and info.filename.lower().endswith(('.mid', '.midi'))]
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            return [(os.path.basename(path), f.read())]
+    entries = []
+    for root, _, names in os.walk(path):
+        for name in sorted(names):
+            if name.lower().endswith(('.mid', '.midi')) and not name.startswith('.'):
+                full_path = os.path.join(root, name)
+                with open(full_path, 'rb') as f:
+                    entries.append((os.path.relpath(full_path, path).replace(os.sep, '/'), f.read()))
+    return entries
+
+
+def pack(entries):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+        for name, data in entries:
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def run_group(server, entries, params, out_dir, timeout):
+    """发送一组文件，流式接收结果 zip 并解压，返回这一组的 manifest"""
+    files = {'file': ('batch.zip', pack(entries), 'application/zip')}
+    with requests.post(f"{server.rstrip('/')}/batch", files=files, data=params, stream=True, timeout=timeout) as response:
+        if response.status_code != 200:
+            raise RuntimeError(f"服务器返回 {response.status_code}: {response.text[:200]}")
+        with tempfile.TemporaryFile() as result:
+            for chunk in response.iter_content(chunk_size=1 << 16):
+                result.write(chunk)
+            result.seek(0)
+            with zipfile.ZipFile(result) as archive:
+                manifest = json.loads(archive.read('manifest.json'))
+                for info in archive.infolist():
+                    if info.filename != 'manifest.json':
+                        archive.extract(info, out_dir)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量生成左手伴奏（调用服务器的 /batch 接口）")
+    parser.add_argument('input', help="右手 MIDI 所在目录、zip 或单个文件")
+    parser.add_argument('-o', '--out', default='batch_results', help="结果目录")
+    parser.add_argument('--server', default='http://localhost:5000')
+    parser.add_argument('--target-len', type=int, default=800)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--full-length', action='store_true', help="生成覆盖整首曲子的左手")
+    parser.add_argument('--pdf', action='store_true', help="同时导出乐谱")
+    parser.add_argument('--per-request', type=int, default=200, help="每次请求的文件数")
+    parser.add_argument('--timeout', type=float, default=3600, help="每次请求的超时（秒）")
+    args = parser.parse_args()
+
+    entries = collect_files(args.input)
+    if not entries:
+        print(f"没有找到MIDI文件: {args.input}")
+        return 1
+    os.makedirs(args.out, exist_ok=True)
+    params = {'target_len': str(args.target_len)}
+    if args.seed is not None:
+        params['seed'] = str(args.seed)
+    if args.full_length:
+        params['full_length'] = '1'
+    if args.pdf:
+        params['pdf'] = '1'
+
+    started = time.monotonic()
+    files = []
+    for start in range(0, len(entries), args.per_request):
+        group = entries[start:start + args.per_request]
+        print(f"发送第 {start + 1}-{start + len(group)} 个文件（共 {len(entries)} 个）")
+        try:
+            files.extend(run_group(args.server, group, params, args.out, args.timeout)['files'])
+        except Exception as e:
+            print(f"❌ 这一组失败: {str(e)}")
+            files.extend({'name': name, 'status': 'failed', 'error': str(e)} for name, _ in group)
+
+    succeeded = sum(1 for item in files if item['status'] == 'ok')
+    summary = {'total': len(files), 'succeeded': succeeded, 'failed': len(files) - succeeded,
+               'elapsed': time.monotonic() - started, 'files': files}
+    with open(os.path.join(args.out, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    print(f"完成：成功 {succeeded} 个，失败 {len(files) - succeeded} 个，耗时 {summary['elapsed']:.1f}s，结果在 {args.out}")
+    for item in files:
+        if item['status'] != 'ok':
+            print(f"  失败: {item['name']}（{item.get('error', '')}）")
+    return 0 if succeeded == len(files) else 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
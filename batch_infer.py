@@ -0,0 +1,187 @@
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import torch
+from app.config.config import Config
+from app.utils.batch import output_names, plan_chunks, token_count, MIDI_EXTENSIONS
+
+# ========== 离线批量生成 ==========
+'''
+不经过 Web 服务，在本机为整个曲库重新生成左手：
+    python batch_infer.py 右手目录（或清单文件） -o 输出目录 --workers 2 --batch-size 8 --target-len 800
+    - 输入为目录（递归查找 .mid / .midi）或清单文件（.txt 每行一个路径，.json 为路径列表）
+    - 按右手长度排序后每 batch-size 首一组，由 infer_batch 在同一个 KV 缓存解码循环里同时生成；
+      各组分给 workers 个工作进程（spawn 启动，各自以 mmap 方式加载同一个模型文件，每个进程
+      torch 线程数为 CPU 核数 / workers）
+    - 每完成一组，把其中每个文件的结果追加到 输出目录/progress.jsonl 并落盘；中断后用同样的命令重新运行，
+      已成功（且输出文件存在）的文件会被跳过，失败的会重试；--restart 忽略已有进度
+    - 结束时写出 输出目录/summary.json：成功 / 失败 / 跳过的文件数、生成的 token 数、tokens/sec
+输出文件为 输出目录/<相对路径>/converted_<文件名>.mid，与 /batch 接口的命名一致。
+'''
+
+PROGRESS_FILE = 'progress.jsonl'
+SUMMARY_FILE = 'summary.json'
+
+
+def collect_inputs(path):
+    """返回 [(相对名称, 文件路径)]，相对名称用于输出文件的目录结构和进度记录"""
+    if os.path.isdir(path):
+        paths = []
+        for root, _, names in os.walk(path):
+            paths.extend(os.path.join(root, name) for name in sorted(names)
+                         if name.lower().endswith(MIDI_EXTENSIONS) and not name.startswith('.'))
+        root = path
+    else:
+        base = os.path.dirname(os.path.abspath(path))
+        with open(path, 'r', encoding='utf-8') as f:
+            if path.lower().endswith('.json'):
+                listed = json.load(f)
+            else:
+                listed = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+        # 清单中的相对路径相对于清单文件所在目录
+        paths = [item if os.path.isabs(item) else os.path.join(base, item) for item in listed]
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in paths]) if paths else base
+    return [(os.path.relpath(p, root).replace(os.sep, '/'), p) for p in sorted(paths)]
+
+
+def load_progress(out_dir):
+    """已成功的文件：{相对名称: 记录}，输出文件不存在的不算"""
+    done = {}
+    progress_path = os.path.join(out_dir, PROGRESS_FILE)
+    if not os.path.exists(progress_path):
+        return done
+    with open(progress_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # 崩溃时写了一半的最后一行
+            if record.get('status') == 'ok' and os.path.exists(os.path.join(out_dir, record['output'])):
+                done[record['name']] = record
+            else:
+                done.pop(record.get('name'), None)
+    return done
+
+
+def _init_worker(model_path, threads):
+    torch.set_num_threads(threads)
+    Config.MODEL_PATH, Config.MODEL_NAME = os.path.split(os.path.abspath(model_path))
+
+
+def _run_chunk(items, out_dir, options):
+    """在工作进程中生成一组：items 为 [(相对名称, 输入路径, 输出相对路径)]，返回每个文件的记录"""
+    from app.utils.infer import infer_batch
+    started = time.monotonic()
+    sources = []
+    for _, path, _ in items:
+        with open(path, 'rb') as f:
+            sources.append(f.read())
+    results = infer_batch(sources, model_name=Config.MODEL_NAME, temperature=options['temperature'],
+                          target_len=options['target_len'], top_k=options['top_k'], top_p=options['top_p'],
+                          repetition_penalty=options['repetition_penalty'], seed=options['seed'],
+                          full_length=options['full_length'], window_tokens=Config.WINDOW_TOKENS,
+                          window_overlap=Config.WINDOW_OVERLAP_TOKENS)
+    elapsed = time.monotonic() - started
+    records = []
+    for (name, _, output), result in zip(items, results):
+        if not result:
+            records.append({'name': name, 'status': 'failed', 'error': 'MIDI处理失败，可能是文件格式不正确'})
+            continue
+        # 先写临时文件再替换，崩溃时不会留下写了一半的输出
+        output_path = os.path.join(out_dir, output)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(output_path + '.tmp', 'wb') as f:
+            f.write(result['midi_bytes'])
+        os.replace(output_path + '.tmp', output_path)
+        records.append({'name': name, 'status': 'ok', 'output': output, 'num_tokens': result['num_tokens'],
+                        'elapsed': elapsed})
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线批量生成左手伴奏（可中断后继续）")
+    parser.add_argument('input', help="右手 MIDI 所在目录，或清单文件（.txt / .json）")
+    parser.add_argument('-o', '--out', required=True, help="输出目录（同时保存进度）")
+    parser.add_argument('--model', default=os.path.join(Config.MODEL_PATH, Config.MODEL_NAME), help="模型 checkpoint")
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 1) // 4), help="工作进程数")
+    parser.add_argument('--batch-size', type=int, default=Config.BATCH_DECODE_SIZE, help="一组同时解码的曲子数")
+    parser.add_argument('--target-len', type=int, default=800)
+    parser.add_argument('--full-length', action='store_true', help="生成覆盖整首曲子的左手（分窗生成）")
+    parser.add_argument('--temperature', type=float, default=Config.TEMPERATURE)
+    parser.add_argument('--top-k', type=int, default=Config.SAMPLING_TOP_K)
+    parser.add_argument('--top-p', type=float, default=Config.SAMPLING_TOP_P)
+    parser.add_argument('--repetition-penalty', type=float, default=Config.REPETITION_PENALTY)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--restart', action='store_true', help="忽略已有进度，全部重新生成")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.model):
+        print(f"错误: 模型文件不存在 - {args.model}")
+        return 1
+    inputs = collect_inputs(args.input)
+    if not inputs:
+        print(f"没有找到MIDI文件: {args.input}")
+        return 1
+    os.makedirs(args.out, exist_ok=True)
+    progress_path = os.path.join(args.out, PROGRESS_FILE)
+    if args.restart and os.path.exists(progress_path):
+        os.remove(progress_path)
+    done = load_progress(args.out)
+
+    names = output_names([(name, None) for name, _ in inputs])
+    pending = [(name, path, midi_name) for (name, path), (midi_name, _) in zip(inputs, names) if name not in done]
+    print(f"共 {len(inputs)} 个文件，已完成 {len(inputs) - len(pending)} 个，本次生成 {len(pending)} 个")
+    options = {'target_len': args.target_len, 'full_length': args.full_length, 'temperature': args.temperature,
+               'top_k': args.top_k, 'top_p': args.top_p, 'repetition_penalty': args.repetition_penalty,
+               'seed': args.seed}
+
+    started = time.monotonic()
+    counts = [token_count(path) for _, path, _ in pending]
+    chunks = [[pending[i] for i in chunk] for chunk in plan_chunks(counts, max(1, args.batch_size))]
+    threads = max(1, (os.cpu_count() or 1) // args.workers)
+    succeeded, failed, tokens = 0, 0, 0
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker, initargs=(args.model, threads)) as pool, \
+            open(progress_path, 'a', encoding='utf-8') as progress:
+        futures = {pool.submit(_run_chunk, chunk, args.out, options): chunk for chunk in chunks}
+        try:
+            for future in as_completed(futures):
+                try:
+                    records = future.result()
+                except Exception as e:
+                    print(f"❌ 一组生成失败: {str(e)}")
+                    records = [{'name': name, 'status': 'failed', 'error': str(e)} for name, _, _ in futures[future]]
+                for record in records:
+                    progress.write(json.dumps(record, ensure_ascii=False) + '\n')
+                    if record['status'] == 'ok':
+                        succeeded += 1
+                        tokens += record['num_tokens']
+                    else:
+                        failed += 1
+                        print(f"  失败: {record['name']}（{record['error']}）")
+                progress.flush()
+                os.fsync(progress.fileno())
+                elapsed = time.monotonic() - started
+                print(f"[{succeeded + failed}/{len(pending)}] {tokens / max(elapsed, 1e-6):.1f} tokens/s")
+        except KeyboardInterrupt:
+            print("已中断，进度已保存，重新运行同样的命令即可继续")
+            pool.shutdown(wait=False, cancel_futures=True)
+            return 130
+
+    elapsed = time.monotonic() - started
+    summary = {'total': len(inputs), 'skipped': len(inputs) - len(pending), 'succeeded': succeeded, 'failed': failed,
+               'generated_tokens': tokens, 'elapsed': elapsed, 'tokens_per_sec': tokens / max(elapsed, 1e-6),
+               'workers': args.workers, 'batch_size': args.batch_size, 'threads_per_worker': threads}
+    with open(os.path.join(args.out, SUMMARY_FILE), 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    print(f"完成：成功 {succeeded} 个，失败 {failed} 个，跳过 {summary['skipped']} 个；"
+          f"生成 {tokens} 个 token，耗时 {elapsed:.1f}s，{summary['tokens_per_sec']:.1f} tokens/s")
+    return 0 if failed == 0 else 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
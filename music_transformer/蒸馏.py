@@ -0,0 +1,272 @@
+# 知识蒸馏训练脚本
+# 以现有的 6+6 层 Seq2SeqTransformer 作为教师，在同一份 npy 语料上训练一个更小的学生模型，
+# 学生模型用于 CPU 推理（也可作为推测解码的草稿模型）
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.optim as optim
+from torch.utils.data import DataLoader
+import matplotlib.pyplot as plt
+import argparse
+import importlib.util
+import time
+import os
+from tqdm import tqdm
+from music_transformer import Seq2SeqTransformer, NumpySeq2SeqDataset, split_dataset
+'''
+损失 = alpha * KL(教师软标签 || 学生) * T^2 + (1 - alpha) * 真实左手的交叉熵
+温度 T 越大，教师分布越平滑，学生能学到更多"次优 token"之间的相对关系。
+导出的学生 checkpoint 只含 model_state_dict 和 model_config，app/utils/infer.py 可以直接加载。
+'''
+
+# ================== 学生模型 ===================
+def build_student(vocab_size=410, d_model=256, nhead=4, num_encoder_layers=3, num_decoder_layers=2,
+                  dim_feedforward=1024, max_len=4000, max_relative_position=512):
+    config = {
+        'vocab_size': vocab_size,
+        'd_model': d_model,
+        'nhead': nhead,
+        'num_encoder_layers': num_encoder_layers,
+        'num_decoder_layers': num_decoder_layers,
+        'dim_feedforward': dim_feedforward,
+        'max_len': max_len,
+        'max_relative_position': max_relative_position,
+    }
+    return Seq2SeqTransformer(**config), config
+
+def init_student_from_teacher(student, teacher):
+    """d_model 相同时，复制教师的嵌入、编码器前几层和输出层，加快收敛"""
+    teacher_state = teacher.state_dict()
+    student_state = student.state_dict()
+    copied = 0
+    for name, param in student_state.items():
+        if name in teacher_state and teacher_state[name].shape == param.shape:
+            student_state[name] = teacher_state[name].clone()
+            copied += 1
+    student.load_state_dict(student_state)
+    print(f"从教师模型复制了 {copied}/{len(student_state)} 个参数张量")
+
+# ================== 蒸馏损失 ===================
+def distill_loss(student_logits, teacher_logits, tgt_output, pad_id=2, alpha=0.7, temperature=2.0):
+    vocab_size = student_logits.size(-1)
+    valid = (tgt_output != pad_id).reshape(-1)
+    s = student_logits.reshape(-1, vocab_size)[valid]
+    t = teacher_logits.reshape(-1, vocab_size)[valid]
+
+    soft_loss = F.kl_div(F.log_softmax(s / temperature, dim=-1),
+                         F.softmax(t / temperature, dim=-1),
+                         reduction='batchmean') * temperature ** 2
+    hard_loss = F.cross_entropy(s, tgt_output.reshape(-1)[valid])
+    return alpha * soft_loss + (1 - alpha) * hard_loss
+
+# ================== 训练 ===================
+def export_student(student, config, path):
+    torch.save({
+        'model_state_dict': student.state_dict(),
+        'model_config': config,
+    }, path)
+
+def distill_train(teacher, student, config, train_loader, val_loader, num_epochs=20, pad_id=2,
+                  alpha=0.7, temperature=2.0, lr=1e-4, ckpt_path="student.pt",
+                  plt_pth=r"autodl-tmp/event/distill.png"):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    teacher.to(device).eval()
+    student.to(device)
+    optimizer = optim.Adam(student.parameters(), lr=lr)
+    scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min', factor=0.5, patience=3)
+    loss_fn = nn.CrossEntropyLoss(ignore_index=pad_id)
+
+    best_val_loss = float('inf')
+    train_losses, val_losses = [], []
+
+    for epoch in range(num_epochs):
+        student.train()
+        total_train_loss = 0
+        for src, tgt in tqdm(train_loader, desc=f"Epoch {epoch + 1}/{num_epochs}"):
+            src, tgt = src.to(device), tgt.to(device)
+            if (src != pad_id).sum().item() == 0 or (tgt != pad_id).sum().item() == 0:
+                continue  # 跳过全是PAD的batch
+            tgt_input, tgt_output = tgt[:, :-1], tgt[:, 1:]
+            tgt_mask = torch.triu(torch.ones(tgt_input.size(1), tgt_input.size(1), device=device), 1).bool()
+            src_padding_mask = (src == pad_id)
+            tgt_padding_mask = (tgt_input == pad_id)
+
+            with torch.no_grad():
+                teacher_logits = teacher(src, tgt_input, tgt_mask, src_padding_mask, tgt_padding_mask)
+            student_logits = student(src, tgt_input, tgt_mask, src_padding_mask, tgt_padding_mask)
+            loss = distill_loss(student_logits, teacher_logits, tgt_output, pad_id, alpha, temperature)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total_train_loss += loss.item()
+
+        avg_train_loss = total_train_loss / len(train_loader)
+        train_losses.append(avg_train_loss)
+
+        # 验证：学生在真实左手上的交叉熵，与教师的 val_loss 可直接比较
+        student.eval()
+        total_val_loss = 0
+        with torch.no_grad():
+            for src, tgt in val_loader:
+                src, tgt = src.to(device), tgt.to(device)
+                if (src != pad_id).sum().item() == 0 or (tgt != pad_id).sum().item() == 0:
+                    continue
+                tgt_input, tgt_output = tgt[:, :-1], tgt[:, 1:]
+                tgt_mask = torch.triu(torch.ones(tgt_input.size(1), tgt_input.size(1), device=device), 1).bool()
+                logits = student(src, tgt_input, tgt_mask, src == pad_id, tgt_input == pad_id)
+                total_val_loss += loss_fn(logits.reshape(-1, logits.size(-1)), tgt_output.reshape(-1)).item()
+
+        avg_val_loss = total_val_loss / len(val_loader)
+        val_losses.append(avg_val_loss)
+        scheduler.step(avg_val_loss)
+        print(f"Epoch {epoch+1}/{num_epochs} - Distill Loss: {avg_train_loss:.4f}, Student Val Loss: {avg_val_loss:.4f}")
+
+        if avg_val_loss < best_val_loss:
+            best_val_loss = avg_val_loss
+            export_student(student, config, ckpt_path)
+            print("Saved new best student.")
+
+    plt.plot(train_losses, label='Distill Loss')
+    plt.plot(val_losses, label='Student Val Loss')
+    plt.xlabel("Epoch")
+    plt.ylabel("Loss")
+    plt.legend()
+    plt.title("Distillation")
+    plt.savefig(plt_pth)
+    plt.close()
+
+# ================== 质量与速度对比 ===================
+@torch.no_grad()
+def evaluate_quality(model, loader, pad_id=2, teacher=None):
+    """在留出集上计算交叉熵、token 准确率，以及（给定 teacher 时）与教师 top-1 的一致率"""
+    device = next(model.parameters()).device
+    model.eval()
+    total_loss, total_tokens, correct, agree = 0.0, 0, 0, 0
+    for src, tgt in loader:
+        src, tgt = src.to(device), tgt.to(device)
+        tgt_input, tgt_output = tgt[:, :-1], tgt[:, 1:]
+        tgt_mask = torch.triu(torch.ones(tgt_input.size(1), tgt_input.size(1), device=device), 1).bool()
+        logits = model(src, tgt_input, tgt_mask, src == pad_id, tgt_input == pad_id)
+        valid = tgt_output != pad_id
+        if valid.sum().item() == 0:
+            continue
+        total_loss += F.cross_entropy(logits[valid], tgt_output[valid], reduction='sum').item()
+        pred = logits.argmax(dim=-1)
+        correct += (pred[valid] == tgt_output[valid]).sum().item()
+        if teacher is not None:
+            teacher_pred = teacher(src, tgt_input, tgt_mask, src == pad_id, tgt_input == pad_id).argmax(dim=-1)
+            agree += (pred[valid] == teacher_pred[valid]).sum().item()
+        total_tokens += valid.sum().item()
+    total_tokens = max(total_tokens, 1)
+    avg_loss = total_loss / total_tokens
+    return {
+        'val_loss': avg_loss,
+        'perplexity': float(torch.exp(torch.tensor(avg_loss))),
+        'token_acc': correct / total_tokens,
+        'teacher_agreement': agree / total_tokens if teacher is not None else None,
+    }
+
+@torch.no_grad()
+def load_serving_model(model, config):
+    """把训练好的权重装进 app/utils/music_transformer.py 中的推理模型（带 KV 缓存的增量解码接口）"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app', 'utils', 'music_transformer.py')
+    spec = importlib.util.spec_from_file_location('serving_music_transformer', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    serving = module.Seq2SeqTransformer(**config)
+    serving.load_state_dict(model.state_dict())
+    return serving.eval()
+
+@torch.no_grad()
+def measure_decode_speed(model, config, src_len=1000, num_tokens=200, bos_id=0, pad_id=2):
+    """
+    与 infer() 相同的解码方式：编码一次右手，预先算好 cross-attn K/V，
+    之后每步只把新 token 送入 decoder（self-attn K/V 缓存），返回 tokens/sec
+    """
+    serving = load_serving_model(model, config)
+    device = next(serving.parameters()).device
+    src = torch.randint(3, config['vocab_size'], (1, src_len), device=device)
+    ys = torch.tensor([[bos_id]], dtype=torch.long, device=device)
+    start = time.perf_counter()
+    memory = serving.encode(src, src == pad_id)
+    cache = serving.new_cache(serving.cross_kv(memory))
+    for _ in range(num_tokens):
+        logits = serving.decode(ys, memory, src == pad_id, cache)[:, -1]
+        ys = logits.argmax(dim=-1, keepdim=True)
+    return num_tokens / (time.perf_counter() - start)
+
+def write_report(teacher_stats, student_stats, config, path):
+    """把对比结果写成 markdown 表格"""
+    speedup = student_stats['tokens_per_sec'] / teacher_stats['tokens_per_sec']
+    lines = [
+        "# 蒸馏学生模型 vs 教师模型",
+        "",
+        f"学生配置：{config}",
+        "",
+        "| 指标 | 教师 | 学生 |",
+        "| --- | --- | --- |",
+        f"| 留出集交叉熵 | {teacher_stats['val_loss']:.4f} | {student_stats['val_loss']:.4f} |",
+        f"| 困惑度 | {teacher_stats['perplexity']:.2f} | {student_stats['perplexity']:.2f} |",
+        f"| token 准确率 | {teacher_stats['token_acc']:.3f} | {student_stats['token_acc']:.3f} |",
+        f"| 与教师 top-1 一致率 | - | {student_stats['teacher_agreement']:.3f} |",
+        f"| CPU 增量解码速度 (tokens/s，KV 缓存) | {teacher_stats['tokens_per_sec']:.1f} | {student_stats['tokens_per_sec']:.1f} |",
+        "",
+        f"解码加速比（与 infer() 相同的解码方式）：{speedup:.2f}x",
+        "",
+    ]
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines))
+    print("\n".join(lines))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--teacher", default=r"autodl-tmp/5-24.pt", help="教师模型 checkpoint")
+    parser.add_argument("--src_npy", default=r"autodl-tmp/ndarray/from_freescore_right.npy")
+    parser.add_argument("--tgt_npy", default=r"autodl-tmp/ndarray/from_freescore_left.npy")
+    parser.add_argument("--out", default=r"autodl-tmp/event/student.pt", help="学生模型导出路径")
+    parser.add_argument("--report", default=r"autodl-tmp/event/distill_report.md", help="对比报告路径")
+    parser.add_argument("--d_model", type=int, default=256)
+    parser.add_argument("--nhead", type=int, default=4)
+    parser.add_argument("--encoder_layers", type=int, default=3)
+    parser.add_argument("--decoder_layers", type=int, default=2)
+    parser.add_argument("--dim_feedforward", type=int, default=1024)
+    parser.add_argument("--max_len", type=int, default=4000)
+    parser.add_argument("--epochs", type=int, default=20)
+    parser.add_argument("--alpha", type=float, default=0.7)
+    parser.add_argument("--temperature", type=float, default=2.0)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    dataset = NumpySeq2SeqDataset(args.src_npy, args.tgt_npy, max_len=args.max_len)
+    # 固定随机种子划分，保证留出集可复现
+    torch.manual_seed(0)
+    train_dataset, val_dataset = split_dataset(dataset, val_ratio=0.1)
+    train_loader = DataLoader(train_dataset, batch_size=1, shuffle=True)
+    val_loader = DataLoader(val_dataset, batch_size=1)
+
+    teacher_config = {'vocab_size': 410, 'max_len': args.max_len}
+    teacher = Seq2SeqTransformer(**teacher_config)
+    checkpoint = torch.load(args.teacher, map_location=device)
+    teacher.load_state_dict(checkpoint['model_state_dict'])
+    teacher.to(device).eval()
+
+    student, config = build_student(d_model=args.d_model, nhead=args.nhead,
+                                    num_encoder_layers=args.encoder_layers,
+                                    num_decoder_layers=args.decoder_layers,
+                                    dim_feedforward=args.dim_feedforward, max_len=args.max_len)
+    if args.d_model == 512:
+        init_student_from_teacher(student, teacher)
+
+    distill_train(teacher, student, config, train_loader, val_loader, num_epochs=args.epochs,
+                  alpha=args.alpha, temperature=args.temperature, ckpt_path=args.out,
+                  plt_pth=os.path.splitext(args.report)[0] + ".png")
+
+    # 用保存的最优学生在留出集上与教师对比，解码速度统一在 CPU 上测
+    student.load_state_dict(torch.load(args.out, map_location=device)['model_state_dict'])
+    teacher_stats = evaluate_quality(teacher, val_loader)
+    student_stats = evaluate_quality(student.to(device), val_loader, teacher=teacher)
+    teacher_stats['tokens_per_sec'] = measure_decode_speed(teacher.cpu(), teacher_config)
+    student_stats['tokens_per_sec'] = measure_decode_speed(student.cpu(), config)
+    write_report(teacher_stats, student_stats, config, args.report)
@@ -0,0 +1,266 @@
+import os
+import gc
+import sys
+import time
+import fcntl
+import select
+import signal
+import socket
+import argparse
+import threading
+import torch
+from werkzeug.serving import make_server
+from app import create_app
+from app.config.config import Config
+from app.utils import infer
+from app.utils.cancellation import jobs
+from app.utils.retention import retention_sweeper
+from app.utils.scheduler import generation_scheduler
+
+# ========== 多进程部署入口（预先 fork） ==========
+'''
+run.py 是单进程的开发服务器，一个用户的解码会因为 GIL 挡住其他用户。这里是生产部署入口：
+    - 主进程创建监听 socket、构建应用并加载模型（内存映射，见 infer.load_model），然后 fork 出 N 个工作进程；
+      工作进程继承已加载的模型，权重页在进程间共享（写时复制，推理不写权重），常驻内存不随工作进程数成倍增加
+    - 每个工作进程设置 torch.set_num_threads(CPU 核数 / 工作进程数)，多个进程同时解码时不会超额占用 CPU
+    - MAX_CONCURRENT_JOBS / MAX_QUEUE_DEPTH 按工作进程数平分（每个进程至少 1），全机同时运行的生成任务数
+      不会变成 工作进程数 × MAX_CONCURRENT_JOBS；工作进程数多于 MAX_CONCURRENT_JOBS 时每个进程同时只生成一个
+    - 所有工作进程在同一个监听 socket 上 accept，由内核分配连接；每个工作进程内部仍是多线程服务器
+    - 后台线程只在工作进程中启动（fork 只复制调用线程，主进程中的线程和它持有的锁不能带进子进程）；
+      过期会话清理只在 0 号工作进程中运行
+    - /cancel 在本进程找不到任务时通过管道交给主进程，由主进程转发给所有工作进程
+信号：
+    SIGHUP          平滑重载：主进程重新加载模型文件，启动新一代工作进程后让旧的工作进程处理完进行中的请求再退出
+    SIGTERM/SIGINT  平滑停止：工作进程停止 accept，等进行中的请求和后台生成结束（最多 SERVER_GRACEFUL_TIMEOUT 秒）
+工作进程意外退出时主进程会重新 fork 一个。修改代码后需要完整重启；SIGHUP 只重新加载模型。
+使用 GPU 时 CUDA 不能跨 fork 使用，主进程不预加载模型，各工作进程自己加载。
+'''
+
+
+def log(role, message):
+    print(f"[{role} {os.getpid()}] {message}", flush=True)
+
+
+def preload_models():
+    """在主进程中加载模型，fork 出的工作进程直接使用；返回是否预加载"""
+    if torch.cuda.is_available():
+        log('master', "检测到 CUDA，由各工作进程自己加载模型")
+        return False
+    device = torch.device("cpu")
+    for model_name in (Config.MODEL_NAME, Config.DRAFT_MODEL_NAME):
+        if not model_name:
+            continue
+        model_path = os.path.join(Config.MODEL_PATH, model_name)
+        if not os.path.exists(model_path):
+            log('master', f"模型文件不存在，跳过预加载: {model_path}")
+            continue
+        infer.load_model(model_path, device)
+        log('master', f"已预加载模型: {model_path}")
+    # 把目前的所有对象移出 GC 跟踪，工作进程中的 GC 不会遍历并改写这些对象所在的页，它们保持共享
+    gc.freeze()
+    return True
+
+
+class Worker:
+    def __init__(self, index, pid, cancel_pipe):
+        self.index = index
+        self.pid = pid
+        # 主进程写入端：转发取消请求
+        self.cancel_pipe = cancel_pipe
+        self.retiring = False
+
+
+def _listen_for_cancel(fd):
+    """工作进程：逐行读取主进程转发来的 job_id 并取消本进程中的任务"""
+    with os.fdopen(fd, 'rb') as pipe:
+        for line in pipe:
+            jobs.cancel(line.decode('utf-8', 'ignore').strip(), 'cancelled')
+
+
+def _wait_background(timeout):
+    """等待后台生成（预览模式）结束，超过 timeout 秒放弃"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = generation_scheduler.stats()
+        if not stats['running'] and not stats['queued'] and not jobs.count():
+            return True
+        time.sleep(0.2)
+    return False
+
+
+def split_limit(total, num_workers, index):
+    """把全机的上限分给各工作进程：余数给编号小的进程，每个进程至少 1"""
+    return max(1, total // num_workers + (1 if index < total % num_workers else 0))
+
+
+def run_worker(index, num_workers, app, host, port, listen_fd, cancel_fd, relay_fd, torch_threads):
+    role = f'worker {index}'
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C 由主进程处理
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    torch.set_num_threads(torch_threads)
+    # MAX_CONCURRENT_JOBS / MAX_QUEUE_DEPTH 是整台机器的上限，每个工作进程的调度器只管自己那一份
+    generation_scheduler.max_concurrent = split_limit(Config.MAX_CONCURRENT_JOBS, num_workers, index)
+    generation_scheduler.max_queue = split_limit(Config.MAX_QUEUE_DEPTH, num_workers, index)
+
+    def relay(job_id):
+        data = (job_id + '\n').encode('utf-8')
+        if '\n' in job_id or len(data) > 512:
+            return False
+        os.write(relay_fd, data)
+        return True
+
+    jobs.relay = relay
+    threading.Thread(target=_listen_for_cancel, args=(cancel_fd,), daemon=True).start()
+    if index == 0:
+        retention_sweeper.start()
+
+    server = make_server(host, port, app, threaded=True, fd=listen_fd)
+    # 停止时等请求线程处理完再退出
+    server.daemon_threads = False
+    server.block_on_close = True
+
+    def stop(signum, frame):
+        # 平滑重载时新一代的 0 号工作进程已经启动了自己的清理线程，旧的立即停止，两者不会同时删除文件
+        retention_sweeper.stop()
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    log(role, f"已启动，torch 线程数 {torch_threads}，同时生成 {generation_scheduler.max_concurrent} 个，"
+              f"排队上限 {generation_scheduler.max_queue}")
+    server.serve_forever()
+    server.server_close()
+    if not _wait_background(Config.SERVER_GRACEFUL_TIMEOUT):
+        log(role, "等待后台生成超时，强制退出")
+    log(role, "已退出")
+
+
+class Master:
+    def __init__(self, host, port, num_workers, torch_threads):
+        self.host = host
+        self.port = port
+        self.num_workers = num_workers
+        self.torch_threads = torch_threads or max(1, (os.cpu_count() or 1) // num_workers)
+        self.workers = {}  # pid -> Worker
+        self.signals = []
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(128)
+        self.sock.set_inheritable(True)
+        # 工作进程把找不到的取消请求写到这里
+        self.relay_r, self.relay_w = os.pipe()
+        self.app = create_app(start_background=False)
+
+    def spawn(self, index):
+        cancel_r, cancel_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                os.close(cancel_w)
+                os.close(self.relay_r)
+                for worker in self.workers.values():
+                    os.close(worker.cancel_pipe)
+                run_worker(index, self.num_workers, self.app, self.host, self.port, self.sock.fileno(), cancel_r,
+                           self.relay_w, self.torch_threads)
+            except Exception as e:
+                log(f'worker {index}', f"异常退出: {str(e)}")
+                exit_code = 1
+            finally:
+                sys.stdout.flush()
+                os._exit(exit_code)
+        os.close(cancel_r)
+        fcntl.fcntl(cancel_w, fcntl.F_SETFL, fcntl.fcntl(cancel_w, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.workers[pid] = Worker(index, pid, cancel_w)
+        return pid
+
+    def _forward_cancels(self, data):
+        for line in data.splitlines(keepends=True):
+            for worker in self.workers.values():
+                try:
+                    os.write(worker.cancel_pipe, line)
+                except OSError:
+                    pass
+
+    def _reap(self, respawn=True):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            os.close(worker.cancel_pipe)
+            if respawn and not worker.retiring:
+                log('master', f"工作进程 {worker.index}（{pid}）意外退出（{status}），重新启动")
+                time.sleep(1)  # 避免启动即崩溃时不停 fork
+                self.spawn(worker.index)
+
+    def reload(self):
+        """重新加载模型，启动新一代工作进程后让旧的平滑退出"""
+        log('master', "平滑重载")
+        old = [worker for worker in self.workers.values() if not worker.retiring]
+        gc.unfreeze()
+        infer._model_cache.clear()
+        preload_models()
+        for index in range(self.num_workers):
+            self.spawn(index)
+        for worker in old:
+            worker.retiring = True
+            os.kill(worker.pid, signal.SIGTERM)
+
+    def stop(self):
+        log('master', "平滑停止，等待工作进程结束")
+        for worker in self.workers.values():
+            worker.retiring = True
+            try:
+                os.kill(worker.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + Config.SERVER_GRACEFUL_TIMEOUT + 10
+        while self.workers and time.monotonic() < deadline:
+            self._reap(respawn=False)
+            time.sleep(0.1)
+        for worker in self.workers.values():
+            os.kill(worker.pid, signal.SIGKILL)
+        self.sock.close()
+
+    def run(self):
+        preload_models()
+        for index in range(self.num_workers):
+            self.spawn(index)
+        log('master', f"监听 {self.sock.getsockname()}，工作进程 {self.num_workers} 个，每个 torch 线程 {self.torch_threads} 个")
+
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: self.signals.append(signum))
+        while True:
+            try:
+                readable, _, _ = select.select([self.relay_r], [], [], 0.5)
+            except InterruptedError:
+                readable = []
+            if readable:
+                self._forward_cancels(os.read(self.relay_r, 65536))
+            while self.signals:
+                signum = self.signals.pop(0)
+                if signum == signal.SIGHUP:
+                    self.reload()
+                else:
+                    self.stop()
+                    return
+            self._reap()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="多进程部署：主进程加载模型后 fork 出工作进程")
+    parser.add_argument('--host', default=Config.SERVER_HOST)
+    parser.add_argument('--port', type=int, default=Config.SERVER_PORT)
+    parser.add_argument('--workers', type=int, default=Config.SERVER_WORKERS, help="工作进程数")
+    parser.add_argument('--threads', type=int, default=Config.SERVER_TORCH_THREADS,
+                        help="每个工作进程的 torch 线程数，默认 CPU 核数 / 工作进程数")
+    args = parser.parse_args()
+    Master(args.host, args.port, max(1, args.workers), args.threads).run()